@@ -5,6 +5,7 @@ other modules.  Reduces the overhead/etc of importing api.py itself.
 
 from esmond.config import get_config_path, get_config
 from esmond.api.models import OIDSet
+from esmond.util import get_logger
 
 # Prefix used in all the snmp data cassandra keys
 SNMP_NAMESPACE = 'snmp'
@@ -13,6 +14,36 @@ SNMP_NAMESPACE = 'snmp'
 alim = lambda x: x.api_anon_limit if x.api_anon_limit else 30
 ANON_LIMIT = alim(get_config(get_config_path()))
 
+_conf = get_config(get_config_path())
+
+# Stream data responses with more points than this, 0 disables streaming.
+STREAM_THRESHOLD = _conf.api_stream_threshold or 0
+
+# Threads shared by the process for bulk timeseries queries, how many of 
+# them one request can use at once and the deadline for a whole request.
+BULK_QUERY_THREADS = _conf.api_bulk_threads or 1
+BULK_QUERY_CONCURRENCY = _conf.api_bulk_concurrency or 1
+BULK_QUERY_DEADLINE = _conf.api_bulk_deadline or None
+
+# Token bucket for the (estimated) data points anonymous clients can 
+# request from the bulk endpoints: its size and the points per second it 
+# refills at. A size of 0 disables the bucket. The buckets have to be 
+# shared by all of the WSGI processes, otherwise every process would hand 
+# out a full budget, so they are only used with api_throttle_memcached.
+ANON_BULK_POINTS = _conf.api_anon_bulk_points or 0
+ANON_BULK_RATE = _conf.api_anon_bulk_rate or 1
+
+if ANON_BULK_POINTS and not _conf.api_throttle_memcached:
+    get_logger(__name__).warning("api_throttle_memcached not defined: "
+        "anonymous bulk requests are only limited by api_anon_limit")
+    ANON_BULK_POINTS = 0
+
+# Data ranges that ended more than CLOSED_RANGE_DELAY seconds ago don't 
+# change anymore, unless they are backfilled, and can be cached for 
+# CACHE_MAX_AGE seconds if it is set.
+CACHE_MAX_AGE = _conf.api_cache_max_age or 0
+CLOSED_RANGE_DELAY = _conf.api_closed_range_delay or 0
+
 # Set up data structure mapping oidsets/oids to REST uri endpoints.
 class EndpointMap(object):
     """
@@ -11,6 +11,7 @@ import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
 
+from django.db.models import Case, Count, IntegerField, Max, Sum, Value, When
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import make_aware, utc
 from django.utils.timezone import now as django_now
@@ -29,12 +30,23 @@ from rest_framework_extensions.fields import ResourceUriField
 import rest_framework_filters as filters
 
 from .models import *
-from esmond.api import SNMP_NAMESPACE, ANON_LIMIT, OIDSET_INTERFACE_ENDPOINTS
-from esmond.util import atdecode, atencode
+from esmond.api import (SNMP_NAMESPACE, ANON_LIMIT, OIDSET_INTERFACE_ENDPOINTS,
+        BULK_QUERY_THREADS, BULK_QUERY_CONCURRENCY, BULK_QUERY_DEADLINE,
+        ANON_BULK_POINTS, ANON_BULK_RATE)
+from esmond.util import atdecode, atencode, max_datetime
 from esmond.api.dataseries import QueryUtil, Fill, TimerangeException
+from esmond.api.streaming import (JSONStream, StreamingJSONResponse,
+        should_stream, iter_queryset)
+from esmond.api.querypool import QueryPool, DeadlineExceeded
+from esmond.api.tokenbucket import TokenBucket
+from esmond.api.renderers import DATA_RENDERER_CLASSES
+from esmond.api.conditional import (make_etag, not_modified_response,
+        add_validators, range_is_closed, closed_range_last_modified)
 from esmond.cassandra import CASSANDRA_DB, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin
 from esmond.config import get_config_path, get_config
 
+from pycassa.pool import MaximumRetryException
+
 #
 # Cassandra connection
 # 
@@ -196,7 +208,24 @@ class BaseDataSerializer(BaseMixin, serializers.Serializer):
     begin_time = serializers.IntegerField()
     end_time = serializers.IntegerField()
 
+def stream_data_response(serializer_class, obj, request, status=200):
+    """
+    Stream the data of obj. The rest of the return envelope is 
+    generated by serializer_class as usual and obj.data (any iterable, 
+    a generator in the bulk viewsets) is encoded into it as it is 
+    written out.
+    """
+    data = obj.data
+    obj.data = []
+    envelope = serializer_class(obj.to_dict(), context={'request': request}).data
+    obj.data = data
+
+    return StreamingJSONResponse(JSONStream(envelope, 'data', data), status=status)
+
 class BaseDataViewset(viewsets.GenericViewSet):
+    # JSON, the browsable API and format=packed
+    renderer_classes = DATA_RENDERER_CLASSES
+
     def _endpoint_map(self, device, iface_name):
 
         endpoint_map = {}
@@ -264,6 +293,22 @@ class BaseDataViewset(viewsets.GenericViewSet):
         else:
             obj.agg = None
 
+    def _closed_range_validators(self, request, end_time, *state):
+        """
+        Conditional GET validators for a data request. Only a time range 
+        that is completely in the past gets any, the data for it won't 
+        change so it can be cached. state is whatever else the response 
+        depends on.
+        """
+        if not range_is_closed(end_time):
+            return {}
+
+        return dict(
+            etag=make_etag(request, end_time, *state),
+            last_modified=closed_range_last_modified(end_time),
+            immutable=True,
+        )
+
 #
 # Filter classes and functions
 # 
@@ -343,6 +388,22 @@ def build_time_filters(request):
     # print orm_filters
     return orm_filters 
 
+def ifref_state(qs):
+    """
+    Cheap summary of a set of IfRefs for conditional GET. It changes 
+    whenever the persister adds a row, closes one (an interface went 
+    away) or replaces one (a new row with a higher id), or the device 
+    is changed.
+    """
+    state = qs.aggregate(
+        count=Count('id'),
+        last_id=Max('id'),
+        open=Sum(Case(When(end_time=max_datetime, then=Value(1)),
+            default=Value(0), output_field=IntegerField())),
+        generation=Max('device__generation'),
+    )
+    return sorted(state.items())
+
 def get_single_iface(ifname, device_name, request):
     """
     The standard time range filtering is applied to get_object since there may
@@ -373,12 +434,14 @@ def get_single_iface(ifname, device_name, request):
     if not request.user.has_perm("api.can_see_hidden_ifref"):
         qs = qs.exclude(ifAlias__contains=":hide:")
 
+    # there might be more than one, so sort and return.
+    qs = list(qs.select_related('device').order_by('-end_time')[:1])
+
     if len(qs) == 0:
         # Let the recieving code decide how to handle this.
         return None
     else:
-        # there might be more than one, so sort and return.
-        return qs.order_by('-end_time')[0]
+        return qs[0]
 
 def get_single_outlet(outlet_id, device_name, request):
     """
@@ -409,7 +472,29 @@ class CustomThrottleAuth(APIException):
     status_code = status.HTTP_401_UNAUTHORIZED
     default_detail = _('Auth-based bulk throttling.')
 
+class BulkRequestTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = _('Bulk request exceeds the unauthenticated limit.')
+
+# Frequency (in seconds) assumed when estimating the cost of a bulk 
+# request that doesn't ask for a specific one.
+BULK_COST_FREQUENCY = 30
+
+def expected_points(begin, end, freq):
+    """Estimate the number of data points between begin and end."""
+    return max(1, (end - begin) / max(1, int(freq)))
+
 class BaseBulkThrottle(throttling.BaseThrottle):
+    """
+    Throttle for clients that are not authenticated. A request can ask 
+    for at most ANON_LIMIT endpoints and is charged the number of data 
+    points it is expected to return against a token bucket per client.
+    A request the bucket doesn't have enough points for gets a 429 
+    telling the client how long to wait. A request for more points than 
+    the whole bucket holds would never be let through, so it gets a 413 
+    instead.
+    """
+    bucket = TokenBucket(ANON_BULK_POINTS, ANON_BULK_RATE, prefix='esmond_bulk')
 
     def _check_payload_and_request(self, post_payload):
         """
@@ -419,25 +504,52 @@ class BaseBulkThrottle(throttling.BaseThrottle):
         """
         raise NotImplementedError
 
+    def _request_cost(self, post_payload, request, view):
+        """
+        Override in subclasses. Return the number of data points the 
+        request is expected to return.
+        """
+        raise NotImplementedError
+
     def allow_request(self, request, view):
+        self.wait_time = None
 
         if request.user.is_authenticated():
             # Authenticated users can as for however much data
             return True
 
-        if request.body and request.content_type.startswith('application/json'):
-            post_payload = json.loads(request.body)
+        # request.data is parsed once and kept on the request, the view 
+        # uses the same payload.
+        if request.content_type.startswith('application/json') and \
+            request.data and isinstance(request.data, dict):
+            post_payload = request.data
         else:
             # status 400
             raise ParseError('Did not receive json payload for bulk POST request.')
 
         num_request = self._check_payload_and_request(post_payload)
 
-        if num_request <= ANON_LIMIT:
-            return True
-        else:
+        if num_request > ANON_LIMIT:
             raise CustomThrottleAuth('Request for {0} endpoints exceeds the unauthenticated limit of {1}'.format(num_request, ANON_LIMIT))
 
+        if not self.bucket.size:
+            return True
+
+        try:
+            cost = self._request_cost(post_payload, request, view)
+        except (ValueError, TypeError):
+            raise ParseError('Invalid time range or frequency in bulk POST request.')
+
+        if cost > self.bucket.size:
+            raise BulkRequestTooLarge('Request for {0} data points exceeds the unauthenticated limit of {1} per request, ask for a shorter time range or fewer endpoints, or authenticate'.format(cost, self.bucket.size))
+
+        self.wait_time = self.bucket.consume(self.get_ident(request), cost)
+
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
+
 class DjangoModelPerm(DjangoModelPermissions):
     """
     Just allowing unauth for read ops
@@ -487,11 +599,28 @@ class QueryBase(object):
     specific query class.
     """
 
+    def _check_interface_data_query(self, oidset, obj):
+        """Reality checks on an interface data request that can be 
+        made before it is executed. The bulk viewset uses this to reject 
+        a request before it starts streaming the results."""
+        raise NotImplementedError('override in subclass')
+
     def _execute_interface_data_query(self, oidset, obj):
         """Logic to retrieve interface data for InterfaceDataViewset
         and (by extension) BulkInterfaceRequestViewset classes."""
         raise NotImplementedError('override in subclass')
 
+    def _execute_interface_data_queries(self, queries):
+        """Logic to retrieve interface data for a list of (oidset, obj) 
+        pairs in as few backend requests as possible. Used by the 
+        BulkInterfaceRequestViewset."""
+        raise NotImplementedError('override in subclass')
+
+    def _check_timeseries_query(self, obj):
+        """Reality checks on a timeseries request that can be made 
+        before it is executed."""
+        raise NotImplementedError('override in subclass')
+
     def _execute_timeseries_query(self, obj):
         """Logic to retrieve more free-form timeseries data for 
         TimeseriesRequestViewset and (by extension)  the 
@@ -507,14 +636,10 @@ class QueryBase(object):
         raise NotImplementedError('override in subclass')
 
 class CassandraQueryLogic(QueryBase):
-    def _execute_interface_data_query(self, oidset, obj):
+    def _check_interface_data_query(self, oidset, obj):
         """
-        Query to get interface data tied to specific oid/set datasets 
-        (as opposed to the free-form timeseries endpoint).
-
-        Executes a couple of reality checks (making sure that a valid 
-        aggregation was requested and checks/limits the time range), and
-        then make calls to cassandra backend.
+        Make sure that a valid aggregation was requested and check/limit 
+        the time range.
         """
         # If no aggregate level defined in request, set to the frequency, 
         # otherwise, check if the requested aggregate level is valid.
@@ -530,6 +655,21 @@ class CassandraQueryLogic(QueryBase):
             not obj.user.username:
             raise QueryErrorException('exceeded valid timerange for agg level: {0}'.format(obj.agg))
 
+        if obj.agg != oidset.frequency and obj.cf not in AGG_TYPES:
+            raise QueryErrorException('%s is not a valid consolidation function' %
+                    (obj.cf))
+
+        return obj
+
+    def _execute_interface_data_query(self, oidset, obj):
+        """
+        Query to get interface data tied to specific oid/set datasets 
+        (as opposed to the free-form timeseries endpoint).
+
+        Executes a couple of reality checks (see above), and then make 
+        calls to cassandra backend.
+        """
+        self._check_interface_data_query(oidset, obj)
 
         if obj.agg == oidset.frequency:
             # Fetch the base rate data.
@@ -537,9 +677,6 @@ class CassandraQueryLogic(QueryBase):
                     ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000)
         else:
             # Get the aggregation.
-            if obj.cf not in AGG_TYPES:
-                raise QueryErrorException('%s is not a valid consolidation function' %
-                        (obj.cf))
             data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg*1000,
                     ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000, cf=obj.cf)
 
@@ -547,26 +684,71 @@ class CassandraQueryLogic(QueryBase):
 
         return obj
 
-    def _execute_timeseries_query(self, obj):
+    def _execute_interface_data_queries(self, queries):
         """
-        Query for "timeseries" retrieval endpoint.
+        Query to get the interface data for a bulk request. The queries 
+        are a list of (oidset, obj) pairs that have already been through 
+        _check_interface_data_query.
 
-        Sanity check the requested timerange, and then make the appropriate
-        method call to the cassandra backend.
+        The queries are grouped by frequency (and consolidation function 
+        for aggregations) and each group is fetched with a single 
+        multiget rather than a couple of cassandra requests per query.
+        """
+        groups = collections.OrderedDict()
+
+        for oidset, obj in queries:
+            if obj.agg == oidset.frequency:
+                k = (True, obj.agg, None, obj.begin_time, obj.end_time)
+            else:
+                k = (False, obj.agg, obj.cf, obj.begin_time, obj.end_time)
+            groups.setdefault(k, []).append(obj)
+
+        for (base_rate, agg, cf, begin_time, end_time), objs in groups.items():
+            paths = [obj.datapath for obj in objs]
+
+            if base_rate:
+                results = db.query_baserate_timerange_multi(paths=paths,
+                        freq=agg*1000, ts_min=begin_time*1000,
+                        ts_max=end_time*1000)
+            else:
+                results = db.query_aggregation_timerange_multi(paths=paths,
+                        freq=agg*1000, ts_min=begin_time*1000,
+                        ts_max=end_time*1000, cf=cf)
+
+            for obj, data in zip(objs, results):
+                obj.data = QueryUtil.format_cassandra_data_payload(data)
+
+        return [obj for oidset, obj in queries]
+
+    def _check_timeseries_query(self, obj):
+        """
+        Sanity check the requested timerange and consolidation function.
         """
         # Make sure we're not exceeding allowable time range.
         if not QueryUtil.valid_timerange(obj, in_ms=True) and \
             not obj.user.username:
             raise QueryErrorException('exceeded valid timerange for agg level: {0}'.format(obj.agg))
-        
+
+        if obj.r_type == 'Aggs' and obj.cf not in AGG_TYPES:
+            raise QueryErrorException('{0} is not a valid consolidation function'.format(obj.cf))
+
+        return obj
+
+    def _execute_timeseries_query(self, obj):
+        """
+        Query for "timeseries" retrieval endpoint.
+
+        Sanity check the request (see above), and then make the appropriate
+        method call to the cassandra backend.
+        """
+        self._check_timeseries_query(obj)
+
         data = []
 
         if obj.r_type == 'BaseRate':
             data = db.query_baserate_timerange(path=obj.datapath, freq=obj.agg,
                     ts_min=obj.begin_time, ts_max=obj.end_time)
         elif obj.r_type == 'Aggs':
-            if obj.cf not in AGG_TYPES:
-                raise QueryErrorException('{0} is not a valid consolidation function'.format(obj.cf))
             data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg,
                     ts_min=obj.begin_time, ts_max=obj.end_time, cf=obj.cf)
         elif obj.r_type == 'RawData':
@@ -711,8 +893,21 @@ class OidsetMapViewset(viewsets.GenericViewSet):
 # ie: /v2/interface/
 # Also subclassed by the interfaces nested under the device endpoint.
 
-class EsmondPaginator(pagination.LimitOffsetPagination):
-    default_limit = 20
+class KeysetPaginationMixin(object):
+    """
+    Keyset pagination and optional counts for a LimitOffsetPagination.
+
+    With ?after=<id> a page is the limit rows with an id greater than 
+    <id>, in id order, and the next link carries on from the last of 
+    them. Unlike an OFFSET the database doesn't have to step over all of 
+    the earlier rows so a deep page of a large listing is as fast as the 
+    first one. Start with after=0, the links only go forward.
+
+    ?count=false skips counting all of the matching rows, the total 
+    count is then null.
+    """
+    after_query_param = 'after'
+    count_query_param = 'count'
 
     def _get_count(self, queryset):
         try:
@@ -720,46 +915,107 @@ class EsmondPaginator(pagination.LimitOffsetPagination):
         except (AttributeError, TypeError):
             return len(queryset)
 
-    
+    def get_after(self, request):
+        try:
+            return int(request.query_params[self.after_query_param])
+        except (KeyError, ValueError):
+            return None
+
+    def get_total_count(self, request, queryset):
+        if request.query_params.get(self.count_query_param, '').lower() in \
+                ('0', 'false', 'no'):
+            return None
+
+        return self._get_count(queryset)
+
+    def paginate_page(self, queryset):
+        """
+        Return the page after self.after, or at self.offset, and find out 
+        from one extra row whether there is another one after it.
+        """
+        start = self.offset
+        if self.after is not None:
+            queryset = queryset.filter(id__gt=self.after).order_by('id')
+            start = 0
+
+        page = list(queryset[start:start + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        self.last_id = page[-1].id if page else self.after
+
+        return page
+
+    def get_keyset_next_link(self):
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.after_query_param, self.last_id)
+
+class EsmondPaginator(KeysetPaginationMixin, pagination.LimitOffsetPagination):
+    default_limit = 20
 
     def paginate_queryset(self, queryset, request, view=None):
         """
-        Modified to make ?limit=0 return the whole dataset.
+        Modified to make ?limit=0 return the whole dataset, streaming 
+        it when it is large (see StreamingListMixin), and for keyset 
+        pagination.
         """
         self.limit = self.get_limit(request)
         if self.limit is None:
             return None
 
-        self.count = self._get_count(queryset)
         self.request = request
+        self.after = self.get_after(request)
+        self.count = self.get_total_count(request, queryset)
+        self.streaming = False
 
-        if self.count > self.limit and self.template is not None:
+        if self.count is not None and self.count > self.limit and \
+                self.template is not None:
                 self.display_page_controls = True
 
         if self.limit == 0:
             self.offset = 0
+            if self.after is not None:
+                queryset = queryset.filter(id__gt=self.after).order_by('id')
+            self.streaming = should_stream(request, self.count)
+            if self.streaming:
+                return iter_queryset(queryset)
             return list(queryset)
+        elif self.after is not None:
+            self.offset = 0
+            return self.paginate_page(queryset)
         else:
             self.offset = self.get_offset(request)
             return list(queryset[self.offset:self.offset + self.limit])
 
+    def _envelope(self, data):
+        return {
+            'meta': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link(),
+                'limit': self.limit,
+                'total_count': self.count,
+                'offset': self.offset,
+            },
+
+            'children': data,
+        }
+
     def get_paginated_response(self, data):
         """
         Format the return envelope.
         """
-        return Response(
-            {
-                'meta': {
-                    'next': self.get_next_link(),
-                    'previous': self.get_previous_link(),
-                    'limit': self.limit,
-                    'total_count': self.count,
-                    'offset': self.offset,
-                },
-
-                'children': data,
-            }
-        )
+        return Response(self._envelope(data))
+
+    def get_streaming_response(self, items):
+        """
+        The return envelope with the serialized items streamed in.
+        """
+        return StreamingJSONResponse(
+            JSONStream(self._envelope(None), 'children', items))
 
     #
     # XXX(mmg): these are copied and pasted/adapted from the DRF 3.2 version.
@@ -772,6 +1028,9 @@ class EsmondPaginator(pagination.LimitOffsetPagination):
             # custom logic for our limit=0 mods.
             return None
 
+        if self.after is not None:
+            return self.get_keyset_next_link()
+
         url = self.request.build_absolute_uri()
         url = replace_query_param(url, self.limit_query_param, self.limit)
 
@@ -779,7 +1038,7 @@ class EsmondPaginator(pagination.LimitOffsetPagination):
         return replace_query_param(url, self.offset_query_param, offset)
 
     def get_previous_link(self):
-        if self.offset <= 0:
+        if self.after is not None or self.offset <= 0:
             return None
 
         url = self.request.build_absolute_uri()
@@ -791,6 +1050,28 @@ class EsmondPaginator(pagination.LimitOffsetPagination):
         offset = self.offset - self.limit
         return replace_query_param(url, self.offset_query_param, offset)
 
+class StreamingListMixin(object):
+    """
+    list() for the viewsets paginated by EsmondPaginator. When the 
+    paginator streams a large limit=0 listing the objects are serialized 
+    one at a time as they are written rather than all at once.
+    """
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            if getattr(self.paginator, 'streaming', False):
+                serializer = self.get_serializer()
+                return self.paginator.get_streaming_response(
+                    serializer.to_representation(obj) for obj in page)
+
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
 class InterfaceSerializer(BaseMixin, serializers.ModelSerializer):
     serializer_url_field = InterfaceHyperlinkField
 
@@ -816,27 +1097,47 @@ class InterfaceSerializer(BaseMixin, serializers.ModelSerializer):
     device = serializers.SlugRelatedField(queryset=Device.objects.all(), slug_field='name')
     device_uri = serializers.CharField(allow_blank=True, trim_whitespace=True)
 
+    def _endpoint_aliases(self, device):
+        """
+        The data-bearing OID endpoints of a device. These are the same 
+        for every interface on the device so they are worked out once 
+        per device per request (the serializer context is shared by all 
+        of the interfaces in a listing) from the cached endpoint map.
+        """
+        cache = self.context.setdefault('endpoint_aliases', {})
+
+        if device.id not in cache:
+            aliases = []
+            for oidset in device.oidsets.all():
+                aliases.extend(sorted(
+                    OIDSET_INTERFACE_ENDPOINTS.endpoints.get(oidset.name, {}).keys()))
+            cache[device.id] = aliases
+
+        return cache[device.id]
+
     def to_representation(self, obj):
         obj.children = list()
         obj.device_uri = ''
         obj.leaf = False
         # list of actual data-bearing OID endpoints.
-        for i in obj.device.oidsets.all():
-            for ii in i.oids.all():
-                if ii.endpoint_alias:
-                    d = dict(
-                            name=ii.endpoint_alias, 
-                            url=self.serializer_url_field._oid_detail_url(obj.ifName, obj.device.name, self.context.get('request'), ii.endpoint_alias),
-                            leaf=True,
-                        )
-                    self._add_uris(d, resource=False)
-                    obj.children.append(d)
+        aliases = self._endpoint_aliases(obj.device)
+        if aliases:
+            iface_url = self.serializer_url_field._iface_detail_url(obj.ifName,
+                obj.device.name, self.context.get('request'))
+        for alias in aliases:
+            d = dict(
+                    name=alias, 
+                    url=iface_url + '/' + alias,
+                    leaf=True,
+                )
+            self._add_uris(d, resource=False)
+            obj.children.append(d)
         ret =  super(InterfaceSerializer, self).to_representation(obj)
         self._add_uris(ret)
         self._add_device_uri(ret)
         return ret
 
-class InterfaceViewset(BaseMixin, viewsets.ReadOnlyModelViewSet):
+class InterfaceViewset(StreamingListMixin, BaseMixin, viewsets.ReadOnlyModelViewSet):
     # queryset returned by overridden get_queryset()
     serializer_class = InterfaceSerializer
     lookup_field = 'ifName'
@@ -846,7 +1147,8 @@ class InterfaceViewset(BaseMixin, viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         filters = build_time_filters(self.request)
 
-        ret = IfRef.objects.filter(**filters)
+        ret = IfRef.objects.filter(**filters) \
+            .select_related('device').prefetch_related('device__oidsets')
 
         # filter out hidden ifrefs based on perms
         if not self.request.user.has_perm('api.can_see_hidden_ifref'):
@@ -854,6 +1156,18 @@ class InterfaceViewset(BaseMixin, viewsets.ReadOnlyModelViewSet):
 
         return ret      
 
+    def list(self, request, *args, **kwargs):
+        etag = make_etag(request,
+            ifref_state(self.filter_queryset(self.get_queryset())))
+
+        response = not_modified_response(request, etag=etag)
+        if response is not None:
+            return response
+
+        return add_validators(
+            super(InterfaceViewset, self).list(request, *args, **kwargs),
+            etag=etag)
+
 # Classes for devices in the "main" rest URI series, ie:
 # /v2/device/
 # /v2/device/$DEVICE/
@@ -903,7 +1217,27 @@ class DeviceViewset(viewsets.ModelViewSet):
 
     def get_queryset(self):
         filters = build_time_filters(self.request)
-        return Device.objects.filter(**filters)
+        ret = Device.objects.filter(**filters)
+
+        # Not for updates, which change the oidsets before serializing.
+        if self.action == 'list':
+            ret = ret.prefetch_related('oidsets')
+
+        return ret
+
+    def list(self, request, *args, **kwargs):
+        # Device.generation changes whenever a device or its oidsets do.
+        state = self.get_queryset().aggregate(count=Count('id'),
+            last_id=Max('id'), generation=Max('generation'))
+        etag = make_etag(request, sorted(state.items()))
+
+        response = not_modified_response(request, etag=etag)
+        if response is not None:
+            return response
+
+        return add_validators(
+            super(DeviceViewset, self).list(request, *args, **kwargs),
+            etag=etag)
 
     def _no_verb(self):
         return Response({'error': 'Endpoint only supports GET and PUT'}, status.HTTP_400_BAD_REQUEST)
@@ -972,7 +1306,8 @@ class NestedInterfaceViewset(InterfaceViewset):
         if self.kwargs.get('parent_lookup_device__name', None):
             filters['device__name'] = self.kwargs.get('parent_lookup_device__name')
 
-        ret = IfRef.objects.filter(**filters)
+        ret = IfRef.objects.filter(**filters) \
+            .select_related('device').prefetch_related('device__oidsets')
 
         # filter out hidden ifrefs based on perms
         if not self.request.user.has_perm('api.can_see_hidden_ifref'):
@@ -1062,17 +1397,29 @@ class InterfaceDataViewset(BaseDataViewset, QueryBackend):
 
         self._parse_data_default_args(request, obj)
 
+        validators = self._closed_range_validators(request, obj.end_time,
+            iface.pk, iface.device.generation)
+        response = not_modified_response(request, **validators)
+        if response is not None:
+            return response
+
         obj.data = list()
 
         try:
             # defined in QueryBackend mixin
             obj = self._execute_interface_data_query(oidset, obj)
             obj = self._format_payload(obj)
-            serializer = InterfaceDataSerializer(obj.to_dict(), context={'request': request})
-            return Response(serializer.data)
         except (QueryErrorException, TimerangeException) as e:
             return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
 
+        if should_stream(request, len(obj.data)):
+            response = stream_data_response(InterfaceDataSerializer, obj, request)
+        else:
+            serializer = InterfaceDataSerializer(obj.to_dict(), context={'request': request})
+            response = Response(serializer.data)
+
+        return add_validators(response, **validators)
+
     def _format_payload(self, obj):
         """
         Post process data returned by query. Expects that the obj.data list 
@@ -1126,12 +1473,26 @@ class BulkInterfaceThrottle(BaseBulkThrottle):
 
         return len(post_payload.get('interfaces', []))
 
+    def _request_cost(self, post_payload, request, view):
+        obj = BulkInterfaceDataObject()
+        view._parse_data_default_args(request, obj, time_only=True)
+
+        npoints = expected_points(obj.begin_time, obj.end_time,
+            post_payload.get('agg') or BULK_COST_FREQUENCY)
+
+        return len(post_payload['interfaces']) * \
+            len(post_payload['endpoint']) * npoints
+
 class BulkInterfaceRequestSerializer(InterfaceDataSerializer):
     # other fields defined in superclass
     iface_dataset = serializers.ListField(child=serializers.CharField())
     device_names = serializers.ListField(child=serializers.CharField())
 
-class BulkInterfaceRequestViewset(BaseDataViewset):
+# Upper bound on the number of (estimated) data points fetched from the 
+# backend at once when streaming a bulk response.
+BULK_QUERY_POINTS = 250000
+
+class BulkInterfaceRequestViewset(BaseDataViewset, QueryBackend):
     throttle_classes = (BulkInterfaceThrottle,)
     # This overrides the global "auth or read only" because this uses 
     # post and the throttle class will perform auth-based gating.
@@ -1158,28 +1519,46 @@ class BulkInterfaceRequestViewset(BaseDataViewset):
 
         self._parse_data_default_args(request, ret_obj)
 
-        # process request
-        for i in request.data['interfaces']:
-            device_name = i['device'].rstrip('/').split('/')[-1]
+        # Check the whole request before running any of the queries so 
+        # a bad request is rejected before the results start streaming.
+        # All of the devices and their oidsets are looked up at once.
+        device_names = [i['device'].rstrip('/').split('/')[-1]
+            for i in request.data['interfaces']]
+
+        devices = dict()
+        for device in Device.objects.filter(name__in=set(device_names)) \
+                .prefetch_related('oidsets'):
+            oidsets = dict((o.name, o) for o in device.oidsets.all())
+            devices[device.name] = (self._endpoint_map(device, None), oidsets)
+
+        queries = []
+        npoints = 0
+
+        for i, device_name in zip(request.data['interfaces'], device_names):
             iface_name = i['iface']
 
             # XXX(mmg): should we do an "if in" test first to avoid dupes?
             ret_obj.device_names.append(device_name)
 
-            device = Device.objects.get(name=device_name)
-            endpoint_map = self._endpoint_map(device, iface_name)
+            if device_name not in devices:
+                return Response({'error': 'no such device {0}'.format(device_name)}, status.HTTP_400_BAD_REQUEST)
+
+            endpoint_map, oidsets = devices[device_name]
 
             for end_point in request.data['endpoint']:
 
                 if end_point not in endpoint_map:
                     return Response({'error': 'no such dataset {0}'.format(end_point)}, status.HTTP_400_BAD_REQUEST)
 
-                oidset = device.oidsets.get(name=endpoint_map[end_point][2])
+                oidset = oidsets[endpoint_map[end_point][2]]
 
                 obj = BulkInterfaceDataObject()
-                obj.datapath = endpoint_map[end_point]
+                obj.datapath = endpoint_map[end_point][:-1] + [iface_name]
+                obj.datapath[2] = oidset.set_name
                 obj.iface_dataset = end_point
                 obj.iface = iface_name
+                obj.device_name = device_name
+                obj.user = request.user
 
                 obj.begin_time = ret_obj.begin_time
                 obj.end_time = ret_obj.end_time
@@ -1187,21 +1566,58 @@ class BulkInterfaceRequestViewset(BaseDataViewset):
                 obj.agg = ret_obj.agg
 
                 try:
-                    data = InterfaceDataViewset()._execute_interface_data_query(oidset, obj)
-                    data = InterfaceDataViewset()._format_payload(obj)
+                    self._check_interface_data_query(oidset, obj)
                 except QueryErrorException, e:
                     return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
 
-                row = dict(
-                    data=data.data,
-                    path={'dev': device_name,'iface': iface_name,'endpoint': end_point}
-                )
+                obj.npoints = (obj.end_time - obj.begin_time) / obj.agg
+                queries.append((oidset, obj))
+                npoints += obj.npoints
 
-                ret_obj.data.append(row)
+        if should_stream(request, npoints):
+            ret_obj.data = self._query_rows(queries, stream=True)
+            return stream_data_response(BulkInterfaceRequestSerializer,
+                    ret_obj, request, status.HTTP_201_CREATED)
 
+        ret_obj.data = list(self._query_rows(queries))
         serializer = BulkInterfaceRequestSerializer(ret_obj.to_dict(), context={'request': request})
         return Response(serializer.data, status.HTTP_201_CREATED)
 
+    def _query_rows(self, queries, stream=False):
+        """
+        Generate the result rows. The queries are sent to the backend in 
+        batches, a streamed response fetches at most BULK_QUERY_POINTS 
+        (estimated) points per batch so it only holds one batch in memory.
+        """
+        batch = []
+        npoints = 0
+
+        for oidset, obj in queries:
+            batch.append((oidset, obj))
+            npoints += obj.npoints
+
+            if stream and npoints >= BULK_QUERY_POINTS:
+                for row in self._query_batch(batch, stream):
+                    yield row
+                batch = []
+                npoints = 0
+
+        for row in self._query_batch(batch, stream):
+            yield row
+
+    def _query_batch(self, batch, stream):
+        viewset = InterfaceDataViewset()
+
+        for obj in self._execute_interface_data_queries(batch):
+            obj = viewset._format_payload(obj)
+
+            path = {'dev': obj.device_name, 'iface': obj.iface, 'endpoint': obj.iface_dataset}
+
+            if stream:
+                yield JSONStream(dict(path=path), 'data', obj.data)
+            else:
+                yield dict(data=obj.data, path=path)
+
 ts_ns_doc = """
 **/v1/timeseries/** - Namespace to retrive data with explicit Cassandra 
 schema-like syntax.
@@ -1305,15 +1721,26 @@ class TimeseriesRequestViewset(BaseDataViewset, QueryBackend):
 
         self._parse_data_default_args(request, obj, in_ms=True)
 
+        validators = self._closed_range_validators(request, obj.end_time / 1000)
+        response = not_modified_response(request, **validators)
+        if response is not None:
+            return response
+
         try:
             # defined in QueryBackend mixin
             obj = self._execute_timeseries_query(obj)
             obj = self._format_payload(obj)
-            serializer = TimeseriesRequestSerializer(obj.to_dict(), context={'request': request})
-            return Response(serializer.data)
         except (QueryErrorException, TimerangeException) as e:
             return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
 
+        if should_stream(request, len(obj.data)):
+            response = stream_data_response(TimeseriesRequestSerializer, obj, request)
+        else:
+            serializer = TimeseriesRequestSerializer(obj.to_dict(), context={'request': request})
+            response = Response(serializer.data)
+
+        return add_validators(response, **validators)
+
     def _format_payload(self, obj):
         """
         Post process data returned by query. Expects that the obj.data list 
@@ -1431,9 +1858,27 @@ class BulkTimeseriesThrottle(BaseBulkThrottle):
 
         return len(post_payload.get('paths', []))
 
+    def _request_cost(self, post_payload, request, view):
+        obj = BulkTimeseriesDataObject()
+        view._parse_data_default_args(request, obj, in_ms=True, time_only=True)
+
+        cost = 0
+        for p in post_payload['paths']:
+            # the frequency (in ms) is the last element of a path
+            if isinstance(p, list) and p:
+                freq = p[-1]
+            else:
+                freq = BULK_COST_FREQUENCY * 1000
+            cost += expected_points(obj.begin_time, obj.end_time, freq)
+
+        return cost
+
 class BulkTimeseriesSerializer(InterfaceDataSerializer):
     pass
 
+# Threads shared by all of the bulk timeseries requests in this process.
+bulk_query_pool = QueryPool(BULK_QUERY_THREADS)
+
 class BulkTimeseriesViewset(BaseDataViewset):
     throttle_classes = (BulkTimeseriesThrottle,)
     # This overrides the global "auth or read only" because this uses 
@@ -1468,6 +1913,9 @@ class BulkTimeseriesViewset(BaseDataViewset):
 
         self._parse_data_default_args(request, ret_obj, in_ms=True)
 
+        queries = []
+        npoints = 0
+
         for p in request.data['paths']:
             obj = BulkTimeseriesDataObject()
             obj.r_type = request.data['type']
@@ -1476,23 +1924,68 @@ class BulkTimeseriesViewset(BaseDataViewset):
             obj.end_time = ret_obj.end_time
             obj.datapath = p
             obj.agg = int(obj.datapath.pop())
+            obj.user = request.user
 
             try:
-                obj = TimeseriesRequestViewset()._execute_timeseries_query(obj)
-                obj = TimeseriesRequestViewset()._format_payload(obj)
+                TimeseriesRequestViewset()._check_timeseries_query(obj)
             except QueryErrorException, e:
                 return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
 
-            row = {
-                'data': obj.data,
-                'path': obj.datapath + [obj.agg]
-            }
+            queries.append(obj)
+            npoints += (obj.end_time - obj.begin_time) / obj.agg
 
-            ret_obj.data.append(row)
+        if should_stream(request, npoints):
+            ret_obj.data = self._query_rows(queries, stream=True)
+            return stream_data_response(BulkTimeseriesSerializer,
+                    ret_obj, request, status.HTTP_201_CREATED)
+
+        try:
+            ret_obj.data = list(self._query_rows(queries))
+        except QueryErrorException, e:
+            return Response({'query error': '{0}'.format(str(e))}, status.HTTP_400_BAD_REQUEST)
 
         serializer = BulkTimeseriesSerializer(ret_obj.to_dict(), context={'request': request})
         return Response(serializer.data, status.HTTP_201_CREATED)
 
+    def _query_rows(self, queries, stream=False):
+        """
+        Generate the result rows in the order of the requested paths. 
+        The paths are queried concurrently on the bulk_query_pool, at 
+        most BULK_QUERY_CONCURRENCY at a time, so a streamed response 
+        only holds that many series in memory.
+
+        Paths that are not queried by the BULK_QUERY_DEADLINE or whose 
+        query failed in cassandra are returned with a query error element 
+        in their row rather than failing the whole request.
+
+        A path with no data is only found to have no keys at all once 
+        it has been queried. By then a streamed response has already 
+        been sent with a 201 so instead of the usual 400 that error is 
+        also returned in the path's row.
+        """
+        viewset = TimeseriesRequestViewset()
+
+        def query(obj):
+            obj = viewset._execute_timeseries_query(obj)
+            return viewset._format_payload(obj)
+
+        for obj, result, exc_info in bulk_query_pool.map(query, queries,
+                concurrency=BULK_QUERY_CONCURRENCY,
+                deadline=BULK_QUERY_DEADLINE):
+            path = obj.datapath + [obj.agg]
+
+            if exc_info is not None:
+                e = exc_info[1]
+                if (isinstance(e, QueryErrorException) and not stream) or \
+                        not isinstance(e, (QueryErrorException,
+                            DeadlineExceeded, MaximumRetryException)):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield {'data': [], 'path': path, 'query error': '{0}'.format(str(e))}
+            elif stream:
+                yield JSONStream({'path': path}, 'data', result.data)
+            else:
+                yield {'data': result.data, 'path': path}
+
 """
 **/v2/outlet/**
 
@@ -1574,7 +2067,7 @@ class OutletSerializer(BaseMixin, serializers.ModelSerializer):
         self._add_pdu_uri(ret)
         return ret
 
-class OutletViewset(BaseMixin, viewsets.ReadOnlyModelViewSet):
+class OutletViewset(StreamingListMixin, BaseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = OutletSerializer
     lookup_field = 'outletID'
     filter_class = OutletFilter
@@ -9,7 +9,8 @@ import warnings
 
 import requests
 
-from ..util import add_apikey_header
+from ..util import (add_apikey_header, unpack_data, PACKED_FORMAT,
+                    PACKED_CONTENT_TYPE)
 
 # URI prefix segment - to change during development
 PS_ROOT = 'perfsonar'
@@ -17,6 +18,18 @@ PS_ROOT = 'perfsonar'
 MAX_DATETIME = datetime.datetime.max - datetime.timedelta(2)
 MAX_EPOCH = calendar.timegm(MAX_DATETIME.utctimetuple())
 
+
+def decode_data(r):
+    """Decode the body of a response from the api, either JSON or the
+    packed encoding of timeseries data.  Returns None for any other
+    content type."""
+    content_type = r.headers.get('content-type')
+    if content_type == 'application/json':
+        return json.loads(r.text)
+    elif content_type == PACKED_CONTENT_TYPE:
+        return unpack_data(r.content)
+    return None
+
 # Custom warnings and exceptions.
 
 
@@ -151,6 +164,8 @@ class NodeInfo(object):
 
         q_params = copy.copy(self.filters.time_filters)
         q_params['limit'] = LIMIT
+        if self.filters.packed:
+            q_params['format'] = PACKED_FORMAT
 
         data_payload = []
 
@@ -163,10 +178,9 @@ class NodeInfo(object):
 
             self.inspect_request(r)
 
-            if r.status_code == 200 and \
-                    r.headers['content-type'] == 'application/json':
-                data = json.loads(r.text)
+            data = decode_data(r) if r.status_code == 200 else None
 
+            if data is not None:
                 data_payload += data
 
                 if self.filters.verbose:
@@ -526,6 +540,9 @@ class ApiFilters(object):
         self._metadata_filters = {}
         self._time_filters = {}
 
+        # Request timeseries data in the packed format rather than JSON.
+        self.packed = False
+
         # Other stuff
         self.auth_username = ''
         self.auth_apikey = ''
@@ -42,6 +42,11 @@ returned from the api follow the general pattern where information in
 a given object are accessed by properties, and when acutal 'work' is
 being done (hitting the api), that is done by a method prefixed with
 get_ (ex: get_interfaces()).
+
+Setting filters.packed = True asks the api for the compact packed encoding
+of the data responses (see esmond.api.client.util) instead of JSON, which
+is a lot faster to decode for large requests.  The objects returned are
+the same either way.
 """
 
 import calendar
@@ -52,7 +57,8 @@ import time
 
 import requests
 
-from .util import add_apikey_header, AlertMixin
+from .util import (add_apikey_header, AlertMixin, unpack_data,
+                   PACKED_FORMAT, PACKED_CONTENT_TYPE)
 
 # all the properties don't need docstrings, etc.
 # seed some recursive args with empty lists and enacapsulation
@@ -63,6 +69,17 @@ MAX_DATETIME = datetime.datetime.max - datetime.timedelta(2)
 MAX_EPOCH = calendar.timegm(MAX_DATETIME.utctimetuple())
 
 
+def decode_data(r):
+    """Decode the body of a data response from the api, either JSON or
+    the packed encoding.  Returns None for any other content type."""
+    content_type = r.headers.get('content-type')
+    if content_type == 'application/json':
+        return json.loads(r.text)
+    elif content_type == PACKED_CONTENT_TYPE:
+        return unpack_data(r.content)
+    return None
+
+
 class NodeInfoWarning(Warning):
     pass
 
@@ -511,15 +528,18 @@ class Endpoint(NodeInfo):
         empty object.
         """
 
+        if self.filters.packed:
+            filters = dict(filters, format=PACKED_FORMAT)
+
         r = requests.get('{0}{1}'.format(self.api_url, self.uri),
                          params=self.filters.compose_filters(filters),
                          headers=self.request_headers)
 
         self.inspect_request(r)
 
-        if r.status_code == 200 and \
-                r.headers['content-type'] == 'application/json':
-            data = json.loads(r.text)
+        data = decode_data(r) if r.status_code == 200 else None
+
+        if data is not None:
             return DataPayload(data)
         else:
             self.http_alert(r)
@@ -647,6 +667,8 @@ class ApiFilters(AlertMixin, object):  # pylint: disable=too-many-instance-attri
         self.verbose = False
         self.cf = 'average'  # pylint: disable=invalid-name
         self.agg = None
+        # Request data in the packed format rather than JSON.
+        self.packed = False
         # This needs to be checked via property.
         self._endpoint = ['in']
 
@@ -859,15 +881,21 @@ class ApiConnect(AlertMixin, object):
 
         self.request_headers['content-type'] = 'application/json'
 
+        params = {}
+        if self.filters.packed:
+            params['format'] = PACKED_FORMAT
+
         r = requests.post('{0}/{1}/bulk/interface/'.format(self.api_url, API_VERSION_PREFIX),
-                          headers=self.request_headers, data=json.dumps(payload))
+                          headers=self.request_headers, params=params,
+                          data=json.dumps(payload))
 
         self.inspect_request(r)
         self.inspect_payload(payload)
 
-        if r.status_code == 201 and \
-                r.headers['content-type'] == 'application/json':
-            return BulkDataPayload(json.loads(r.text))
+        data = decode_data(r) if r.status_code == 201 else None
+
+        if data is not None:
+            return BulkDataPayload(data)
         else:
             self.http_alert(r)
             return BulkDataPayload()
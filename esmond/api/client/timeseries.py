@@ -77,8 +77,8 @@ import json
 
 import requests
 
-from .snmp import DataPayload, API_VERSION_PREFIX
-from .util import add_apikey_header, atencode, AlertMixin
+from .snmp import DataPayload, API_VERSION_PREFIX, decode_data
+from .util import add_apikey_header, atencode, AlertMixin, PACKED_FORMAT
 
 # The class constructors in these classes upset pylint
 # pylint: disable=dangerous-default-value, too-many-arguments
@@ -308,13 +308,16 @@ class GetData(TimeseriesBase):
     wrn = GetWarning
 
     def __init__(self, api_url='http://localhost/', path=[], freq=None,
-                 username='', api_key='', params={}):
+                 username='', api_key='', params={}, packed=False):
         """Constructor - the path list arg is an ordered list of elements
         that will be used (along with the freq arg) to construct the
-        cassandra row key.  See example above."""
+        cassandra row key.  See example above.  If packed is True the
+        data is requested in the packed format rather than JSON."""
         super(GetData, self).__init__(api_url, path, freq, username, api_key)
 
         self._params = params
+        if packed:
+            self._params = dict(params, format=PACKED_FORMAT)
 
         # Make sure we're not using an intermediate base class.
         try:
@@ -329,9 +332,8 @@ class GetData(TimeseriesBase):
     def get_data(self):
         """Get the data payloas for initialized object - make the GET request."""
         r = requests.get(self.url, params=self._params, headers=self.headers)
-        if r.status_code == 200 and \
-                r.headers['content-type'] == 'application/json':
-            data = json.loads(r.content)
+        data = decode_data(r) if r.status_code == 200 else None
+        if data is not None:
             return TimeSeriesDataPayload(data)
         else:
             self.set_error_state(r.status_code, r.content)
@@ -383,11 +385,13 @@ class GetBulkData(AlertMixin, object):
     wrn = GetBulkWarning
     _schema_root = '{0}/bulk/timeseries'.format(API_VERSION_PREFIX)
 
-    def __init__(self, api_url='http://localhost', username='', api_key=''):
+    def __init__(self, api_url='http://localhost', username='', api_key='',
+                 packed=False):
         super(GetBulkData, self).__init__()
         self.api_url = api_url.rstrip("/")
         self.username = username
         self.api_key = api_key
+        self.params = {'format': PACKED_FORMAT} if packed else {}
 
         # Make sure we're not using the base class
         try:
@@ -422,11 +426,11 @@ class GetBulkData(AlertMixin, object):
         if end:
             payload['end'] = end
 
-        r = requests.post(self.url, data=json.dumps(payload), headers=self.headers)
+        r = requests.post(self.url, data=json.dumps(payload), headers=self.headers,
+                          params=self.params)
 
-        if r.status_code == 201 and \
-                r.headers['content-type'] == 'application/json':
-            data = json.loads(r.content)
+        data = decode_data(r) if r.status_code == 201 else None
+        if data is not None:
             return TimeSeriesBulkDataPayload(data)
         else:
             self.warn('GET error: status_code: {0}, message: {1}'.format(r.status_code, r.content))
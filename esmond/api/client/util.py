@@ -1,7 +1,9 @@
 """Utils for esmond.api.client modules and scripts."""
 
 import calendar
+import json
 import os.path
+import struct
 import sys
 import warnings
 
@@ -241,3 +243,226 @@ def atdecode(s):
             r.append(part)
 
     return ''.join(r)
+
+
+# -- compact "packed" encoding of timeseries data
+#
+# Requested from the data endpoints with format=packed.  The payload is the
+# same structure the JSON response would have, but every list of data point
+# dicts (a "series", eg: [{'ts': ..., 'val': ...}, ...]) is sent as columns
+# of packed little-endian values instead.  Objects with a columns() method
+# returning the timestamps and values (esmond.api.dataseries.FilledSeries)
+# are packed as a ts/val series straight from those lists:
+#
+#   header      4s magic 'ESPK', B version, I envelope length
+#   envelope    JSON with each series replaced by {"__series__": index}
+#   I           number of series, then for each series:
+#     I B       number of rows, number of columns, then for each column:
+#       B, name   length of the column name and the name (utf-8)
+#       c         column type:
+#                   'q' - rows * int64
+#                   'Q' - rows * uint64, for counters of 2**63 and up
+#                   'd' - rows * float64
+#                   'j' - I length and a JSON list for anything else
+#                         (ie: perfSONAR histograms)
+#       B         flags, for the q, Q and d types only:
+#                   1 - the values are preceded by a null bitmap of
+#                       (rows + 7) / 8 bytes, bit i % 8 of byte i / 8 is
+#                       set if the value of row i is None (and sent as 0)
+#
+# Version 1 payloads have no flags and send None as NaN in 'd' columns.
+
+PACKED_FORMAT = 'packed'
+PACKED_CONTENT_TYPE = 'application/x-esmond-packed'
+
+_PACKED_MAGIC = 'ESPK'
+_PACKED_VERSION = 2
+_PACKED_HEADER = '<4sBI'
+_SERIES_KEY = '__series__'
+
+_INT_TYPES = (int, long)
+_NUMBER_TYPES = (int, long, float)
+_NULLS = 1
+
+
+def _is_series(obj):
+    """A non-empty list (or tuple) of dicts that have the same keys,
+    including ts."""
+    if not isinstance(obj, (list, tuple)) or not obj:
+        return False
+
+    first = obj[0]
+    if not isinstance(first, dict) or 'ts' not in first:
+        return False
+
+    keys = first.viewkeys()
+    for row in obj:
+        if not isinstance(row, dict) or row.viewkeys() != keys:
+            return False
+
+    return True
+
+
+def _column_type(vals):
+    """The packed type of a column, ignoring the Nones.  Integers are
+    never sent as doubles unless they are mixed with floats and all fit
+    in the 53 bits of a double exactly, so counters come back unchanged."""
+    types = set(type(v) for v in vals if v is not None)
+
+    if types <= set(_INT_TYPES):
+        present = [v for v in vals if v is not None]
+        if all(-2**63 <= v < 2**63 for v in present):
+            return 'q'
+        if all(0 <= v < 2**64 for v in present):
+            return 'Q'
+    elif types <= set(_NUMBER_TYPES):
+        if all(type(v) is float or -2**53 <= v <= 2**53
+               for v in vals if v is not None):
+            return 'd'
+
+    return 'j'
+
+
+def _pack_column(vals, json_cls=None):
+    """Return the type, flags and payload of a column."""
+    n = len(vals)
+    code = _column_type(vals)
+
+    if code == 'j':
+        s = json.dumps(vals, cls=json_cls, separators=(',', ':'))
+        return code, None, struct.pack('<I', len(s)) + s
+
+    flags = 0
+    chunks = []
+    if None in vals:
+        flags |= _NULLS
+        bitmap = bytearray((n + 7) // 8)
+        for i, v in enumerate(vals):
+            if v is None:
+                bitmap[i // 8] |= 1 << (i % 8)
+        chunks.append(str(bitmap))
+        vals = [0 if v is None else v for v in vals]
+
+    chunks.append(struct.pack('<%d%s' % (n, code), *vals))
+    return code, flags, ''.join(chunks)
+
+
+def _unpack_nulls(content, offset, nrows):
+    """Return the rows marked as None by a null bitmap."""
+    bitmap = bytearray(content[offset:offset + (nrows + 7) // 8])
+    return set(i for i in xrange(nrows) if bitmap[i // 8] & (1 << (i % 8)))
+
+
+def pack_data(data, json_cls=None):
+    """Encode a data response in the packed format described above.
+    json_cls is the JSONEncoder used for the envelope and any JSON
+    columns."""
+    series = []
+
+    def walk(obj):
+        if hasattr(obj, 'columns'):
+            ts, vals = obj.columns()
+            series.append((len(vals), [('ts', ts), ('val', vals)]))
+            return {_SERIES_KEY: len(series) - 1}
+        elif _is_series(obj):
+            names = list(obj[0].keys())
+            series.append((len(obj),
+                [(name, [row[name] for row in obj]) for name in names]))
+            return {_SERIES_KEY: len(series) - 1}
+        elif isinstance(obj, dict):
+            return dict((k, walk(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [walk(v) for v in obj]
+        return obj
+
+    envelope = json.dumps(walk(data), cls=json_cls, separators=(',', ':'))
+
+    chunks = [struct.pack(_PACKED_HEADER, _PACKED_MAGIC, _PACKED_VERSION,
+                          len(envelope)),
+              envelope,
+              struct.pack('<I', len(series))]
+
+    for nrows, cols in series:
+        chunks.append(struct.pack('<IB', nrows, len(cols)))
+        for name, vals in cols:
+            code, flags, payload = _pack_column(vals, json_cls)
+            name = name.encode('utf-8')
+            chunks.append(struct.pack('<B', len(name)) + name + code)
+            if flags is not None:
+                chunks.append(struct.pack('<B', flags))
+            chunks.append(payload)
+
+    return ''.join(chunks)
+
+
+def unpack_data(content, columns=False):
+    """Decode a packed data response.  Returns the same thing json.loads()
+    would have for the JSON response or, if columns is True, with each
+    series as a dict of column name -> list of values."""
+    magic, version, length = struct.unpack_from(_PACKED_HEADER, content, 0)
+    if magic != _PACKED_MAGIC:
+        raise ValueError('Not a packed esmond payload.')
+    if version not in (1, _PACKED_VERSION):
+        raise ValueError('Unsupported packed payload version {0}.'.format(version))
+
+    offset = struct.calcsize(_PACKED_HEADER)
+    envelope = json.loads(content[offset:offset + length])
+    offset += length
+
+    nseries, = struct.unpack_from('<I', content, offset)
+    offset += 4
+
+    series = []
+    for _ in xrange(nseries):
+        nrows, ncols = struct.unpack_from('<IB', content, offset)
+        offset += 5
+
+        cols = []
+        for _ in xrange(ncols):
+            length, = struct.unpack_from('<B', content, offset)
+            name = content[offset + 1:offset + 1 + length].decode('utf-8')
+            code = content[offset + 1 + length]
+            offset += 2 + length
+
+            nulls = ()
+            if code in ('q', 'Q', 'd') and version > 1:
+                flags, = struct.unpack_from('<B', content, offset)
+                offset += 1
+                if flags & _NULLS:
+                    nulls = _unpack_nulls(content, offset, nrows)
+                    offset += (nrows + 7) // 8
+
+            if code in ('q', 'Q', 'd'):
+                vals = list(struct.unpack_from('<%d%s' % (nrows, code),
+                                               content, offset))
+                offset += 8 * nrows
+                if version == 1 and code == 'd':
+                    vals = [None if v != v else v for v in vals]
+                for i in nulls:
+                    vals[i] = None
+            elif code == 'j':
+                length, = struct.unpack_from('<I', content, offset)
+                vals = json.loads(content[offset + 4:offset + 4 + length])
+                offset += 4 + length
+            else:
+                raise ValueError('Unknown packed column type {0!r}.'.format(code))
+
+            cols.append((name, vals))
+
+        if columns:
+            series.append(dict(cols))
+        else:
+            names = [name for name, _ in cols]
+            series.append([dict(zip(names, row))
+                           for row in zip(*[vals for _, vals in cols])])
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and _SERIES_KEY in obj:
+                return series[obj[_SERIES_KEY]]
+            return dict((k, walk(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [walk(v) for v in obj]
+        return obj
+
+    return walk(envelope)
@@ -0,0 +1,116 @@
+"""
+Conditional GET (ETag/Last-Modified) support for the REST api.
+
+The validators for a response are worked out from cheap state: an
+aggregate over the rows a listing returns, Device.generation,
+PSEventTypes.time_updated or, for a time range that is completely in the
+past, nothing but the request itself.  A request with a matching
+If-None-Match (or If-Modified-Since, for a response without an ETag)
+header is answered with a 304 before the response is generated, and in
+particular before Cassandra is queried.
+"""
+
+import calendar
+import datetime
+import hashlib
+import time
+
+from django.utils.http import (http_date, parse_http_date_safe, parse_etags,
+        quote_etag)
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from esmond.api import CACHE_MAX_AGE, CLOSED_RANGE_DELAY
+
+def make_etag(request, *state):
+    """
+    Build an ETag for the response to request.  state is anything
+    (that repr()s consistently) that changes whenever the response would.
+    The full path and the user are included since they select the data
+    and what of it the user is allowed to see.
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    h = hashlib.sha1(repr((
+        request.get_full_path(),
+        renderer.format if renderer else None,
+        request.user.pk,
+        state
+    )))
+    return quote_etag(h.hexdigest())
+
+def range_is_closed(end_time):
+    """
+    True if all of the data up to end_time (seconds) should have been
+    written by now, ie: the data for the range will not change.
+    """
+    return end_time is not None and \
+        end_time + CLOSED_RANGE_DELAY < time.time()
+
+def closed_range_last_modified(end_time):
+    """The time the data for a range ending at end_time stopped changing."""
+    return end_time + CLOSED_RANGE_DELAY
+
+def to_timestamp(dt):
+    if dt is None or not isinstance(dt, datetime.datetime):
+        return None
+    return calendar.timegm(dt.utctimetuple())
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Check the If-None-Match and If-Modified-Since request headers.  If the
+    response has an ETag only If-None-Match is used: If-Modified-Since
+    has a resolution of one second, so it can miss data written in the
+    same second as the client's copy.
+    """
+    if etag:
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    if if_modified_since and last_modified is not None:
+        return int(last_modified) <= if_modified_since
+
+    return False
+
+def add_validators(response, etag=None, last_modified=None, immutable=False):
+    """
+    Set the ETag, Last-Modified and Cache-Control headers on response.
+    Immutable responses may be kept by caches for CACHE_MAX_AGE seconds
+    if that is configured, otherwise (by default) they are public but
+    still revalidated since old ranges can be backfilled (see
+    espersistd --replay).  Everything else has to be revalidated.
+    """
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    if etag or last_modified is not None:
+        if immutable and CACHE_MAX_AGE:
+            response['Cache-Control'] = 'public, max-age={0}'.format(CACHE_MAX_AGE)
+        elif immutable:
+            response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+        else:
+            response['Cache-Control'] = 'no-cache'
+        response['Vary'] = 'Accept, Authorization'
+
+    return response
+
+def not_modified_response(request, etag=None, last_modified=None,
+        immutable=False):
+    """
+    Return a 304 response if the client's copy is still current,
+    otherwise None.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if not is_not_modified(request, etag, last_modified):
+        return None
+
+    return add_validators(Response(status=status.HTTP_304_NOT_MODIFIED),
+            etag, last_modified, immutable)
@@ -4,8 +4,6 @@ and gaps in a series of data.
 """
 import datetime
 
-from collections import OrderedDict
-
 from esmond.util import atdecode, atencode
 
 class TimerangeException(Exception):
@@ -164,46 +162,78 @@ class Fill(object):
         
         return start_bin, end_bin, expected_bins
 
+    @staticmethod
+    def fill_values(start_bin, end_bin, freq, data):
+        """Return a list with a value for every bin from start_bin to
+        end_bin, None where data has no value for the bin.
+
+        The bin of each datapoint is found with integer arithmetic rather
+        than by looking its timestamp up.  Datapoints which don't fall on
+        a bin in the range are ignored."""
+        n = Fill.expected_bin_count(start_bin, end_bin, freq)
+        vals = [None] * n
+
+        for dp in data:
+            offset = dp['ts'] - start_bin
+            i = offset // freq
+            if 0 <= i < n and i * freq == offset:
+                vals[i] = dp['val']
+
+        return vals
+
     @staticmethod
     def generate_filled_series(start_bin, end_bin, freq, data):
         """Genrate a new 'filled' series if the returned series has unexpected
-        gaps.  Initialize a new range based in the requested time range as
-        an OrderedDict, then iterate through original series to retain original
-        values.
+        gaps.  Yields a dict with ts and val for every bin in the requested
+        time range, the val is None for the missing bins.
         """
-        # Generate the empty "proper" timerange
-        filled_range = []
-        s = start_bin + 0 # copy it
-        while s <= end_bin:
-            filled_range.append((s,dict(ts=s, val=None)))
-            s += freq
-        
-        # Make it a ordered dict
-        fill = OrderedDict(filled_range)
-        
-        # Go through the original data and plug in 
-        # good values
-        for dp in data:
-            fill[dp['ts']]['val'] = dp['val']
-
-        for i in fill.values():
-            yield i
+        return iter(FilledSeries(start_bin, freq,
+            Fill.fill_values(start_bin, end_bin, freq, data)))
 
     @staticmethod
     def verify_fill(begin, end, freq, data):
         """Top-level function to inspect a returned series for gaps.
         Returns the original series of the count is correct, else will
-        return a new filled series."""
+        return a new FilledSeries."""
         begin, end, freq = int(begin), int(end), int(freq)
         start_bin,end_bin,expected_bins = Fill.get_bin_alignment(begin, end, freq)
-        #print 'got :', len(data)
-        #print 'need:', Fill.expected_bin_count(start_bin,end_bin,freq)
-        if len(data) == Fill.expected_bin_count(start_bin,end_bin,freq):
-            #print 'verify: not filling'
+        if len(data) == expected_bins:
             return data
         else:
-            #print 'verify: filling'
-            return list(Fill.generate_filled_series(start_bin,end_bin,freq,data))
+            return FilledSeries(start_bin, freq,
+                    Fill.fill_values(start_bin, end_bin, freq, data))
+
+
+class FilledSeries(object):
+    """A series of evenly spaced bins which has been filled by Fill.
+
+    The values are kept in a list indexed by bin number and the dicts
+    with ts and val keys that the rest of the api deals in are only built
+    as the series is iterated over.  Serializers which can use the values
+    directly should use columns() instead."""
+
+    def __init__(self, start_bin, freq, vals):
+        self.start_bin = start_bin
+        self.freq = freq
+        self.vals = vals
+
+    def __len__(self):
+        return len(self.vals)
+
+    def __iter__(self):
+        ts = self.start_bin
+        for val in self.vals:
+            yield dict(ts=ts, val=val)
+            ts += self.freq
+
+    def timestamps(self):
+        return range(self.start_bin, self.start_bin + len(self.vals) * self.freq,
+                self.freq)
+
+    def columns(self):
+        """Return the series as a list of timestamps and a list of
+        values."""
+        return self.timestamps(), self.vals
 
 
 def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
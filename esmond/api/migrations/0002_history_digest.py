@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alusapref',
+            name='digest',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='ifref',
+            name='digest',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='lspopstatus',
+            name='digest',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outletref',
+            name='digest',
+            field=models.CharField(max_length=40, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_history_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigGeneration',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('generation', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'configgeneration',
+            },
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='generation',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
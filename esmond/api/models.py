@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.timezone import now
 import datetime
 
@@ -55,6 +58,9 @@ class Device(models.Model):
     active = models.BooleanField(default = True)
     devicetag = models.ManyToManyField(DeviceTag, through = "DeviceTagMap")
     oidsets = models.ManyToManyField("OIDSet", through = "DeviceOIDSetMap")
+    # the ConfigGeneration at which the polling config for this device last
+    # changed, maintained by the signal handlers below
+    generation = models.BigIntegerField(default=0)
 
     objects = DeviceManager()
 
@@ -210,6 +216,63 @@ class DeviceOIDSetMap(models.Model):
         db_table = "deviceoidsetmap"
         ordering = ["device", "oid_set"]
 
+class ConfigGeneration(models.Model):
+    """A counter which is incremented whenever the polling configuration
+    changes.
+
+    espolld checks this instead of reloading all of the devices and oidsets
+    to find out if anything changed.  The devices affected by a change have
+    their generation set to the new value.  There is only ever one row."""
+
+    generation = models.BigIntegerField(default=0)
+
+    class Meta:
+        app_label = 'api'
+        db_table = "configgeneration"
+
+    @classmethod
+    def current(cls):
+        try:
+            return cls.objects.get(pk=1).generation
+        except cls.DoesNotExist:
+            return 0
+
+    @classmethod
+    def bump(cls):
+        """Increment the generation and return the new value."""
+        if not cls.objects.filter(pk=1).update(
+                generation=F('generation') + 1):
+            cls.objects.get_or_create(pk=1, defaults=dict(generation=0))
+            cls.objects.filter(pk=1).update(generation=F('generation') + 1)
+
+        return cls.current()
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def _device_changed(sender, instance, **kwargs):
+    g = ConfigGeneration.bump()
+    # update() rather than save() so we don't end up back here
+    Device.objects.filter(pk=instance.pk).update(generation=g)
+
+@receiver(post_save, sender=OIDSet)
+@receiver(post_delete, sender=OIDSet)
+def _oidset_changed(sender, instance, **kwargs):
+    g = ConfigGeneration.bump()
+    Device.objects.filter(oidsets__pk=instance.pk).update(generation=g)
+
+@receiver(post_save, sender=OIDSetMember)
+@receiver(post_delete, sender=OIDSetMember)
+def _oidsetmember_changed(sender, instance, **kwargs):
+    g = ConfigGeneration.bump()
+    Device.objects.filter(oidsets__pk=instance.oid_set_id).update(
+            generation=g)
+
+@receiver(post_save, sender=DeviceOIDSetMap)
+@receiver(post_delete, sender=DeviceOIDSetMap)
+def _deviceoidsetmap_changed(sender, instance, **kwargs):
+    g = ConfigGeneration.bump()
+    Device.objects.filter(pk=instance.device_id).update(generation=g)
+
 class IfRefManager(models.Manager):
     def active(self):
         qs = super(IfRefManager, self).get_queryset()
@@ -245,6 +308,9 @@ class IfRef(models.Model):
     end_time = models.DateTimeField(default=max_datetime)
     ifPhysAddress = models.CharField(max_length=32, db_column="ifphysaddress",
             blank=True, null=True)
+    # digest of the polled state of all of the device's active rows,
+    # see HistoryTablePersister
+    digest = models.CharField(max_length=40, blank=True, null=True)
 
     objects = IfRefManager()
 
@@ -307,6 +373,7 @@ class ALUSAPRef(models.Model):
 
     begin_time = models.DateTimeField()
     end_time = models.DateTimeField(default=max_datetime)
+    digest = models.CharField(max_length=40, blank=True, null=True)
 
     objects = ALUSAPRefManager()
 
@@ -342,6 +409,7 @@ class OutletRef(models.Model):
 
     begin_time = models.DateTimeField()
     end_time = models.DateTimeField(default=max_datetime)
+    digest = models.CharField(max_length=40, blank=True, null=True)
     
     objects = HistoryTableManager()
 
@@ -370,6 +438,9 @@ class LSPOpStatus(models.Model):
 
     begin_time = models.DateTimeField()
     end_time = models.DateTimeField(default=max_datetime)
+    digest = models.CharField(max_length=40, blank=True, null=True)
+
+    objects = HistoryTableManager()
 
     class Meta:
         app_label = 'api'
@@ -17,7 +17,7 @@ import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 from django.db import connection, transaction
-from django.db.models import Q
+from django.db.models import Count, Max, Q
 from django.utils.text import slugify
 from django.utils.timezone import utc
 from django.db.utils import DatabaseError
@@ -31,6 +31,7 @@ from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.authentication import BaseAuthentication, TokenAuthentication
+from rest_framework.utils.urls import replace_query_param
 
 import rest_framework_filters as filters
 
@@ -38,10 +39,15 @@ from esmond.api.models import (PSMetadata, PSPointToPointSubject, PSEventTypes,
     PSMetadataParameters, PSNetworkElementSubject, UserIpAddress)
 
 from esmond.api.api_v2 import (DataObject, _get_ersatz_esmond_api_queryset,
-    DjangoModelPerm)
+    DjangoModelPerm, KeysetPaginationMixin)
 
 from esmond.api.perfsonar.types import *
 
+from esmond.api.streaming import StreamingJSONResponse, should_stream
+from esmond.api.renderers import DATA_RENDERER_CLASSES
+from esmond.api.conditional import (make_etag, not_modified_response,
+        add_validators, to_timestamp)
+
 from esmond.cassandra import KEY_DELIMITER, CASSANDRA_DB, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin, RawData, AggregationBin
 
 from esmond.config import get_config_path, get_config
@@ -272,7 +278,10 @@ class PSPaginator(pagination.LimitOffsetPagination):
     ## I actually kinda like the default pagination better
     ## but sticking with backward compatibility here
     def get_paginated_response(self, data):
-    
+        #return response with unmodified data and links in headers
+        return Response(data, headers=self.get_link_headers())
+
+    def get_link_headers(self):
         #create some pagination links in headers
         next_url = self.get_next_link()
         previous_url = self.get_previous_link()
@@ -285,16 +294,50 @@ class PSPaginator(pagination.LimitOffsetPagination):
         else:
             link = ''
         link = link.format(next_url=next_url, previous_url=previous_url)
-        headers = {'Link': link} if link else {}
-        
-        #return response with unmodified data and links in headers
-        return Response(data, headers=headers)
+        return {'Link': link} if link else {}
 
-class PSMetadataPaginator(PSPaginator):
+class PSMetadataPaginator(KeysetPaginationMixin, PSPaginator):
     """
     Metadata API spec requires us to put pagination details in the first
     item returned so that is down here.
+
+    Also supports keyset pagination with after=<id> and skipping the 
+    count (a DISTINCT over the metadata joins) with count=false, see 
+    KeysetPaginationMixin.
     """
+    after_query_param = AFTER_FILTER
+    count_query_param = COUNT_FILTER
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.request = request
+        self.after = self.get_after(request)
+        self.offset = self.get_offset(request) if self.after is None else 0
+        self.count = self.get_total_count(request, queryset)
+
+        return self.paginate_page(queryset)
+
+    def get_next_link(self):
+        if self.after is not None:
+            return self.get_keyset_next_link()
+
+        if self.count is None:
+            if not self.has_next:
+                return None
+            url = self.request.build_absolute_uri()
+            return replace_query_param(url, self.offset_query_param,
+                self.offset + self.limit)
+
+        return super(PSMetadataPaginator, self).get_next_link()
+
+    def get_previous_link(self):
+        if self.after is not None:
+            return None
+
+        return super(PSMetadataPaginator, self).get_previous_link()
 
     def get_paginated_response(self, data):
         
@@ -403,12 +446,23 @@ class PSTimeSeriesObject(object):
                                                 summary_window=et[1]
                                                 )
                 self.database_write(ts_obj, local_cache)
+    
+    @staticmethod
+    def mark_updated(metadata_key, event_types):
+        """
+        Bump time_updated for the event types that were written to. This 
+        is the Last-Modified (and ETag) of their data, so it must only be 
+        called after db.flush() has sent the data to cassandra, and not 
+        inside a transaction so now() is the time of the update.
+        """
+        rawsql_cursor = connection.cursor()
+        for event_type in sorted(event_types):
             #make sqlite happy (mainly for unit tests not configured to use postgres)
             if connection.vendor.startswith('sqlite'):
-                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated='now' WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [self.event_type, self.metadata_key])
+                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated='now' WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [event_type, metadata_key])
             else:
                 #update time. clear out microseconds since timestamp filters are only seconds and we want to allow exact matches
-                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated=now() WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [self.event_type, self.metadata_key])
+                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated=now() WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [event_type, metadata_key])
     
     @staticmethod
     def row_prefix(event_type):
@@ -826,9 +880,24 @@ class ArchiveViewset(mixins.CreateModelMixin,
 
         GET /perfsonar/archive/
 
-        Probably won't need modification, just here for reference.
+        The ETag is worked out from the matching metadata and their event 
+        types so a client polling for new measurements gets a 304 until 
+        one is added or updated.
         """
-        return super(ArchiveViewset, self).list(request)
+        ids = self.filter_queryset(self.get_queryset()).values('id')
+        state = PSMetadata.objects.filter(id__in=ids).aggregate(
+            count=Count('id'), last_id=Max('id'))
+        state.update(PSEventTypes.objects.filter(metadata__in=ids).aggregate(
+            et_count=Count('id'), et_last_id=Max('id'),
+            time_updated=Max('time_updated')))
+        etag = make_etag(request, sorted(state.items()))
+
+        response = not_modified_response(request, etag=etag)
+        if response is not None:
+            return response
+
+        return add_validators(super(ArchiveViewset, self).list(request),
+            etag=etag)
 
     def retrieve(self, request, **kwargs):
         """Stub for detail GET 'metadata_key', will be one of 
@@ -880,6 +949,7 @@ class ArchiveViewset(mixins.CreateModelMixin,
         
         #validate 
         i = 0
+        event_types = set()
         for ts_item in request_data["data"]:
             i += 1
             if DATA_KEY_TIME not in ts_item:
@@ -900,9 +970,11 @@ class ArchiveViewset(mixins.CreateModelMixin,
                 obj = PSTimeSeriesObject(ts, val_item[DATA_KEY_VALUE], kwargs["metadata_key"])
                 obj.event_type =  val_item['event-type']
                 obj.save()
+                event_types.add(obj.event_type)
                 
         #everything succeeded so save to database
         db.flush()
+        PSTimeSeriesObject.mark_updated(kwargs["metadata_key"], event_types)
 
         return Response('', status.HTTP_201_CREATED)
 
@@ -1022,6 +1094,7 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
     queryset = _get_ersatz_esmond_api_queryset('timeseries')
     serializer_class = TimeSeriesSerializer # mollify viewset
     pagination_class = PSPaginator
+    renderer_classes = DATA_RENDERER_CLASSES
 
     def retrieve(self, request, **kwargs):
         """
@@ -1065,6 +1138,13 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
         time_result = self.handle_time_filters(request.query_params)
         begin_time = time_result['begin']
         end_time = time_result['end']
+
+        #answer conditional requests before going to cassandra
+        validators = self._validators(request, metadata_key, event_type,
+            summary_type, freq)
+        response = not_modified_response(request, **validators)
+        if response is not None:
+            return response
         
         #Handle pagination
         ##set high limit by default. This is a performance gain so pycassa doesn't have to count
@@ -1077,13 +1157,51 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
                 
         #send query
         results = PSTimeSeriesObject.query_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results)
+        #paginate result
+        results = self.paginator.paginate_queryset(results, self.request, view=self)
+
+        #stream large pages, serializing each item as it is written
+        if should_stream(request, len(results)):
+            serializer = self.serializer_class()
+            return add_validators(StreamingJSONResponse(
+                (serializer.to_representation(r) for r in results),
+                headers=self.paginator.get_link_headers()), **validators)
+
         #serialize result
         data = self.serializer_class(results, many=True).data
-        #paginate result
-        data = self.paginator.paginate_queryset(data, self.request, view=self)
         
         #return response with pagination headers set
-        return self.paginator.get_paginated_response(data)
+        return add_validators(self.paginator.get_paginated_response(data),
+            **validators)
+
+    def _validators(self, request, metadata_key, event_type, summary_type, freq):
+        """
+        Conditional GET validators for a timeseries request. Every write 
+        to an event type bumps its time_updated, so that is the last 
+        modified time of the data. A time-range on its own is relative 
+        to now, the data it selects changes without any writes so those 
+        requests get no validators.
+        """
+        params = request.query_params
+        if params.has_key(TIME_RANGE_FILTER) and not (
+                params.has_key(TIME_FILTER) or
+                params.has_key(TIME_START_FILTER) or
+                params.has_key(TIME_END_FILTER)):
+            return {}
+
+        filters = dict(metadata__metadata_key=metadata_key,
+            event_type=event_type, summary_type=summary_type)
+        if freq is not None:
+            filters['summary_window'] = freq
+        time_updated = PSEventTypes.objects.filter(**filters) \
+            .aggregate(time_updated=Max('time_updated'))['time_updated']
+        if time_updated is None:
+            return {}
+
+        return dict(
+            etag=make_etag(request, time_updated),
+            last_modified=to_timestamp(time_updated),
+        )
 
 
     def create(self, request, **kwargs):
@@ -1143,6 +1261,7 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
         #everything succeeded so save to database. 
         #do this here as opposed to in obj.save() for performance reasons.
         db.flush()
+        PSTimeSeriesObject.mark_updated(obj.metadata_key, [obj.event_type])
         
         return Response('', status.HTTP_201_CREATED)
 
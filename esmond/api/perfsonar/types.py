@@ -243,6 +243,9 @@ DATA_KEY_TIME = "ts"
 DATA_KEY_VALUE = "val"
 LIMIT_FILTER = "limit"
 OFFSET_FILTER = "offset"
-RESERVED_GET_PARAMS = ["format", LIMIT_FILTER, OFFSET_FILTER, DNS_MATCH_RULE_FILTER, TIME_FILTER,
+AFTER_FILTER = "after"
+COUNT_FILTER = "count"
+RESERVED_GET_PARAMS = ["format", LIMIT_FILTER, OFFSET_FILTER, AFTER_FILTER, COUNT_FILTER,
+                       DNS_MATCH_RULE_FILTER, TIME_FILTER,
                        TIME_START_FILTER, TIME_END_FILTER, TIME_RANGE_FILTER]
 
@@ -0,0 +1,135 @@
+"""
+A small thread pool to run backend queries concurrently.
+
+The pool is shared by all of the requests handled by a process so the
+number of concurrent queries, and with it the number of connections taken
+from the CASSANDRA_DB connection pool, is bounded no matter how many
+requests are being handled.  Each request can also cap how many of its own
+queries run at once and set a deadline for all of them.
+"""
+
+import os
+import sys
+import threading
+import time
+import Queue
+
+class DeadlineExceeded(Exception):
+    """Raised for a query that was not finished by the deadline."""
+    pass
+
+class QueryPool(object):
+    """
+    Run functions on a fixed number of worker threads.
+
+    The threads are started on first use (and again in a forked child)
+    so creating a pool at import time in a pre-forking server is safe.
+    """
+    def __init__(self, nthreads):
+        self.nthreads = max(1, nthreads)
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.jobs = Queue.Queue()
+            for i in range(self.nthreads):
+                t = threading.Thread(target=self._run,
+                        name='QueryPool-%d' % i, args=(self.jobs,))
+                t.daemon = True
+                t.start()
+            self.pid = os.getpid()
+
+    def _run(self, jobs):
+        while True:
+            fn, args, request, i = jobs.get()
+            # the request may have given up while this was queued
+            if request.cancelled or request.expired():
+                continue
+            try:
+                result = (i, fn(*args), None)
+            except Exception:
+                result = (i, None, sys.exc_info())
+            request.done.put(result)
+
+    def _drop(self, request):
+        """Take the jobs of request that haven't started off the queue."""
+        jobs = self.jobs
+        with jobs.mutex:
+            queued = [job for job in jobs.queue if job[2] is not request]
+            jobs.queue.clear()
+            jobs.queue.extend(queued)
+
+    def map(self, fn, items, concurrency=None, deadline=None):
+        """
+        Generate (item, result, exc_info) for fn(item) for each of items,
+        in order.  exc_info is None or the sys.exc_info() of the exception
+        fn raised, so it can be re-raised with its traceback.  At most
+        concurrency calls for this request are queued or running at once.
+        Once deadline seconds have passed the remaining items are not run
+        and, like the ones still running, are returned with a
+        DeadlineExceeded exception.
+        """
+        if self.pid != os.getpid():
+            self._start()
+
+        items = list(items)
+        concurrency = max(1, concurrency or len(items))
+        expires = time.time() + deadline if deadline else None
+        request = _Request(expires)
+
+        results = {}
+        submitted = 0
+        try:
+            for i in range(len(items)):
+                while submitted < len(items) and \
+                        submitted - i < concurrency and not request.cancelled:
+                    self.jobs.put((fn, (items[submitted],), request, submitted))
+                    submitted += 1
+
+                while i not in results and not request.cancelled:
+                    timeout = None
+                    if expires is not None:
+                        timeout = expires - time.time()
+                        if timeout <= 0:
+                            request.cancelled = True
+                            break
+                    try:
+                        j, result, exc = request.done.get(True, timeout)
+                    except Queue.Empty:
+                        continue
+                    results[j] = (result, exc)
+
+                # collect anything that finished before the deadline
+                while i not in results:
+                    try:
+                        j, result, exc = request.done.get_nowait()
+                    except Queue.Empty:
+                        break
+                    results[j] = (result, exc)
+
+                if i in results:
+                    result, exc = results.pop(i)
+                else:
+                    result, exc = None, (DeadlineExceeded, DeadlineExceeded(
+                            'deadline of {0}s exceeded'.format(deadline)), None)
+
+                yield items[i], result, exc
+        finally:
+            # don't run the rest if the caller gave up on the results
+            request.cancelled = True
+            self._drop(request)
+
+class _Request(object):
+    """Per request state shared with the workers."""
+    def __init__(self, expires=None):
+        self.done = Queue.Queue()
+        self.cancelled = False
+        self.expires = expires
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
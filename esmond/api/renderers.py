@@ -0,0 +1,31 @@
+"""
+Renderers for the data endpoints.
+
+The data endpoints can return the compact packed encoding of their
+payloads (see esmond.api.client.util) instead of JSON when they are asked
+for format=packed.  Timestamps and values are sent as packed columns, so
+neither the server nor the client has to encode or decode a JSON object
+per data point.
+"""
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+
+from esmond.api.client.util import (pack_data, PACKED_FORMAT,
+        PACKED_CONTENT_TYPE)
+
+class PackedRenderer(BaseRenderer):
+    media_type = PACKED_CONTENT_TYPE
+    format = PACKED_FORMAT
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+
+        return pack_data(data, json_cls=JSONRenderer.encoder_class)
+
+# Renderers for the viewsets that return timeseries data.
+DATA_RENDERER_CLASSES = list(api_settings.DEFAULT_RENDERER_CLASSES) + \
+    [PackedRenderer]
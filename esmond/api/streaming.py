@@ -0,0 +1,173 @@
+"""
+Stream large JSON payloads from the data endpoints.
+
+A DRF Response is serialized and then rendered to a single JSON string
+before the first byte goes out, so a long timeseries or a big bulk request
+holds several copies of every data point in the worker at once.  The
+classes here write the JSON envelope and then encode the data points a
+chunk at a time as they are pulled from the (possibly lazy) query results.
+The output is the same JSON the JSONRenderer would have produced.
+"""
+
+import json
+import uuid
+from itertools import izip
+
+from django.db.models.query import prefetch_related_objects
+from django.http import StreamingHttpResponse
+
+from rest_framework.renderers import JSONRenderer
+
+from esmond.api import STREAM_THRESHOLD
+
+# Number of list items encoded per chunk written to the client.
+CHUNK_SIZE = 1000
+
+_SCALAR_TYPES = (int, long, float)
+
+def dumps(data):
+    """Encode data the same way the JSONRenderer does."""
+    separators = (',', ':') if JSONRenderer.compact else None
+    ret = json.dumps(data, cls=JSONRenderer.encoder_class,
+            ensure_ascii=JSONRenderer.ensure_ascii, separators=separators)
+    if isinstance(ret, unicode):
+        ret = ret.replace(u'\u2028', u'\\u2028').replace(u'\u2029', u'\\u2029')
+    return ret
+
+def should_stream(request, npoints):
+    """
+    Return True if a response with (about) npoints data points should
+    be streamed.  npoints is None if the size of the response isn't known
+    (ie: it wasn't counted), those are streamed too.  Only JSON is
+    streamed, the browsable API and any other renderer get a normal
+    Response.
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    if renderer is None or renderer.format != 'json':
+        return False
+
+    return bool(STREAM_THRESHOLD) and \
+        (npoints is None or npoints > STREAM_THRESHOLD)
+
+def iter_queryset(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the objects of queryset without the queryset caching all
+    of them, applying its prefetch_related() lookups a chunk at a time.
+    """
+    lookups = queryset._prefetch_related_lookups
+
+    def prefetched(chunk):
+        if lookups:
+            prefetch_related_objects(chunk, lookups)
+        return chunk
+
+    chunk = []
+    for obj in queryset.iterator():
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            for obj in prefetched(chunk):
+                yield obj
+            chunk = []
+
+    for obj in prefetched(chunk):
+        yield obj
+
+class JSONStream(object):
+    """
+    A dict to be encoded with the items of a list streamed in as the
+    value of obj[key].  items can be any iterable, including a generator
+    and including one that yields further JSONStream objects.
+    """
+    def __init__(self, obj, key, items):
+        self.obj = obj
+        self.key = key
+        self.items = items
+
+    def __iter__(self):
+        marker = '__esmond_stream_{0}__'.format(uuid.uuid4().hex)
+        obj = self.obj.copy()
+        obj[self.key] = marker
+        head, tail = dumps(obj).split(dumps(marker), 1)
+
+        yield head
+        for s in iter_json_list(self.items):
+            yield s
+        yield tail
+
+def iter_json_series(series, chunk_size=CHUNK_SIZE):
+    """
+    Yield the JSON encoding of a FilledSeries a chunk at a time.  The data
+    points are formatted straight from the series' columns() rather than
+    building a dict for each one, unless the values aren't plain numbers.
+    """
+    ts, vals = series.columns()
+
+    yield '['
+
+    sep = ''
+    for i in xrange(0, len(vals), chunk_size):
+        ts_chunk = ts[i:i + chunk_size]
+        val_chunk = vals[i:i + chunk_size]
+        if JSONRenderer.compact and \
+                all(v is None or type(v) in _SCALAR_TYPES for v in val_chunk):
+            encoded = dumps(val_chunk)[1:-1].split(',')
+            yield sep + ','.join(['{"ts":%d,"val":%s}' % point
+                for point in izip(ts_chunk, encoded)])
+        else:
+            yield sep + dumps([dict(ts=t, val=v)
+                for t, v in izip(ts_chunk, val_chunk)])[1:-1]
+        sep = ','
+
+    yield ']'
+
+def iter_json_list(items, chunk_size=CHUNK_SIZE):
+    """Yield the JSON encoding of the iterable items a chunk at a time."""
+    if hasattr(items, 'columns'):
+        for s in iter_json_series(items, chunk_size):
+            yield s
+        return
+
+    yield '['
+
+    sep = ''
+    chunk = []
+    for item in items:
+        if isinstance(item, JSONStream):
+            if chunk:
+                yield sep + dumps(chunk)[1:-1]
+                sep = ','
+                chunk = []
+            yield sep
+            for s in item:
+                yield s
+            sep = ','
+            continue
+
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield sep + dumps(chunk)[1:-1]
+            sep = ','
+            chunk = []
+
+    if chunk:
+        yield sep + dumps(chunk)[1:-1]
+
+    yield ']'
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """
+    Streaming counterpart of the DRF Response for JSON data payloads.
+    data is either a JSONStream or an iterable that is encoded as a list.
+    """
+    def __init__(self, data, status=200, headers=None):
+        if isinstance(data, JSONStream):
+            content = iter(data)
+        else:
+            content = iter_json_list(data)
+
+        super(StreamingJSONResponse, self).__init__(content, status=status,
+                content_type='application/json')
+
+        if headers:
+            for name, value in headers.iteritems():
+                self[name] = value
@@ -2,6 +2,7 @@ import json
 import os
 import time
 
+import mock
 import pandokia.helpers.filecomp as filecomp
 
 # This MUST be here in any testing modules that use cassandra!
@@ -411,6 +412,27 @@ class PSArchiveResourceTest(PSAPIBaseTest):
         self.assertMetadataCount(5, url, {OFFSET_FILTER: 0, LIMIT_FILTER: 5})
         self.assertMetadataCount(5, url, {OFFSET_FILTER: 5, LIMIT_FILTER: 5})
         self.assertMetadataCount(6, url, {OFFSET_FILTER: 10, LIMIT_FILTER: 10})
+
+        #test keyset pagination, following the next page links
+        keys = []
+        next_url = '{0}?{1}=0&{2}=5'.format(url, AFTER_FILTER, LIMIT_FILTER)
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertHttpOK(response)
+            data = json.loads(response.content)
+            self.assertTrue(len(data) <= 5)
+            keys += [d['metadata-key'] for d in data]
+            next_url = data[0]['metadata-next-page'] if data else None
+        self.assertEquals(len(keys), 16)
+        self.assertEquals(len(set(keys)), 16)
+
+        #test skipping the count
+        response = self.client.get(url, {COUNT_FILTER: 'false', LIMIT_FILTER: 5})
+        self.assertHttpOK(response)
+        data = json.loads(response.content)
+        self.assertEquals(len(data), 5)
+        self.assertEquals(data[0]['metadata-count-total'], None)
+        self.assertTrue(data[0]['metadata-next-page'])
         
     def test_get_metadata_detail(self):
         url = '/{0}/archive/e99bbc44b7b041c7ad9e51dc6a053b8c/'.format(PS_ROOT)
@@ -795,6 +817,39 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         self.assertSinglePostSuccess(base_url, start+1000, {'test': 100})
         self.assertExpectedResponse([{u'ts': 1398902400, u'val': {}}], stat_url)
         
+    def test_time_updated_after_flush(self):
+        from esmond.api.perfsonar import api_v2
+
+        metadata_key = 'f6b732e9f351487a96126f0c25e5e546'
+        base_url = '/{0}/archive/{1}/throughput/base/'.format(PS_ROOT, metadata_key)
+        bulk_url = '/{0}/archive/{1}/'.format(PS_ROOT, metadata_key)
+        event_types = PSEventTypes.objects.filter(
+            metadata__metadata_key=metadata_key, event_type='throughput')
+
+        # time_updated is the Last-Modified of the data so it must not 
+        # change before the data is flushed to cassandra
+        flush = api_v2.db.flush
+        seen = []
+        def check_flush():
+            seen.append(list(event_types.values_list('time_updated', flat=True)))
+            flush()
+
+        requests = [
+            (self.get_api_client(admin_auth=True).post, base_url,
+                {'ts': 1398000000, 'val': self.int_data[0]}),
+            (self.get_api_client(admin_auth=True).put, bulk_url,
+                {'data': [{'ts': 1398007200, 'val': [{'event-type': 'throughput', 'val': self.int_data[1]}]}]}),
+        ]
+
+        with mock.patch.object(api_v2.db, 'flush', check_flush):
+            for method, url, data in requests:
+                event_types.update(time_updated=None)
+                response = method(url, format='json', data=data)
+                self.assertHttpCreated(response)
+                self.assertTrue(all([t is None for t in seen[-1]]))
+                self.assertTrue(all([t is not None for t in
+                    event_types.values_list('time_updated', flat=True)]))
+
     def test_authentication_failures(self):
         base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/throughput/base/'.format(PS_ROOT)
         self.assertAuthFailure(base_url, 1398965990, self.int_data[0], False)
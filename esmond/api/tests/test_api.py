@@ -3,6 +3,7 @@ import time
 import calendar
 import datetime
 import os
+import traceback
 
 import pprint
 
@@ -15,7 +16,7 @@ os.environ['ESMOND_UNIT_TESTS'] = 'True'
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
-from django.utils.timezone import make_aware, utc
+from django.utils.timezone import make_aware, now, utc
 
 from rest_framework.test import APIClient
 
@@ -186,6 +187,125 @@ class DeviceAPITests(DeviceAPITestsBase):
         self.assertEquals(len(data['children']), 1)
         self.assertEquals(data['children'][0]['ifName'], '3/1/1')
 
+    def test_interface_list_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def count_queries(url):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, dict(limit=0))
+                self.assertEquals(response.status_code, 200)
+            return len(queries), json.loads(response.content)
+
+        for url in ('/v2/interface/', '/v2/device/rtr_a/interface/'):
+            # warm up the endpoint map
+            count_queries(url)
+            n_before, before = count_queries(url)
+
+            for i in range(20):
+                IfRef.objects.create(
+                        device=self.td.rtr_a,
+                        begin_time=self.td.rtr_a.begin_time,
+                        ifIndex=100+i,
+                        ifName="ge-{0}/0/0{1}".format(i, len(url)),
+                        ifAlias="test interface",
+                        ipAddr="10.0.0.1",
+                        ifSpeed=0,
+                        ifHighSpeed=1000,
+                        ifMtu=9000,
+                        ifOperStatus=1,
+                        ifAdminStatus=1,
+                        ifPhysAddress="00:00:00:00:00:00")
+
+            n_after, after = count_queries(url)
+
+            self.assertEquals(len(after['children']),
+                    len(before['children']) + 20)
+            self.assertEquals(n_after, n_before)
+
+            for child in after['children']:
+                if child['device'] != 'rtr_a':
+                    continue
+                names = [c['name'] for c in child['children']]
+                self.assertIn('in', names)
+                self.assertIn('out', names)
+                for c in child['children']:
+                    self.assertEquals(c['uri'],
+                            child['uri'].rstrip('/') + '/' + c['name'])
+
+    def test_interface_list_keyset(self):
+        url = '/v2/interface/'
+
+        response = self.client.get(url, dict(limit=0))
+        self.assertEquals(response.status_code, 200)
+        expected = sorted(c['id'] for c in json.loads(response.content)['children'])
+
+        ids = []
+        next_url = url + '?after=0&limit=2'
+        while next_url:
+            response = self.client.get(next_url)
+            self.assertEquals(response.status_code, 200)
+            data = json.loads(response.content)
+            self.assertTrue(len(data['children']) <= 2)
+            self.assertEquals(data['meta']['previous'], None)
+            ids += [c['id'] for c in data['children']]
+            next_url = data['meta']['next']
+
+        self.assertEquals(ids, expected)
+
+        response = self.client.get(url, dict(limit=2, count='false'))
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEquals(data['meta']['total_count'], None)
+        self.assertEquals(len(data['children']), 2)
+
+    def test_interface_list_streamed(self):
+        url = '/v2/interface/'
+
+        response = self.client.get(url, dict(limit=0))
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        expected = json.loads(response.content)
+
+        with mock.patch('esmond.api.streaming.STREAM_THRESHOLD', 1):
+            response = self.client.get(url, dict(limit=0))
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            data = json.loads(''.join(response.streaming_content))
+
+        self.assertEquals(data, expected)
+
+    def test_interface_list_conditional(self):
+        url = '/v2/device/rtr_a/interface/'
+
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEquals(response['Cache-Control'], 'no-cache')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response['ETag'], etag)
+
+        # a different query is a different resource
+        response = self.client.get(url, dict(limit=1), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+
+        # closing an interface changes the listing
+        ifref = IfRef.objects.filter(device=self.td.rtr_a)[0]
+        ifref.end_time = now()
+        ifref.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+        response = self.client.get('/v2/device/')
+        self.assertEquals(response.status_code, 200)
+        response = self.client.get('/v2/device/',
+                HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
     def test_get_device_interface_detail(self):
         for device, iface in (
                 ('rtr_a', 'xe-0/0/0'),
@@ -341,6 +461,10 @@ class MockCASSANDRA_DB(object):
             {'is_valid': 0, 'ts': s_bin+(freq*3), 'val': 80}
         ]
 
+    def query_baserate_timerange_multi(self, paths=None, freq=None, ts_min=None, ts_max=None):
+        self.multi_queries = getattr(self, 'multi_queries', 0) + 1
+        return [self.query_baserate_timerange(p, freq, ts_min, ts_max) for p in paths]
+
     def query_raw_data(self, path=None, freq=None, ts_min=None, ts_max=None):
         if 'SentryPoll' in path:
             s_bin = (ts_min/freq)*freq
@@ -376,6 +500,10 @@ class MockCASSANDRA_DB(object):
         else:
             pass
 
+    def query_aggregation_timerange_multi(self, paths=None, freq=None, ts_min=None, ts_max=None, cf=None):
+        self.multi_queries = getattr(self, 'multi_queries', 0) + 1
+        return [self.query_aggregation_timerange(p, freq, ts_min, ts_max, cf) for p in paths]
+
     def _test_incoming_args(self, path, freq, ts_min, ts_max, cf=None):
         assert isinstance(path, list)
         assert isinstance(freq, int)
@@ -859,6 +987,264 @@ class DeviceAPIDataTests(DeviceAPITestsBase):
         self.assertEquals(data['begin_time'], int(params['begin']))
         self.assertEquals(data['end_time'], int(params['end']))
 
+    def test_streamed_data_detail(self):
+        agg = 30000
+        params = APIDataTestResults.get_agg_range(agg, in_ms=True)
+        params['begin'] -= agg*2
+
+        urls = [
+            ('/v2/device/rtr_a/interface/xe-0@2F0@2F0/in', {}),
+            ('/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/{0}'.format(agg), params),
+        ]
+
+        for url, p in urls:
+            response = self.client.get(url, p)
+            self.assertEquals(response.status_code, 200)
+            self.assertFalse(response.streaming)
+            expected = json.loads(response.content)
+
+            with mock.patch('esmond.api.streaming.STREAM_THRESHOLD', 1):
+                response = self.client.get(url, p)
+                self.assertEquals(response.status_code, 200)
+                self.assertTrue(response.streaming)
+                data = json.loads(''.join(response.streaming_content))
+
+            self.assertEquals(data, expected)
+
+    def test_conditional_data_detail(self):
+        agg = 30
+        urls = [
+            ('/v2/device/rtr_a/interface/xe-0@2F0@2F0/in',
+                APIDataTestResults.get_agg_range(agg)),
+            ('/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000',
+                APIDataTestResults.get_agg_range(30000, in_ms=True)),
+        ]
+
+        for url, params in urls:
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response['Cache-Control'],
+                    'public, max-age=0, must-revalidate')
+            etag = response['ETag']
+            last_modified = response['Last-Modified']
+
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304)
+            self.assertEquals(response.content, '')
+
+            # with an ETag If-Modified-Since alone isn't enough
+            response = self.client.get(url, params,
+                    HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(response.status_code, 200)
+            response = self.client.get(url, params,
+                    HTTP_IF_NONE_MATCH='"stale"',
+                    HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(response.status_code, 200)
+
+            with mock.patch('esmond.api.conditional.CACHE_MAX_AGE', 86400):
+                response = self.client.get(url, params)
+                self.assertEquals(response['Cache-Control'],
+                        'public, max-age=86400')
+
+        # an open ended range may still change
+        response = self.client.get('/v2/device/rtr_a/interface/xe-0@2F0@2F0/in')
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_packed_data(self):
+        from esmond.api.client.util import unpack_data, PACKED_CONTENT_TYPE
+
+        urls = [
+            ('/v2/device/rtr_a/interface/xe-0@2F0@2F0/in', {}),
+            ('/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000',
+                APIDataTestResults.get_agg_range(30000, in_ms=True)),
+        ]
+
+        for url, params in urls:
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            expected = json.loads(response.content)
+
+            response = self.client.get(url, dict(params, format='packed'))
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response['Content-Type'], PACKED_CONTENT_TYPE)
+            self.assertEquals(unpack_data(response.content), expected)
+
+        params = APIDataTestResults.get_agg_range(30000, in_ms=True)
+        payload = {
+            'paths': [['snmp', 'rtr_a', 'FastPollHC', 'ifHCInOctets', 'xe-0/0/0', 30000]],
+            'type': 'BaseRate',
+            'begin': params['begin'],
+            'end': params['end'],
+        }
+
+        response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                format='json')
+        expected = json.loads(response.content)
+
+        response = self.client.post('/v2/bulk/timeseries/?format=packed',
+                data=payload, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response['Content-Type'], PACKED_CONTENT_TYPE)
+        self.assertEquals(unpack_data(response.content), expected)
+
+        # a longer range has gaps that are filled, the filled series is
+        # packed too
+        payload['begin'] = payload['end'] - 30000 * 10
+        response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                format='json')
+        expected = json.loads(response.content)
+        self.assertTrue(None in [d['val'] for d in expected['data'][0]['data']])
+
+        response = self.client.post('/v2/bulk/timeseries/?format=packed',
+                data=payload, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(unpack_data(response.content), expected)
+        columns = unpack_data(response.content, columns=True)
+        self.assertEquals(sorted(columns['data'][0]['data'].keys()),
+                ['ts', 'val'])
+
+    def test_bulk_interface_data(self):
+        from esmond.api import api_v2
+
+        params = APIDataTestResults.get_agg_range(30)
+
+        payload = {
+            'interfaces': [
+                {'device': 'rtr_a', 'iface': 'xe-0/0/0'},
+                {'device': '/v2/device/rtr_b/', 'iface': 'xe-1/0/0'},
+                {'device': 'rtr_a', 'iface': 'xe-1/0/0'},
+            ],
+            'endpoint': ['in', 'out'],
+            'begin': params['begin'],
+            'end': params['end'],
+        }
+
+        # build the endpoint map before counting queries
+        OIDSET_INTERFACE_ENDPOINTS.endpoints
+
+        # the devices and their oidsets and nothing else
+        with self.assertNumQueries(2):
+            response = self.client.post('/v2/bulk/interface/', data=payload,
+                    format='json')
+        self.assertEquals(response.status_code, 201)
+
+        # one backend request for all of the base rates
+        self.assertEquals(api_v2.db.multi_queries, 1)
+
+        data = json.loads(response.content)
+
+        self.assertEquals(data['device_names'], ['rtr_a', 'rtr_b', 'rtr_a'])
+        self.assertEquals(len(data['data']), 6)
+        self.assertEquals(
+            [(r['path']['dev'], r['path']['iface'], r['path']['endpoint']) for r in data['data']],
+            [('rtr_a', 'xe-0/0/0', 'in'), ('rtr_a', 'xe-0/0/0', 'out'),
+             ('rtr_b', 'xe-1/0/0', 'in'), ('rtr_b', 'xe-1/0/0', 'out'),
+             ('rtr_a', 'xe-1/0/0', 'in'), ('rtr_a', 'xe-1/0/0', 'out')])
+        for row in data['data']:
+            self.assertEquals(row['data'][1]['val'], 20)
+
+        payload['interfaces'].append({'device': 'nonexistent', 'iface': 'xe-0/0/0'})
+        response = self.client.post('/v2/bulk/interface/', data=payload,
+                format='json')
+        self.assertEquals(response.status_code, 400)
+
+        payload['interfaces'].pop()
+        payload['endpoint'].append('nonexistent')
+        response = self.client.post('/v2/bulk/interface/', data=payload,
+                format='json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_bulk_timeseries_data(self):
+        from esmond.api import api_v2
+
+        agg = 30000
+        params = APIDataTestResults.get_agg_range(agg, in_ms=True)
+        ifaces = ['xe-{0}/0/0'.format(i) for i in range(10)]
+
+        payload = {
+            'paths': [['snmp', 'rtr_a', 'FastPollHC', 'ifHCInOctets', i, agg]
+                for i in ifaces],
+            'type': 'BaseRate',
+            'begin': params['begin'],
+            'end': params['end'],
+        }
+
+        response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                format='json')
+        self.assertEquals(response.status_code, 201)
+
+        data = json.loads(response.content)
+
+        # reassembled in request order
+        self.assertEquals([r['path'][4] for r in data['data']], ifaces)
+        for row in data['data']:
+            self.assertEquals(row['path'][5], agg)
+            self.assertEquals(row['data'][1]['val'], 20)
+
+        # paths that miss the deadline come back with an error
+        query = api_v2.db.query_baserate_timerange
+        def slow_query(path=None, freq=None, ts_min=None, ts_max=None):
+            if path[4] != ifaces[0]:
+                time.sleep(0.5)
+            return query(path, freq, ts_min, ts_max)
+
+        with mock.patch('esmond.api.api_v2.BULK_QUERY_DEADLINE', 0.2), \
+                mock.patch.object(api_v2.db, 'query_baserate_timerange', slow_query):
+            response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                    format='json')
+        self.assertEquals(response.status_code, 201)
+
+        data = json.loads(response.content)
+
+        self.assertEquals([r['path'][4] for r in data['data']], ifaces)
+        self.assertEquals(data['data'][0]['data'][1]['val'], 20)
+        self.assertFalse(data['data'][0].has_key('query error'))
+        for row in data['data'][1:]:
+            self.assertEquals(row['data'], [])
+            self.assertTrue(row['query error'].startswith('deadline'))
+
+    def test_bulk_throttle(self):
+        from esmond.api.api_v2 import BaseBulkThrottle
+        from esmond.api.tokenbucket import TokenBucket
+
+        agg = 30000
+        params = APIDataTestResults.get_agg_range(agg, in_ms=True)
+
+        # 3 points per request
+        payload = {
+            'paths': [['snmp', 'rtr_a', 'FastPollHC', 'ifHCInOctets', 'xe-0/0/0', agg]],
+            'type': 'BaseRate',
+            'begin': params['begin'],
+            'end': params['end'],
+        }
+
+        bucket = TokenBucket(10, 0.01, prefix='test_bulk_throttle')
+
+        with mock.patch.object(BaseBulkThrottle, 'bucket', bucket):
+            for i in range(3):
+                response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                        format='json')
+                self.assertEquals(response.status_code, 201)
+
+            response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                    format='json')
+            self.assertEquals(response.status_code, 429)
+            self.assertTrue(int(response['Retry-After']) > 0)
+
+            # authenticated clients aren't charged
+            response = self.get_api_client(admin_auth=True).post(
+                    '/v2/bulk/timeseries/', data=payload, format='json')
+            self.assertEquals(response.status_code, 201)
+
+            # more points than the bucket holds can never be let through
+            payload['begin'] = payload['end'] - 86400 * 1000
+            response = self.client.post('/v2/bulk/timeseries/', data=payload,
+                    format='json')
+            self.assertEquals(response.status_code, 413)
+            self.assertFalse(response.has_header('Retry-After'))
+            self.assertTrue('limit of 10' in json.loads(response.content)['detail'])
+
     def test_bad_timeseries_post_requests(self):
         url = '/v2/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000'
 
@@ -1076,3 +1462,216 @@ class QueryUtilTests(TestCase):
         data_out_nocoerce = [{ 'ts': 1391216201, 'val': 1100}, { 'ts': 1391216262, 'val': 1100}, { 'ts': 1391216323, 'val': 1100}]
         data_check = QueryUtil.format_cassandra_data_payload(data_in)
         self.assertEquals(data_check, data_out_nocoerce)
+
+class StreamingTests(TestCase):
+    def test_iter_json_list(self):
+        from esmond.api.streaming import iter_json_list, JSONStream
+
+        data = [dict(ts=i, val=i*10) for i in range(25)]
+
+        for chunk_size in (1, 7, 25, 100):
+            s = ''.join(iter_json_list(iter(data), chunk_size=chunk_size))
+            self.assertEquals(json.loads(s), data)
+
+        self.assertEquals(''.join(iter_json_list([])), '[]')
+
+        rows = [
+            dict(path=['a'], data=data[:3]),
+            JSONStream(dict(path=['b']), 'data', iter(data)),
+            JSONStream(dict(path=['c']), 'data', []),
+            dict(path=['d'], data=[]),
+        ]
+
+        s = ''.join(iter_json_list(rows, chunk_size=2))
+        self.assertEquals(json.loads(s), [
+            dict(path=['a'], data=data[:3]),
+            dict(path=['b'], data=data),
+            dict(path=['c'], data=[]),
+            dict(path=['d'], data=[]),
+        ])
+
+        rows[1] = JSONStream(dict(path=['b']), 'data', iter(data))
+        s = ''.join(JSONStream(dict(url='/x', data=None), 'data', iter(rows)))
+        self.assertEquals(json.loads(s)['url'], '/x')
+        self.assertEquals(json.loads(s)['data'][1]['data'], data)
+
+    def test_iter_json_series(self):
+        from esmond.api.streaming import iter_json_list, dumps
+        from esmond.api.dataseries import FilledSeries
+
+        vals = [i * 1.5 for i in range(25)]
+        vals[3] = None
+        vals[7] = 10**20
+        series = FilledSeries(1000, 30, vals)
+
+        for chunk_size in (1, 7, 25, 100):
+            s = ''.join(iter_json_list(series, chunk_size=chunk_size))
+            self.assertEquals(s, dumps(list(series)))
+
+        # values that aren't numbers are encoded as they would be anyway
+        series = FilledSeries(1000, 30, [dict(a=1), None, 'x,y'])
+        s = ''.join(iter_json_list(series, chunk_size=2))
+        self.assertEquals(json.loads(s), json.loads(dumps(list(series))))
+
+        self.assertEquals(''.join(iter_json_list(FilledSeries(1000, 30, []))),
+            '[]')
+
+    def test_should_stream(self):
+        from esmond.api.streaming import should_stream
+        from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
+
+        request = mock.Mock(accepted_renderer=JSONRenderer())
+        with mock.patch('esmond.api.streaming.STREAM_THRESHOLD', 10):
+            self.assertTrue(should_stream(request, 11))
+            self.assertFalse(should_stream(request, 10))
+            request.accepted_renderer = BrowsableAPIRenderer()
+            self.assertFalse(should_stream(request, 11))
+
+        request.accepted_renderer = JSONRenderer()
+        with mock.patch('esmond.api.streaming.STREAM_THRESHOLD', 0):
+            self.assertFalse(should_stream(request, 1000000))
+
+class PackedFormatTests(TestCase):
+    def test_pack_data(self):
+        from esmond.api.client.util import pack_data, unpack_data
+
+        series = [dict(ts=1000+i*30, val=i*1.5) for i in range(100)]
+        series[10]['val'] = None
+
+        payloads = [
+            dict(agg=30, cf='average', data=series),
+            dict(data=[dict(path=['a', 30], data=series), dict(path=['b', 30], data=[])]),
+            [dict(ts=1, val=dict(a=1)), dict(ts=2, val=[1, 2])],
+            [dict(ts=1, val=10, cf='min', m_ts=None), dict(ts=2, val=20, cf='min', m_ts=3)],
+            dict(error='not a series', data=[dict(ts=1), dict(val=2)]),
+            # 64 bit counters, alone and with Nones
+            [dict(ts=1, val=2**64 - 1), dict(ts=2, val=2**63)],
+            [dict(ts=1, val=2**63), dict(ts=2, val=None)],
+            [dict(ts=1, val=2**62), dict(ts=2, val=None), dict(ts=3, val=-1)],
+            # too big for any integer column, and for a double
+            [dict(ts=1, val=2**64), dict(ts=2, val=-1)],
+            [dict(ts=1, val=2**60 + 1), dict(ts=2, val=0.5)],
+        ]
+
+        for payload in payloads:
+            self.assertEquals(unpack_data(pack_data(payload)), payload)
+
+        # integers stay integers
+        for x, result in ((2**63, [2**63, None]), (1, [1, None])):
+            rows = [dict(ts=1, val=x), dict(ts=2, val=None)]
+            vals = unpack_data(pack_data(rows), columns=True)['val']
+            self.assertEquals(vals, result)
+            self.assertTrue(type(vals[0]) in (int, long))
+
+        # a NaN is only None if it was None
+        vals = unpack_data(pack_data([dict(ts=1, val=float('nan')),
+            dict(ts=2, val=None)]), columns=True)['val']
+        self.assertTrue(vals[0] != vals[0])
+        self.assertEquals(vals[1], None)
+
+        # tuples of rows are series too
+        rows = (dict(ts=1, val=1), dict(ts=2, val=2))
+        self.assertEquals(unpack_data(pack_data(rows)), list(rows))
+
+        columns = unpack_data(pack_data(payloads[0]), columns=True)['data']
+        self.assertEquals(columns['ts'], [d['ts'] for d in series])
+        self.assertEquals(columns['val'][10], None)
+
+        # the point of the whole thing
+        self.assertTrue(len(pack_data(series)) < len(json.dumps(series)))
+
+        self.assertRaises(ValueError, unpack_data, json.dumps(series))
+
+    def test_pack_filled_series(self):
+        from esmond.api.client.util import pack_data, unpack_data
+        from esmond.api.dataseries import FilledSeries
+
+        series = FilledSeries(1000, 30, [1.5, None, 3.0])
+        payload = dict(agg=30, data=series)
+        self.assertEquals(unpack_data(pack_data(payload)),
+            dict(agg=30, data=list(series)))
+
+class QueryPoolTests(TestCase):
+    def test_map(self):
+        from esmond.api.querypool import QueryPool, DeadlineExceeded
+
+        pool = QueryPool(4)
+
+        def double(x):
+            time.sleep((x % 3) * 0.01)
+            if x == 5:
+                raise ValueError('five')
+            return x * 2
+
+        results = list(pool.map(double, range(20), concurrency=3))
+        self.assertEquals([r[0] for r in results], range(20))
+        for x, result, exc_info in results:
+            if x == 5:
+                self.assertTrue(isinstance(exc_info[1], ValueError))
+                # the traceback goes back to where it was raised
+                tb = traceback.extract_tb(exc_info[2])
+                self.assertEquals(tb[-1][2], 'double')
+            else:
+                self.assertEquals(result, x * 2)
+                self.assertEquals(exc_info, None)
+
+        def slow(x):
+            time.sleep(x * 0.1)
+            return x
+
+        results = list(pool.map(slow, range(6), concurrency=2, deadline=0.25))
+        self.assertEquals([r[1] for r in results[:2]], [0, 1])
+        for x, result, exc_info in results[3:]:
+            self.assertEquals(result, None)
+            self.assertTrue(isinstance(exc_info[1], DeadlineExceeded))
+
+        self.assertEquals(list(pool.map(slow, [])), [])
+
+    def test_deadline_skips_queued(self):
+        from esmond.api.querypool import QueryPool, DeadlineExceeded
+
+        pool = QueryPool(1)
+        started = []
+
+        def slow(x):
+            started.append(x)
+            time.sleep(0.2)
+            return x
+
+        # the queued items expire while the first one runs and are never
+        # started
+        results = list(pool.map(slow, range(4), deadline=0.1))
+        self.assertTrue(isinstance(results[0][2][1], DeadlineExceeded))
+        time.sleep(0.3)
+        self.assertEquals(started, [0])
+        self.assertEquals(pool.jobs.qsize(), 0)
+
+class TokenBucketTests(TestCase):
+    def test_consume(self):
+        from esmond.api.tokenbucket import TokenBucket
+
+        bucket = TokenBucket(100, 10, prefix='test_consume')
+        now = [1000.0]
+
+        with mock.patch.object(bucket, 'timer', lambda: now[0]):
+            self.assertEquals(bucket.consume('a', 60), 0)
+            self.assertEquals(bucket.tokens('a'), 40)
+
+            # not enough tokens, nothing is taken.  The 60 spent are
+            # refilled over the next window of 100 / 10 seconds.
+            self.assertAlmostEquals(bucket.consume('a', 60), 10 + 20 / 6.0)
+            self.assertEquals(bucket.tokens('a'), 40)
+
+            # every client has a bucket of its own
+            self.assertEquals(bucket.consume('b', 100), 0)
+
+            now[0] += 2
+            self.assertEquals(bucket.tokens('a'), 40)
+            now[0] += 14
+            self.assertAlmostEquals(bucket.tokens('a'), 76)
+            self.assertEquals(bucket.consume('a', 60), 0)
+            self.assertAlmostEquals(bucket.tokens('a'), 16)
+
+            # never fills past its size
+            now[0] += 3600
+            self.assertEquals(bucket.tokens('a'), 100)
@@ -12,8 +12,10 @@ import json
 import datetime
 import calendar
 import shutil
+import tempfile
 import time
 
+import mock
 import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
@@ -31,8 +33,10 @@ from rest_framework.test import APIClient
 from esmond.api.models import Device, IfRef, ALUSAPRef, OIDSet, DeviceOIDSetMap
 
 from esmond.persist import IfRefPollPersister, ALUSAPRefPersister, \
-     PersistQueueEmpty, CassandraPollPersister
-from esmond.api.dataseries import fit_to_bins
+     PersistQueueEmpty, CassandraPollPersister, PollResult, PollResultCodec, \
+     PersistWireFormatError, AdaptiveBatchPolicy, PollPersister, replay, \
+     MemcachedPersistQueue
+from esmond.api.dataseries import fit_to_bins, Fill, FilledSeries
 from esmond.config import get_config, get_config_path
 from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD
 from esmond.util import max_datetime
@@ -137,6 +141,9 @@ class TestPersistQueue(object):
 class MockConfig(object):
     def __init__(self):
         self.profile_persister = False
+        self.persist_batch_size_min = 200
+        self.persist_batch_size_max = 5000
+        self.persist_max_latency = 30
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -182,6 +189,39 @@ class TestIfRefPersister(TestCase):
 
         self.assertTrue(ifrefs[1].end_time < max_datetime)
 
+    def test_unchanged(self):
+        first, second = json.loads(ifref_test_data)
+
+        p = IfRefPollPersister(MockConfig(), "test",
+                persistq=TestPersistQueue([]))
+        p.store(TestPollResult(copy.deepcopy(first)))
+
+        ifrefs = IfRef.objects.filter(device__name="rtr_d", ifName="Vlan1")
+        self.assertEqual(ifrefs.count(), 1)
+        self.assertEqual(ifrefs[0].digest, p.digests["rtr_d"])
+
+        # the same poll again doesn't touch the database at all
+        with self.assertNumQueries(0):
+            p.store(TestPollResult(copy.deepcopy(first)))
+
+        # a new persister only has to look up the stored digest
+        p = IfRefPollPersister(MockConfig(), "test",
+                persistq=TestPersistQueue([]))
+        with self.assertNumQueries(1):
+            p.store(TestPollResult(copy.deepcopy(first)))
+        self.assertEqual(p.digests["rtr_d"], ifrefs[0].digest)
+
+        # a change still ends the old row and adds a new one
+        p.store(TestPollResult(copy.deepcopy(second)))
+
+        ifrefs = ifrefs.order_by("end_time").all()
+        self.assertEqual(len(ifrefs), 2)
+        self.assertTrue(ifrefs[0].end_time < max_datetime)
+        self.assertEqual(ifrefs[1].end_time, max_datetime)
+        self.assertEqual(ifrefs[1].ifAlias, "test two")
+        self.assertEqual(ifrefs[1].digest, p.digests["rtr_d"])
+        self.assertNotEqual(ifrefs[0].digest, ifrefs[1].digest)
+
 
 alu_sap_test_data = """
 [
@@ -1592,6 +1632,313 @@ class TestCassandraApiQueries(BaseTestCase):
 
         pass
 
+class TestPollResultCodec(TestCase):
+    def _result(self, data):
+        return PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 1343953700.5,
+                data, {'tsdb_flags': 1})
+
+    def test_round_trip(self):
+        data = [
+            [["ifHCInOctets", "xe-0/0/0"], 2**63 + 5],
+            [["ifHCInOctets", "xe-1/0/0"], None],
+            [["ifHCInOctets", "xe-2/0/0"], -3],
+            [["ifHCInOctets", "xe-3/0/0"], 1.5],
+        ]
+        dicts = {}
+        encoder = PollResultCodec()
+        decoder = PollResultCodec()
+
+        payload, new_dict = encoder.encode(self._result(data))
+        self.assertTrue(encoder.is_encoded(payload))
+        self.assertIsNotNone(new_dict)
+        dicts[new_dict[0]] = new_dict[1]
+
+        decoded = decoder.decode(payload, dicts.get)
+        self.assertEqual(decoded['device_name'], 'rtr_d')
+        self.assertEqual(decoded['oidset_name'], 'FastPollHC')
+        self.assertEqual(decoded['oid_name'], 'ifHCInOctets')
+        self.assertEqual(decoded['timestamp'], 1343953700.5)
+        self.assertEqual(decoded['metadata'], {'tsdb_flags': 1})
+        self.assertEqual(decoded['data'], data)
+
+        # the dictionary is only sent again when the paths change
+        payload, new_dict = encoder.encode(self._result(data[:2]))
+        self.assertIsNone(new_dict)
+        self.assertEqual(decoder.decode(payload, dicts.get)['data'], data[:2])
+
+        payload, new_dict = encoder.encode(
+            self._result(data + [[["ifHCInOctets", "xe-4/0/0"], 7]]))
+        self.assertIsNotNone(new_dict)
+
+        self.assertRaises(PersistWireFormatError, PollResultCodec().decode,
+                payload, lambda digest: None)
+
+        # corrupt entries raise PersistWireFormatError so they are skipped
+        self.assertRaises(PersistWireFormatError, PollResultCodec().decode,
+                payload, lambda digest: '[not json')
+        self.assertRaises(PersistWireFormatError, PollResultCodec().decode,
+                payload[:10], dicts.get)
+        dicts[new_dict[0]] = new_dict[1]
+        meta = len(encoder.MAGIC) + encoder._header.size + \
+            len('FastPollHC') + len('rtr_d') + len('ifHCInOctets')
+        self.assertEqual(decoder.decode(payload, dicts.get)['metadata'],
+                {'tsdb_flags': 1})
+        self.assertRaises(PersistWireFormatError, decoder.decode,
+                payload[:meta] + 'x' + payload[meta + 1:], dicts.get)
+
+    def test_dict_eviction(self):
+        dicts = {}
+        encoder = PollResultCodec()
+        decoder = PollResultCodec()
+        payloads = {}
+
+        for device in ('rtr_a', 'rtr_b'):
+            payload, new_dict = encoder.encode(PollResult('FastPollHC',
+                device, 'ifHCInOctets', 1343953700.5,
+                [[["ifHCInOctets", device + "-xe-0/0/0"], 1]], {}))
+            dicts[new_dict[0]] = new_dict[1]
+            decoder.decode(payload, dicts.get)
+            payloads[device] = (payload, new_dict[0].decode('hex'))
+
+        self.assertEqual(len(decoder._dicts), 2)
+
+        # rtr_b hasn't been seen for a while, rtr_a is still being polled
+        interval = PollResultCodec.DICT_REFRESH_INTERVAL
+        decoder._dicts_swept -= interval + 1
+        for entry in decoder._dicts.values():
+            entry[1] -= interval + 1
+
+        decoder.decode(payloads['rtr_a'][0], dicts.get)
+        self.assertEqual(decoder._dicts.keys(), [payloads['rtr_a'][1]])
+
+        # an evicted dictionary is fetched again if it is needed
+        self.assertEqual(decoder.decode(payloads['rtr_b'][0],
+            dicts.get)['device_name'], 'rtr_b')
+
+    def test_unencodable(self):
+        codec = PollResultCodec()
+        self.assertIsNone(codec.encode(self._result({"ifName": []})))
+        self.assertIsNone(codec.encode(self._result([[["ifAlias", "1"], "x"]])))
+
+class ReplayRecorder(PollPersister):
+    """Writes what each replay worker is given to a file per process."""
+    def store(self, result):
+        path = os.path.join(self.config.replay_record_dir, str(os.getpid()))
+        with open(path, 'a') as f:
+            f.write(json.dumps([result.device_name, result.oidset_name,
+                result.oid_name, result.timestamp]) + '\n')
+
+class ReplayConfig(MockConfig):
+    def __init__(self, record_dir):
+        MockConfig.__init__(self)
+        self.debug = False
+        self.syslog_facility = None
+        self.syslog_priority = None
+        self.streaming_log_dir = None
+        self.persist_queues = {'cassandra': ('ReplayRecorder', 2)}
+        self.persist_map = {'fastpollhc': ['cassandra'],
+                'errors': ['streaming']}
+        self.replay_record_dir = record_dir
+
+class ReplayOptions(object):
+    def __init__(self, begin=None, end=None):
+        self.debug = False
+        self.qname = 'cassandra'
+        self.replay_workers = 2
+        self.begin = begin
+        self.end = end
+
+class FakeMemcache(object):
+    """Just enough of memcache.Client for MemcachedPersistQueue."""
+    def __init__(self, servers, pickler=None, unpickler=None):
+        self.data = {}
+
+    def get(self, k):
+        return self.data.get(k)
+
+    def set(self, k, v):
+        self.data[k] = v
+        return True
+
+    def set_multi(self, items):
+        self.data.update(items)
+        return []
+
+    def delete(self, k):
+        self.data.pop(k, None)
+
+    def incr(self, k, delta=1):
+        self.data[k] += delta
+        return self.data[k]
+
+    def decr(self, k, delta=1):
+        self.data[k] -= delta
+        return self.data[k]
+
+class TestMemcachedPersistQueue(TestCase):
+    def _result(self, n):
+        return PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 1343953700 + n,
+                [[["ifHCInOctets", "xe-0/0/0"], n]], {})
+
+    @mock.patch('esmond.persist.time')
+    @mock.patch('esmond.persist.memcache.Client', FakeMemcache)
+    def test_missing_qids(self, mock_time):
+        q = MemcachedPersistQueue('test', '127.0.0.1:11211')
+        mock_time.time.return_value = 1000
+        q.put_multi([self._result(n) for n in range(1, 4)])
+        # qid 2 is evicted
+        q.mc.delete('%s_test_2' % q.PREFIX)
+
+        self.assertEqual(q.get().data[0][1], 1)
+        # it might be a qid that is still being written, so wait for it
+        mock_time.time.return_value = 1001
+        self.assertIsNone(q.get())
+        self.assertEqual(q.skipped_qids, 0)
+
+        # once all of the qids up to it were reserved long enough ago it is
+        # skipped straight away
+        mock_time.time.return_value = 1002
+        self.assertEqual(q.get().data[0][1], 3)
+        self.assertEqual(q.skipped_qids, 1)
+
+        # a newly reserved qid still gets to wait
+        q.mc.incr(q.last_added)
+        self.assertIsNone(q.get())
+        self.assertEqual(len(q), 1)
+
+        q.publish_stats(dict(batch_size=200))
+        stats = json.loads(q.mc.get('%s_test_batch' % q.PREFIX))
+        self.assertEqual(stats['skipped_qids'], 1)
+
+class TestReplay(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='esmond_test_replay_')
+        self.record_dir = os.path.join(self.tmpdir, 'records')
+        os.mkdir(self.record_dir)
+
+        # two series spread out of time order, plus one for an oidset
+        # that isn't persisted to the cassandra queue
+        timestamps = [1345125660, 1345125600, 1345125720, 1345125630,
+                1345125690]
+        self.log = os.path.join(self.tmpdir, 'stream.log')
+        with open(self.log, 'w') as f:
+            for i, ts in enumerate(timestamps):
+                for device in ('rtr_a', 'rtr_b'):
+                    f.write(json.dumps(dict(oidset_name='FastPollHC',
+                        device_name=device, oid_name='ifHCInOctets',
+                        timestamp=ts + i, data=[], metadata={})) + '\n')
+            f.write(json.dumps(dict(oidset_name='Errors', device_name='rtr_a',
+                oid_name='ifInErrors', timestamp=1345125600, data=[],
+                metadata={})) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _replay(self, opts):
+        # the workers are forked so they see the patched module
+        with mock.patch('esmond.persist.ReplayRecorder', ReplayRecorder,
+                    create=True), \
+                mock.patch('esmond.persist.init_logging'), \
+                mock.patch('django.db.connections.all', return_value=[]):
+            replay('espersistd', ReplayConfig(self.record_dir), opts,
+                    ['espersistd', self.log])
+
+        workers = {}
+        for fname in os.listdir(self.record_dir):
+            with open(os.path.join(self.record_dir, fname)) as f:
+                workers[fname] = [json.loads(line) for line in f]
+            os.unlink(os.path.join(self.record_dir, fname))
+
+        return workers
+
+    def _series(self, workers):
+        series = {}
+        for records in workers.values():
+            for device, oidset, oid, ts in records:
+                series.setdefault((device, oidset, oid), []).append(ts)
+        return series
+
+    def test_replay(self):
+        workers = self._replay(ReplayOptions())
+
+        series = self._series(workers)
+        self.assertEqual(sorted(series.keys()), [
+            ('rtr_a', 'FastPollHC', 'ifHCInOctets'),
+            ('rtr_b', 'FastPollHC', 'ifHCInOctets')])
+
+        for key, timestamps in series.items():
+            self.assertEqual(len(timestamps), 5)
+            self.assertEqual(timestamps, sorted(timestamps))
+            # and all of a series went to one worker
+            self.assertEqual(len([w for w in workers.values()
+                if key[0] in [r[0] for r in w]]), 1)
+
+    def test_replay_time_range(self):
+        workers = self._replay(ReplayOptions(begin=1345125630,
+            end=1345125690))
+
+        for timestamps in self._series(workers).values():
+            self.assertEqual(timestamps, [1345125633, 1345125660])
+
+class TestAdaptiveBatchPolicy(TestCase):
+    def test_policy(self):
+        policy = AdaptiveBatchPolicy(200, 1000)
+        self.assertFalse(policy.update(10))
+        self.assertEqual(policy.size, 200)
+        self.assertFalse(policy.backlogged)
+
+        self.assertTrue(policy.update(500))
+        self.assertEqual(policy.size, 400)
+        self.assertTrue(policy.backlogged)
+        policy.update(500)
+        policy.update(500)
+        self.assertEqual(policy.size, 1000)
+
+        self.assertFalse(policy.update(20))
+        self.assertEqual(policy.size, 1000)
+
+        policy.update(0)
+        policy.update(0)
+        policy.update(0)
+        self.assertEqual(policy.size, 200)
+        self.assertFalse(policy.backlogged)
+        self.assertEqual(policy.resizes, 6)
+
+class IdlePersistQueue(object):
+    """Returns nothing for a few gets and then runs out."""
+    def __init__(self, idle):
+        self.idle = idle
+
+    def get(self):
+        if not self.idle:
+            raise PersistQueueEmpty()
+        self.idle -= 1
+        return None
+
+class FlushCountingPersister(PollPersister):
+    def __init__(self, *args, **kwargs):
+        PollPersister.__init__(self, *args, **kwargs)
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+class TestIdleFlush(TestCase):
+    def test_idle_latency_flush(self):
+        """A partial batch is flushed while the queue stays empty."""
+        config = namedtuple('Config', ['persist_batch_size_min',
+            'persist_batch_size_max', 'persist_max_latency', 'debug',
+            'profile_persister'])(200, 1000, 0, False, False)
+        p = FlushCountingPersister(config, 'test', IdlePersistQueue(3))
+
+        with mock.patch('esmond.persist.PERSIST_SLEEP_TIME', 0.01):
+            p.run()
+
+        # once when it starts sleeping, twice more for the latency while
+        # it is still idle and once when the queue runs out
+        self.assertEqual(p.latency_flushes, 2)
+        self.assertEqual(p.flushes, 4)
+
 class TestFitToBins(TestCase):
     def test_fit_to_bins(self):
         # tests from fit_to_bins docstring
@@ -1613,6 +1960,35 @@ class TestFitToBins(TestCase):
         self.assertEqual({1386369690000: 249747233}, r)
         self.assertLess(time.time()-t0, 0.5)
 
+class TestFill(TestCase):
+    def test_verify_fill(self):
+        data = [dict(ts=60, val=1), dict(ts=90, val=2), dict(ts=150, val=4)]
+
+        # complete series are returned as is
+        self.assertIs(Fill.verify_fill(50, 100, 30, data[:2]), data[:2])
+
+        r = Fill.verify_fill(50, 179, 30, data)
+        self.assertIsInstance(r, FilledSeries)
+        self.assertEqual(len(r), 4)
+        self.assertEqual(list(r), [dict(ts=60, val=1), dict(ts=90, val=2),
+            dict(ts=120, val=None), dict(ts=150, val=4)])
+        self.assertEqual(r.columns(), ([60, 90, 120, 150], [1, 2, None, 4]))
+
+        # points off the bins or out of range are ignored
+        r = Fill.verify_fill(50, 179, 30, data + [dict(ts=100, val=9),
+            dict(ts=300, val=9)])
+        self.assertEqual(r.vals, [1, 2, None, 4])
+
+    def test_fill_year(self):
+        n = 365 * 86400 / 30
+        data = [dict(ts=i * 30, val=i) for i in xrange(n) if i % 1000]
+
+        t0 = time.time()
+        r = Fill.verify_fill(0, (n - 1) * 30, 30, data)
+        self.assertLess(time.time() - t0, 2)
+        self.assertEqual(len(r), n)
+        self.assertEqual(r.vals[999:1002], [999, None, 1001])
+
 class TestCassandraApiQueriesALU(BaseTestCase):
     fixtures = ['oidsets.json']
 
@@ -0,0 +1,344 @@
+import time
+import Queue
+
+import mock
+
+from django.test import TestCase
+from django.utils.timezone import now
+
+from esmond.api.models import Device, OIDSet, DeviceOIDSetMap, \
+        ConfigGeneration
+from esmond.poll import poll_phase, next_poll_slot, first_poll_time, \
+        device_shard, filter_data, WalkResults, PollStats, CorrelatedPoller, \
+        PersistThread, PollSupervisor, oidset_changed
+from esmond.persist import PollResult
+
+class TestPollScheduling(TestCase):
+    def test_poll_phase(self):
+        phase = poll_phase("rtr_a_FastPollHC", 30)
+        self.assertTrue(0 <= phase < 30)
+        # the same poller always gets the same phase
+        self.assertEqual(phase, poll_phase("rtr_a_FastPollHC", 30))
+
+        phases = set([poll_phase("rtr_%d_FastPollHC" % i, 30)
+            for i in range(100)])
+        self.assertTrue(len(phases) > 50)
+
+    def test_next_poll_slot(self):
+        self.assertEqual(next_poll_slot(1000, 30, 5), 1025)
+        self.assertEqual(next_poll_slot(1024.9, 30, 5), 1025)
+        self.assertEqual(next_poll_slot(1025, 30, 5), 1055)
+        # a poller that is running late skips the slots it missed
+        self.assertEqual(next_poll_slot(1100, 30, 5), 1115)
+
+    def test_first_poll_time(self):
+        # the first poll doesn't wait for the next slot
+        self.assertEqual(first_poll_time(1000, 30, 15), 1002.5)
+        self.assertEqual(first_poll_time(1000, 30, 0), 1000)
+        self.assertTrue(first_poll_time(1000, 30, 29.9) < 1005)
+        self.assertEqual(first_poll_time(1000, 2, 1), 1001)
+
+    def test_device_shard(self):
+        shards = [device_shard("rtr_%d" % i, 4) for i in range(100)]
+        self.assertEqual(set(shards), set([1, 2, 3, 4]))
+        self.assertEqual(shards,
+                [device_shard("rtr_%d" % i, 4) for i in range(100)])
+        self.assertEqual(device_shard("rtr_a", 1), 1)
+        self.assertEqual(device_shard(u"rtr_\xe9", 4),
+                device_shard(u"rtr_\xe9", 4))
+
+class SupervisorOptions(object):
+    config_file = '/etc/esmond.conf'
+    debug = True
+    pid_dir = '/var/run/esmond'
+
+class SupervisorConfig(object):
+    espolld_shards = 2
+
+class TestPollSupervisor(TestCase):
+    def setUp(self):
+        with mock.patch('esmond.poll.signal.signal'):
+            self.supervisor = PollSupervisor('espolld', SupervisorOptions(),
+                    SupervisorConfig())
+
+    def test_shard_args(self):
+        args = self.supervisor.shard_args(2)
+        self.assertEqual(args[2:], ['-f', '/etc/esmond.conf', '--shard', '2',
+            '--debug', '-p', '/var/run/esmond'])
+
+    def test_restart_backoff(self):
+        s = self.supervisor
+        s.started[1] = 1000
+        self.assertEqual(s.shard_died(1, 1001), 1)
+        self.assertEqual(s.restarts[1], 1002)
+
+        # dying again soon after each restart backs off up to the cap
+        delays = []
+        for i in range(12):
+            s.started[1] = 1000 + i
+            delays.append(s.shard_died(1, 1001 + i))
+        self.assertEqual(delays[:4], [2, 4, 8, 16])
+        self.assertEqual(delays[-1], PollSupervisor.RESTART_DELAY_MAX)
+
+        # a shard that ran for a while is restarted quickly again
+        s.started[1] = 2000
+        self.assertEqual(s.shard_died(1, 3000), 1)
+
+        with mock.patch.object(s, 'start_shard') as start_shard:
+            s.restart_shards(3000.5)
+            self.assertFalse(start_shard.called)
+            s.restart_shards(3001)
+            start_shard.assert_called_once_with(1)
+        self.assertEqual(s.restarts, {})
+
+class TestWalkResults(TestCase):
+    def test_walk_results(self):
+        results = WalkResults()
+        results.add('ifHCInOctets', [('ifHCInOctets.1', 10),
+            ('ifHCInOctets.2', 20)])
+        results.add('ifName', [('ifName.1', 'xe-0/0/0'),
+            ('ifName.2', 'xe-0/0/1')])
+        results.add('sysUpTime', [('sysUpTime.0', 1234)])
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(list(results)[0], ('ifHCInOctets.1', 10))
+        self.assertEqual(list(results)[-1], ('sysUpTime.0', 1234))
+
+        self.assertEqual(filter_data('ifName', results),
+                [('ifName.1', 'xe-0/0/0'), ('ifName.2', 'xe-0/0/1')])
+        self.assertEqual(filter_data('ifOutErrors', results), [])
+        # names which aren't a walked column fall back to a prefix match
+        self.assertEqual(filter_data('sysUpTime.0', results),
+                [('sysUpTime.0', 1234)])
+        self.assertEqual(filter_data('ifName', list(results)),
+                filter_data('ifName', results))
+
+class TestPollStats(TestCase):
+    def test_poll_stats(self):
+        stats = PollStats()
+        stats.record("rtr_a", "FastPollHC", 30, 0.2, varbinds=100, pdus=4)
+        stats.record("rtr_a", "FastPollHC", 30, 45.0, varbinds=100, pdus=4)
+        stats.record("rtr_a", "FastPollHC", 30, 3.0, timeout=True)
+        stats.record("rtr_b", "FastPollHC", 30, 1.5, varbinds=10, pdus=1)
+
+        snap = stats.snapshot()
+        s = snap["rtr_a"]["FastPollHC"]
+        self.assertEqual(s['polls'], 3)
+        self.assertEqual(s['timeouts'], 1)
+        self.assertEqual(s['overruns'], 1)
+        self.assertEqual(s['varbinds'], 200)
+        self.assertEqual(s['pdus'], 8)
+        self.assertEqual(s['duration_max'], 45.0)
+        self.assertEqual(s['duration_last'], 3.0)
+        self.assertEqual(s['duration_histogram']['0.5'], 1)
+        self.assertEqual(s['duration_histogram']['5'], 1)
+        self.assertEqual(s['duration_histogram']['60'], 1)
+        self.assertEqual(sum(s['duration_histogram'].values()), 3)
+        self.assertEqual(snap["rtr_b"]["FastPollHC"]['polls'], 1)
+
+        # duration_max is per snapshot, the counters are cumulative
+        snap = stats.snapshot()
+        self.assertEqual(snap["rtr_a"]["FastPollHC"]['duration_max'], 0.0)
+        self.assertEqual(snap["rtr_a"]["FastPollHC"]['polls'], 3)
+
+        stats.forget("rtr_b")
+        self.assertFalse("rtr_b" in stats.snapshot())
+
+class TestConfigGeneration(TestCase):
+    fixtures = ['oidsets.json']
+
+    def test_generation(self):
+        g0 = ConfigGeneration.current()
+
+        rtr_a = Device.objects.create(name="rtr_a", community="public",
+                begin_time=now())
+        rtr_b = Device.objects.create(name="rtr_b", community="public",
+                begin_time=now())
+        self.assertTrue(ConfigGeneration.current() > g0)
+
+        g1 = ConfigGeneration.current()
+        DeviceOIDSetMap(device=rtr_a,
+                oid_set=OIDSet.objects.get(name="FastPollHC")).save()
+        g2 = ConfigGeneration.current()
+        self.assertTrue(g2 > g1)
+        # only the device which changed is marked
+        self.assertEqual(Device.objects.get(name="rtr_a").generation, g2)
+        self.assertTrue(Device.objects.get(name="rtr_b").generation <= g1)
+
+        # changing an oidset marks all of the devices which use it
+        oidset = OIDSet.objects.get(name="FastPollHC")
+        oidset.frequency = 60
+        oidset.save()
+        g3 = ConfigGeneration.current()
+        self.assertTrue(g3 > g2)
+        self.assertEqual(Device.objects.get(name="rtr_a").generation, g3)
+        self.assertTrue(Device.objects.get(name="rtr_b").generation <= g1)
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeOIDSet(object):
+    def __init__(self, name, oids, poller_args):
+        self.name = name
+        self.frequency = 30
+        self.poller_args = poller_args
+        self.oids = FakeObject(all=lambda: [FakeObject(name=o) for o in oids])
+
+class TestOIDSetChanged(TestCase):
+    def _oidset(self, oids, poller_args=None, frequency=30):
+        oidset = FakeOIDSet('FastPollHC', oids, poller_args)
+        oidset.poller_id = 1
+        oidset.frequency = frequency
+        return oidset
+
+    def test_oidset_changed(self):
+        old = self._oidset(['ifHCInOctets', 'ifHCOutOctets'])
+        poller = FakeObject(oidset=old, oids=list(old.oids.all()))
+
+        self.assertFalse(oidset_changed(poller,
+            self._oidset(['ifHCInOctets', 'ifHCOutOctets'])))
+        self.assertTrue(oidset_changed(poller,
+            self._oidset(['ifHCInOctets'])))
+        self.assertTrue(oidset_changed(poller,
+            self._oidset(['ifHCInOctets', 'ifHCOutOctets'], frequency=60)))
+        self.assertTrue(oidset_changed(poller,
+            self._oidset(['ifHCInOctets', 'ifHCOutOctets'],
+                poller_args='aggregates=30')))
+
+class FakeSession(object):
+    """Answers the GETs and walks of a poller from canned tables."""
+    def __init__(self):
+        self.uptime = 1000
+        self.last_changed = 10
+        self.ifnames = {'1': 'xe-0/0/0', '2': 'xe-0/0/1'}
+        self.walked = []
+
+    def get(self, device, oids, callback, errback):
+        callback([('sysUpTime.0', self.uptime),
+            ('ifTableLastChanged.0', self.last_changed)])
+
+    def bulkwalk(self, device, oids, callback, errback):
+        self.walked.append(list(oids))
+        data = []
+        for oid in oids:
+            for ifIndex, ifName in sorted(self.ifnames.items()):
+                if oid == 'ifName':
+                    val = ifName
+                elif oid == 'ifAlias':
+                    val = 'alias ' + ifName
+                else:
+                    val = 100
+                data.append(('%s.%s' % (oid, ifIndex), val))
+        callback(data)
+
+class FakePersistQueue(list):
+    def put(self, pr):
+        self.append(pr)
+
+class TestCorrelatedPoller(TestCase):
+    def setUp(self):
+        self.session = FakeSession()
+        self.persistq = FakePersistQueue()
+        self.poller = CorrelatedPoller(
+                FakeObject(poll_correlator_refresh=600),
+                FakeObject(name='rtr_a'),
+                FakeOIDSet('FastPollHC', ['ifHCInOctets'],
+                    'correlator=IfNameCorrelator'),
+                self.session, self.persistq)
+
+    def _poll(self):
+        self.poller.next_poll = 0
+        self.poller.run_once()
+        return self.session.walked[-1], \
+            sorted([name for name, val in self.persistq[-1].data])
+
+    def test_refresh(self):
+        full = ['ifHCInOctets', 'ifName', 'ifAlias']
+        names = [['ifHCInOctets', 'xe-0/0/0'], ['ifHCInOctets', 'xe-0/0/1']]
+
+        # the tables are walked on the first poll and then cached
+        self.assertEqual(self._poll(), (full, names))
+        self.assertFalse(self.poller.refresh)
+        self.assertEqual(self._poll(), (['ifHCInOctets'], names))
+        self.assertEqual(self.poller.poll_oids, ['ifHCInOctets'])
+
+        # the device restarted
+        self.session.uptime = 5
+        self.assertEqual(self._poll()[0], full)
+        self.session.uptime = 1000
+        self.assertEqual(self._poll()[0], ['ifHCInOctets'])
+
+        # the interfaces changed
+        self.session.last_changed = 11
+        self.session.ifnames['1'] = 'xe-9/0/0'
+        self.assertEqual(self._poll(), (full,
+            [['ifHCInOctets', 'xe-0/0/1'], ['ifHCInOctets', 'xe-9/0/0']]))
+        self.assertEqual(self._poll()[0], ['ifHCInOctets'])
+
+        # the tables are refreshed periodically regardless
+        self.poller.next_refresh = time.time() - 1
+        self.assertEqual(self._poll()[0], full)
+        self.assertTrue(self.poller.next_refresh > time.time() + 500)
+        self.assertEqual(self._poll()[0], ['ifHCInOctets'])
+
+        # an unknown ifIndex is skipped and the tables walked next time
+        self.session.ifnames['3'] = 'xe-0/0/2'
+        walked, names = self._poll()
+        self.assertEqual(walked, ['ifHCInOctets'])
+        self.assertEqual(len(names), 2)
+        self.assertTrue(self.poller.refresh)
+        walked, names = self._poll()
+        self.assertEqual(walked, full)
+        self.assertTrue(['ifHCInOctets', 'xe-0/0/2'] in names)
+        self.assertFalse(self.poller.refresh)
+
+class RecordingPersistQueue(object):
+    """Stands in for MemcachedPersistQueue, records what is put on it."""
+    received = {}
+
+    def __init__(self, qname, uri):
+        self.qname = qname
+
+    def put_multi(self, results):
+        self.received.setdefault(self.qname, []).extend(results)
+
+class TestPersistThread(TestCase):
+    def setUp(self):
+        RecordingPersistQueue.received.clear()
+
+    def test_worker_routing(self):
+        config = FakeObject(espolld_persist_batch=100,
+                espoll_persist_uri=['MemcachedPersistHandler:127.0.0.1:11211'],
+                persist_queues={'cassandra': ('CassandraPollPersister', 4)},
+                persist_map={'fastpollhc': ['cassandra']})
+
+        def result(device, nvars):
+            return PollResult('FastPollHC', device, 'ifHCInOctets',
+                    time.time(), [[['ifHCInOctets', str(i)], i]
+                        for i in range(nvars)], {})
+
+        with mock.patch('esmond.persist.MemcachedPersistQueue',
+                RecordingPersistQueue):
+            threads = [PersistThread('espolld.persist_client_%d' % i,
+                config, Queue.Queue()) for i in (1, 2)]
+
+        # each thread sees a different mix of devices before rtr_x
+        for i in range(20):
+            threads[0].persistq.put(result('rtr_%d' % i, 10))
+        threads[0].persistq.put(result('rtr_x', 1))
+        threads[1].persistq.put(result('rtr_y', 100))
+        threads[1].persistq.put(result('rtr_x', 1))
+
+        for t in threads:
+            t.persister.put_multi(t.next_batch())
+
+        received = RecordingPersistQueue.received
+        self.assertTrue(len(received) > 1)
+        self.assertEqual(sum([len(r) for r in received.values()]), 23)
+
+        queues = [qname for qname, results in received.items()
+                if 'rtr_x' in [r.device_name for r in results]]
+        self.assertEqual(len(queues), 1)
+        self.assertEqual(len([r for r in received[queues[0]]
+            if r.device_name == 'rtr_x']), 2)
@@ -0,0 +1,97 @@
+"""
+Token buckets kept in the Django cache.
+
+A bucket holds up to size tokens and refills at rate tokens a second.  A
+request is let through if the bucket has enough tokens for its cost and
+they are taken out.  The state of each bucket is stored in the default
+cache, which is memcached when api_throttle_memcached is set, so all of
+the WSGI workers, and all of the hosts using the same memcached, draw from
+the same buckets.  The bulk throttle doesn't use a bucket without it, with
+the default local memory cache each worker process would have buckets of
+its own.
+
+The bucket is kept as counters of the tokens spent in fixed windows of
+size / rate seconds, the time an empty bucket takes to fill up again.  The
+tokens spent are those of the current window plus the share of the
+previous window that hasn't been refilled yet, assuming it was spent
+evenly.  The counters are only changed with cache.add(), incr() and
+decr(), which are atomic in memcached, so concurrent requests from the
+same client can't both spend the same tokens.
+"""
+
+import math
+import time
+
+from django.core.cache import cache as default_cache
+
+class TokenBucket(object):
+    cache = default_cache
+    timer = time.time
+
+    def __init__(self, size, rate, prefix='esmond_bucket'):
+        self.size = size
+        self.rate = float(rate)
+        self.prefix = prefix
+
+    def _key(self, ident, window):
+        return '{0}_{1}_{2}'.format(self.prefix, ident, window)
+
+    def _window_length(self):
+        return self.size / self.rate
+
+    def _window(self, now):
+        """The current window and the share of the previous window's tokens
+        that are still spent."""
+        length = self._window_length()
+        window = int(now // length)
+        return window, 1 - (now - window * length) / length
+
+    def _timeout(self):
+        """Long enough for a counter to be the previous window."""
+        return int(math.ceil(2 * self._window_length())) + 1
+
+    def tokens(self, ident):
+        """The number of tokens in the bucket for ident right now."""
+        window, weight = self._window(self.timer())
+        spent = self.cache.get(self._key(ident, window - 1), 0) * weight + \
+            self.cache.get(self._key(ident, window), 0)
+        return max(0, self.size - spent)
+
+    def consume(self, ident, cost):
+        """
+        Take cost tokens from the bucket for ident.  Returns 0 if they were
+        taken, otherwise the number of seconds until the bucket will have
+        enough tokens (nothing is taken in that case).
+        """
+        # the cache can only count in integers
+        cost = int(math.ceil(cost))
+        now = self.timer()
+        window, weight = self._window(now)
+        key = self._key(ident, window)
+
+        self.cache.add(key, 0, self._timeout())
+        try:
+            current = self.cache.incr(key, cost)
+        except ValueError:
+            # evicted since the add
+            self.cache.set(key, cost, self._timeout())
+            current = cost
+
+        previous = self.cache.get(self._key(ident, window - 1), 0)
+        excess = previous * weight + current - self.size
+        if excess <= 0:
+            return 0
+
+        self.cache.decr(key, cost)
+        current -= cost
+
+        # wait for enough of the previous window to be refilled
+        length = self._window_length()
+        if previous * weight >= excess:
+            return excess * length / previous
+
+        # or for the next window and enough of this one
+        wait = (window + 1) * length - now
+        if current + cost > self.size:
+            wait += (current + cost - self.size) * length / current
+        return wait
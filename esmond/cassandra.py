@@ -87,6 +87,9 @@ class CASSANDRA_DB(object):
     stat_cf = 'stat_aggregations'
     
     _queue_size = 200
+
+    # keyspaces whose schema has been checked in this process
+    _schema_checked = set()
     
     def __init__(self, config, qname=None):
         """
@@ -127,6 +130,70 @@ class CASSANDRA_DB(object):
         else:
             self.keyspace = config.cassandra_keyspace
 
+        # Only check the schema once per keyspace per process.  Workers
+        # forked from a pre-fork espersistd manager inherit this.
+        if config.db_clear_on_testing or \
+                self.keyspace not in CASSANDRA_DB._schema_checked:
+            self._check_schema(config)
+            CASSANDRA_DB._schema_checked.add(self.keyspace)
+
+        # Now, set up the ConnectionPool
+        
+        # Read auth information from config file and set up if need be.
+        _creds = {}
+        if config.cassandra_user and config.cassandra_pass:
+            _creds['username'] = config.cassandra_user
+            _creds['password'] = config.cassandra_pass
+            self.log.debug('Connecting with username: %s' % (config.cassandra_user,))
+        
+        try:
+            self.log.debug('Opening ConnectionPool')
+            self.pool = ConnectionPool(self.keyspace, 
+                server_list=config.cassandra_servers, 
+                pool_size=10,
+                max_overflow=5,
+                max_retries=10,
+                timeout=30,
+                credentials=_creds)
+        except AllServersUnavailable, e:
+            raise ConnectionException("Couldn't connect to any Cassandra "
+                    "at %s - %s" % (config.cassandra_servers, e))
+                    
+        self.log.info('Connected to %s' % config.cassandra_servers)
+        
+        # Define column family connections for the code to use.
+        self.column_families = {
+            'raw': ColumnFamily(self.pool, self.raw_cf),
+            'rate': ColumnFamily(self.pool, self.rate_cf),
+            'aggs': ColumnFamily(self.pool, self.agg_cf),
+            'stat': ColumnFamily(self.pool, self.stat_cf)
+        }
+        self._make_batches(self._queue_size)
+        
+        # Timing - this turns the database call profiling code on and off.
+        # This is not really meant to be used in production and generally 
+        # just spits out statistics at the end of a run of test data.  Mostly
+        # useful for timing specific database calls to aid in development.
+        self.profiling = False
+        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
+            self.profiling = True
+        self.stats = DatabaseMetrics(profiling=self.profiling)
+        
+        # Class members
+        # Just the dict for the metadata cache.
+        self.metadata_cache = {}
+        self.aggregation_cache = {}
+
+        # Adaptive batching - see set_batch_size()
+        self.batch_size = self._queue_size
+        self.coalesce = False
+        self.counter_buffer = {}
+        
+    def _check_schema(self, config):
+        """
+        Connect to cassandra with SystemManager, do a schema check
+        and set up schema components if need be.
+        """
         try:
             sysman = SystemManager(config.cassandra_servers[0])                              
         except TTransportException, e:
@@ -203,59 +270,7 @@ class CASSANDRA_DB(object):
             self.log.info("Waiting for schema to propagate...")
             time.sleep(10)
             self.log.info("Done")
-                
-        # Now, set up the ConnectionPool
-        
-        # Read auth information from config file and set up if need be.
-        _creds = {}
-        if config.cassandra_user and config.cassandra_pass:
-            _creds['username'] = config.cassandra_user
-            _creds['password'] = config.cassandra_pass
-            self.log.debug('Connecting with username: %s' % (config.cassandra_user,))
-        
-        try:
-            self.log.debug('Opening ConnectionPool')
-            self.pool = ConnectionPool(self.keyspace, 
-                server_list=config.cassandra_servers, 
-                pool_size=10,
-                max_overflow=5,
-                max_retries=10,
-                timeout=30,
-                credentials=_creds)
-        except AllServersUnavailable, e:
-            raise ConnectionException("Couldn't connect to any Cassandra "
-                    "at %s - %s" % (config.cassandra_servers, e))
-                    
-        self.log.info('Connected to %s' % config.cassandra_servers)
-        
-        # Define column family connections for the code to use.
-        self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
-        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
-        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
-        self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
 
-        # Used when a cf needs to be selected on the fly.
-        self.cf_map = {
-            'raw': self.raw_data,
-            'rate': self.rates,
-            'aggs': self.aggs,
-            'stat': self.stat_agg
-        }
-        
-        # Timing - this turns the database call profiling code on and off.
-        # This is not really meant to be used in production and generally 
-        # just spits out statistics at the end of a run of test data.  Mostly
-        # useful for timing specific database calls to aid in development.
-        self.profiling = False
-        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
-            self.profiling = True
-        self.stats = DatabaseMetrics(profiling=self.profiling)
-        
-        # Class members
-        # Just the dict for the metadata cache.
-        self.metadata_cache = {}
-        self.aggregation_cache = {}
-        
     def flush(self):
         """
         Calling this will explicity flush all the batches to the 
@@ -263,11 +278,72 @@ class CASSANDRA_DB(object):
         in production when the batches will be self-flushing.
         """
         self.log.debug('Flush called')
+        self._drain_counters()
         self.raw_data.send()
         self.rates.send()
         self.aggs.send()
         self.stat_agg.send()
         
+    def _make_batches(self, size):
+        """Create the batch mutators that size mutations are queued in."""
+        self.raw_data = self.column_families['raw'].batch(size)
+        self.rates    = self.column_families['rate'].batch(size)
+        self.aggs     = self.column_families['aggs'].batch(size)
+        self.stat_agg = self.column_families['stat'].batch(size)
+
+        # Used when a cf needs to be selected on the fly.
+        self.cf_map = {
+            'raw': self.raw_data,
+            'rate': self.rates,
+            'aggs': self.aggs,
+            'stat': self.stat_agg
+        }
+
+    def set_batch_size(self, size, coalesce=False):
+        """
+        Change how many mutations are queued before a batch is sent to
+        the server.  Called by the persister as its backlog grows and
+        shrinks.
+
+        If coalesce is true, increments to the same counter column are
+        summed in memory and only queued when the number of distinct
+        counter columns reaches the batch size (or on flush()).  This 
+        saves a lot of mutations when a backlog contains consecutive
+        polls of the same devices.
+        """
+        if self.coalesce and not coalesce:
+            self._drain_counters()
+        self.coalesce = coalesce
+
+        if size != self.batch_size:
+            # The mutators can't be resized, so send what is queued on
+            # them and start new ones.
+            for mutator in (self.raw_data, self.rates, self.aggs, self.stat_agg):
+                mutator.send()
+            self._make_batches(size)
+            self.batch_size = size
+
+    def _coalesce_counters(self, cf, key, ts, counters):
+        """
+        Sum counter increments for the super column ts of row key in
+        the counter buffer, draining it to the batches when it is full.
+        """
+        bin_counters = self.counter_buffer.setdefault((cf, key, ts), {})
+        for k, v in counters.iteritems():
+            bin_counters[k] = bin_counters.get(k, 0) + v
+
+        if len(self.counter_buffer) >= self.batch_size:
+            self._drain_counters()
+
+    def _drain_counters(self):
+        """
+        Move the coalesced counter increments into the batches.
+        """
+        buf = self.counter_buffer
+        self.counter_buffer = {}
+        for (cf, key, ts), counters in buf.iteritems():
+            self.cf_map[cf].insert(key, {ts: counters})
+
     def close(self):
         """
         Explicitly close the connection pool.
@@ -381,8 +457,13 @@ class CASSANDRA_DB(object):
         t = time.time()
         # A super column insert.  Both val and is_valid are counter types.
         try:
-            self.rates.insert(ratebin.get_key(),
-                {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
+            if self.coalesce:
+                self._coalesce_counters('rate', ratebin.get_key(),
+                    ratebin.ts_to_jstime(),
+                    {'val': ratebin.val, 'is_valid': ratebin.is_valid})
+            else:
+                self.rates.insert(ratebin.get_key(),
+                    {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
         except MaximumRetryException:
             self.log.warn("update_rate_bin failed. MaximumRetryException")
 
@@ -407,8 +488,12 @@ class CASSANDRA_DB(object):
         # name key that is not 'val' - this will be used by the query interface
         # to generate the averages.  Both values are counter types.
         try:
-            self.aggs.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
+            if self.coalesce:
+                self._coalesce_counters('aggs', agg.get_key(),
+                    agg.ts_to_jstime(), {'val': agg.val, str(agg.base_freq): 1})
+            else:
+                self.aggs.insert(agg.get_key(),
+                    {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
         except MaximumRetryException:
             self.log.warn("update_rate_aggregation failed. MaximumRetryException")
 
@@ -581,27 +666,61 @@ class CASSANDRA_DB(object):
 
         return found
         
-    def query_baserate_timerange(self, path=None, freq=None, 
-            ts_min=None, ts_max=None, cf='average', column_count=None):
+    def _multiget_paths(self, col_fam, paths, freq, ts_min, ts_max, column_count=None):
         """
-        Query interface method to retrieve the base rates (generally average 
-        but could be delta as well).
+        Fetch the rows for several paths with the same frequency and time 
+        range in one multiget.
+
+        Returns a list with one list of (row key, columns) per path, in 
+        the order of paths.
         """
+        keys = []
+        key_paths = {}
+
+        for i, path in enumerate(paths):
+            for key in self._get_row_keys(path, freq, ts_min, ts_max):
+                if key not in key_paths:
+                    key_paths[key] = []
+                    keys.append(key)
+                key_paths[key].append(i)
+
         cols = column_count
         if cols is None:
-            ret_count = self.rates._column_family.multiget_count(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in ret_count.keys():
-                cols += ret_count[i]
-            cols += 5
+            # column_count is applied to each row
+            ret_count = col_fam._column_family.multiget_count(keys,
+                    column_start=ts_min, column_finish=ts_max)
+            cols = max(ret_count.values() or [0]) + 5
 
-        ret = self.rates._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
+        ret = col_fam._column_family.multiget(keys,
                 column_start=ts_min, column_finish=ts_max,
                 column_count=cols)
-        
+
+        rows = [[] for path in paths]
+
+        for k,v in ret.items():
+            for i in key_paths[k]:
+                rows[i].append((k, v))
+
+        return rows
+
+    def query_baserate_timerange(self, path=None, freq=None, 
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Query interface method to retrieve the base rates (generally average 
+        but could be delta as well).
+        """
+        return self.query_baserate_timerange_multi(paths=[path], freq=freq,
+                ts_min=ts_min, ts_max=ts_max, cf=cf,
+                column_count=column_count)[0]
+
+    def query_baserate_timerange_multi(self, paths=None, freq=None, 
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Retrieve the base rates for a list of paths with the same frequency 
+        and time range in a single round of queries.  Returns a list of 
+        results (as returned by query_baserate_timerange) in the order of 
+        paths.
+        """
         if cf not in ['average', 'delta']:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
@@ -611,14 +730,18 @@ class CASSANDRA_DB(object):
         value_divisors = { 'average': int(freq/1000), 'delta': 1 }
         
         # Just return the results and format elsewhere.
-        results = []
-        
-        for k,v in ret.items():
-            for kk,vv in v.items():
-                results.append({'ts': kk, 'val': float(vv['val']) / value_divisors[cf], 
-                                        'is_valid': vv['is_valid']})
+        ret = []
+
+        for rows in self._multiget_paths(self.rates, paths, freq, ts_min,
+                ts_max, column_count):
+            results = []
+            for k,v in rows:
+                for kk,vv in v.items():
+                    results.append({'ts': kk, 'val': float(vv['val']) / value_divisors[cf], 
+                                            'is_valid': vv['is_valid']})
+            ret.append(results)
             
-        return results
+        return ret
 
     def query_aggregation_timerange(self, path=None, freq=None, 
                 ts_min=None, ts_max=None, cf=None, column_count=None):
@@ -627,78 +750,67 @@ class CASSANDRA_DB(object):
         be average/min/max.  Different column families will be queried 
         depending on what value "cf" is set to.
         """
+        return self.query_aggregation_timerange_multi(paths=[path], freq=freq,
+                ts_min=ts_min, ts_max=ts_max, cf=cf,
+                column_count=column_count)[0]
+
+    def query_aggregation_timerange_multi(self, paths=None, freq=None, 
+                ts_min=None, ts_max=None, cf=None, column_count=None):
+        """
+        Retrieve the aggregation rollups for a list of paths with the same 
+        frequency and time range in a single round of queries.  Returns a 
+        list of results (as returned by query_aggregation_timerange) in the 
+        order of paths.
+        """
                 
         if cf not in AGG_TYPES:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
         
+        ret = []
+
         if cf == 'average' or cf == 'raw':
-            cols = column_count
-            if cols is None:
-                ret_count = self.aggs._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            # print cols
-            ret = self.aggs._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-
-            # Just return the results and format elsewhere.
-            results = []
-            
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    val = None
-                    base_freq = None
-                    count = None
-                    for kkk in vv.keys():
-                        if kkk == 'val':
-                            val = vv[kkk]
+            for rows in self._multiget_paths(self.aggs, paths, freq, ts_min,
+                    ts_max, column_count):
+                # Just return the results and format elsewhere.
+                results = []
+                
+                for k,v in rows:
+                    for kk,vv in v.items():
+                        ts = kk
+                        val = None
+                        base_freq = None
+                        count = None
+                        for kkk in vv.keys():
+                            if kkk == 'val':
+                                val = vv[kkk]
+                            else:
+                                base_freq = kkk
+                                count = vv[kkk]
+                        ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
+                        if cf == 'average':
+                            datum = {'ts': ts, 'val': ab.average, 'cf': ab.cf}
                         else:
-                            base_freq = kkk
-                            count = vv[kkk]
-                    ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
-                    if cf == 'average':
-                        datum = {'ts': ts, 'val': ab.average, 'cf': ab.cf}
-                    else:
-                        datum = {'ts': ts, 'val': ab.val, 'cf': ab.cf}
-                    results.append(datum)
-        elif cf == 'min' or cf == 'max':
-            cols = column_count
-            if cols is None:
-                ret_count = self.stat_agg._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            ret = self.stat_agg._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-            
-            results = []
-
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    if cf == 'min':
-                        datum = {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
-                        results.append(datum)
-                    else:
-                        datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
+                            datum = {'ts': ts, 'val': ab.val, 'cf': ab.cf}
                         results.append(datum)
+                ret.append(results)
+        elif cf == 'min' or cf == 'max':
+            for rows in self._multiget_paths(self.stat_agg, paths, freq, ts_min,
+                    ts_max, column_count):
+                results = []
+
+                for k,v in rows:
+                    for kk,vv in v.items():
+                        ts = kk
+                        if cf == 'min':
+                            datum = {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
+                            results.append(datum)
+                        else:
+                            datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
+                            results.append(datum)
+                ret.append(results)
         
-        return results
+        return ret
             
     def query_raw_data(self, path=None, freq=None,
                 ts_min=None, ts_max=None, column_count=None):
@@ -49,10 +49,19 @@ class EsmondConfig(object):
 
         self.agg_tsdb_root = None
         self.allowed_hosts = []
+        self.api_anon_bulk_points = 100000
+        self.api_anon_bulk_rate = 100
         self.api_anon_limit = None
+        self.api_bulk_concurrency = 4
+        self.api_bulk_deadline = 30
+        self.api_bulk_threads = 8
+        self.api_cache_max_age = 0
+        self.api_closed_range_delay = 3600
+        self.api_stream_threshold = 10000
         self.api_throttle_at = None
         self.api_throttle_timeframe = None
         self.api_throttle_expiration = None
+        self.api_throttle_memcached = None
         self.cassandra_keyspace = 'esmond'
         self.cassandra_pass = None
         self.cassandra_servers = []
@@ -67,13 +76,27 @@ class EsmondConfig(object):
         self.error_email_subject = None
         self.error_email_to = None
         self.esdb_uri = None
+        self.espersistd_prefork = False
+        self.espolld_persist_batch = 100
+        self.espolld_persist_threads = 1
+        self.espolld_shards = 1
         self.espersistd_uri = None
         self.espoll_persist_uri = None
         self.htpasswd_file = None
         self.mib_dirs = []
         self.mibs = []
+        self.persist_batch_size_max = 5000
+        self.persist_batch_size_min = 200
+        self.persist_max_latency = 30
         self.pid_dir = None
+        self.poll_concurrent_walks = 3
+        self.poll_correlator_refresh = 600
+        self.poll_maxrepetitions = 25
+        self.poll_maxrepetitions_max = 100
+        self.poll_maxrepetitions_min = 5
         self.poll_retries = 5
+        self.poll_stats_file = None
+        self.poll_stats_interval = 60
         self.poll_timeout = 2
         self.profile_persister = False
         self.reload_interval = 1*10
@@ -110,10 +133,19 @@ class EsmondConfig(object):
         for opt in (
                 'agg_tsdb_root',
                 'allowed_hosts',
+                'api_anon_bulk_points',
+                'api_anon_bulk_rate',
                 'api_anon_limit',
+                'api_bulk_concurrency',
+                'api_bulk_deadline',
+                'api_bulk_threads',
+                'api_cache_max_age',
+                'api_closed_range_delay',
+                'api_stream_threshold',
                 'api_throttle_at',
                 'api_throttle_timeframe',
                 'api_throttle_expiration',
+                'api_throttle_memcached',
                 'cassandra_pass',
                 'cassandra_servers',
                 'cassandra_user',
@@ -124,13 +156,27 @@ class EsmondConfig(object):
                 'error_email_subject',
                 'error_email_to',
                 'esdb_uri',
+                'espersistd_prefork',
                 'espersistd_uri',
+                'espolld_persist_batch',
+                'espolld_persist_threads',
+                'espolld_shards',
                 'espoll_persist_uri',
                 'htpasswd_file',
                 'mib_dirs',
                 'mibs',
+                'persist_batch_size_max',
+                'persist_batch_size_min',
+                'persist_max_latency',
                 'pid_dir',
+                'poll_concurrent_walks',
+                'poll_correlator_refresh',
+                'poll_maxrepetitions',
+                'poll_maxrepetitions_max',
+                'poll_maxrepetitions_min',
                 'poll_retries',
+                'poll_stats_file',
+                'poll_stats_interval',
                 'poll_timeout',
                 'profile_persister',
                 'reload_interval',
@@ -155,6 +201,7 @@ class EsmondConfig(object):
             'db_profile_on_testing',
             'profile_persister',
             'debug',
+            'espersistd_prefork',
         )
 
         for key, val in cfg.items('main'):
@@ -166,12 +213,22 @@ class EsmondConfig(object):
             if key == 'esmond_root': continue
             self.persist_map[key] = val.replace(" ", "").split(",")
 
+        self.poll_concurrent_walks_map = {}
+        if cfg.has_section("poll_concurrent_walks"):
+            for key, val in cfg.items("poll_concurrent_walks"):
+                if key == 'esmond_root': continue
+                self.poll_concurrent_walks_map[key] = int(val)
+
         self.persist_queues = {}
         for key, val in cfg.items("persist_queues"):
             if key == 'esmond_root': continue
             self.persist_queues[key] = val.split(':', 1)
             self.persist_queues[key][1] = int(self.persist_queues[key][1])
 
+        if self.api_throttle_memcached:
+            self.api_throttle_memcached = \
+                self.api_throttle_memcached.replace(' ', '').split(',')
+
         if self.espoll_persist_uri:
             self.espoll_persist_uri = \
                 self.espoll_persist_uri.replace(' ', '').split(',')
@@ -193,10 +250,50 @@ class EsmondConfig(object):
             self.poll_timeout = int(self.poll_timeout)
         if self.poll_retries:
             self.poll_retries = int(self.poll_retries)
+        if self.poll_stats_interval:
+            self.poll_stats_interval = int(self.poll_stats_interval)
+        if self.poll_concurrent_walks:
+            self.poll_concurrent_walks = int(self.poll_concurrent_walks)
+        if self.poll_correlator_refresh:
+            self.poll_correlator_refresh = int(self.poll_correlator_refresh)
+        if self.poll_maxrepetitions:
+            self.poll_maxrepetitions = int(self.poll_maxrepetitions)
+        if self.poll_maxrepetitions_max:
+            self.poll_maxrepetitions_max = int(self.poll_maxrepetitions_max)
+        if self.poll_maxrepetitions_min:
+            self.poll_maxrepetitions_min = int(self.poll_maxrepetitions_min)
         if self.reload_interval:
             self.reload_interval = int(self.reload_interval)
+        if self.espolld_persist_batch:
+            self.espolld_persist_batch = int(self.espolld_persist_batch)
+        if self.espolld_persist_threads:
+            self.espolld_persist_threads = int(self.espolld_persist_threads)
+        if self.espolld_shards:
+            self.espolld_shards = int(self.espolld_shards)
+        if self.persist_batch_size_max:
+            self.persist_batch_size_max = int(self.persist_batch_size_max)
+        if self.persist_batch_size_min:
+            self.persist_batch_size_min = int(self.persist_batch_size_min)
+        if self.persist_max_latency:
+            self.persist_max_latency = int(self.persist_max_latency)
+        if self.api_anon_bulk_points:
+            self.api_anon_bulk_points = int(self.api_anon_bulk_points)
+        if self.api_anon_bulk_rate:
+            self.api_anon_bulk_rate = int(self.api_anon_bulk_rate)
         if self.api_anon_limit:
             self.api_anon_limit = int(self.api_anon_limit)
+        if self.api_bulk_concurrency:
+            self.api_bulk_concurrency = int(self.api_bulk_concurrency)
+        if self.api_bulk_deadline:
+            self.api_bulk_deadline = int(self.api_bulk_deadline)
+        if self.api_bulk_threads:
+            self.api_bulk_threads = int(self.api_bulk_threads)
+        if self.api_cache_max_age:
+            self.api_cache_max_age = int(self.api_cache_max_age)
+        if self.api_closed_range_delay:
+            self.api_closed_range_delay = int(self.api_closed_range_delay)
+        if self.api_stream_threshold:
+            self.api_stream_threshold = int(self.api_stream_threshold)
         if self.api_throttle_at:
              self.api_throttle_at = int(self.api_throttle_at)
         if self.api_throttle_timeframe:
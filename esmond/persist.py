@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import logging
+import copy
 import os
 import os.path
 import sys
@@ -9,6 +10,12 @@ import signal
 import errno
 import datetime
 import cProfile
+import multiprocessing
+import shutil
+import tempfile
+import zlib
+import hashlib
+import struct
 import pstats
 import __main__
 
@@ -20,6 +27,7 @@ import cPickle as pickle
 import json
 
 import django
+from django.db import transaction
 from django.utils.timezone import now, utc, make_aware
 
 try:
@@ -108,9 +116,45 @@ class PollResult(object):
 class PersistQueueEmpty:
     pass
 
+class AdaptiveBatchPolicy(object):
+    """Chooses a write batch size from the depth of the persist queue.
+
+    The batch size doubles while the queue is backlogged and halves once
+    it is nearly empty again, staying between ``min_size`` and
+    ``max_size``.
+    """
+    GROW_DEPTH = 50
+    SHRINK_DEPTH = 5
+
+    def __init__(self, min_size, max_size):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = min_size
+        self.resizes = 0
+
+    def update(self, depth):
+        """Returns True if the batch size changed."""
+        size = self.size
+        if depth >= self.GROW_DEPTH:
+            size = min(size * 2, self.max_size)
+        elif depth <= self.SHRINK_DEPTH:
+            size = max(size / 2, self.min_size)
+
+        if size == self.size:
+            return False
+
+        self.size = size
+        self.resizes += 1
+        return True
+
+    @property
+    def backlogged(self):
+        return self.size > self.min_size
+
 class PollPersister(object):
     """A PollPersister implements a storage method for PollResults."""
     STATS_INTERVAL = 60
+    DEPTH_CHECK_INTERVAL = 1
 
     def __init__(self, config, qname, persistq):
         self.log = get_logger("espersistd.%s" % qname)
@@ -123,10 +167,18 @@ class PollPersister(object):
             self.persistq = persistq
         else:
             self.persistq = MemcachedPersistQueue(qname, config.espersistd_uri)
+            self.persistq.advertise_formats()
 
         self.data_count = 0
         self.last_stats = time.time()
 
+        self.batch_policy = AdaptiveBatchPolicy(config.persist_batch_size_min,
+                config.persist_batch_size_max)
+        self.queue_depth = 0
+        self.last_depth_check = 0
+        self.last_flush = time.time()
+        self.latency_flushes = 0
+
     def store(self, result):
         pass
 
@@ -135,6 +187,48 @@ class PollPersister(object):
         some maintenance during a sleep state."""
         pass
 
+    def set_batch_size(self, size, coalesce):
+        """Can be overridden in subclasses which batch their writes."""
+        pass
+
+    def _flush(self, now):
+        self.flush()
+        self.last_flush = now
+
+    def _check_latency(self, now):
+        """Make sure nothing waits in a batch for longer than
+        ``persist_max_latency``."""
+        if now - self.last_flush > self.config.persist_max_latency:
+            self._flush(now)
+            self.latency_flushes += 1
+
+    def _adjust_batching(self, now):
+        """Resize batches based on the queue depth and check the batch
+        latency."""
+        self._check_latency(now)
+
+        if now < self.last_depth_check + self.DEPTH_CHECK_INTERVAL:
+            return
+        self.last_depth_check = now
+
+        try:
+            self.queue_depth = len(self.persistq)
+        except TypeError:
+            return
+
+        if self.batch_policy.update(self.queue_depth):
+            self.log.debug("queue depth %d, batch size now %d" %
+                    (self.queue_depth, self.batch_policy.size))
+            self.set_batch_size(self.batch_policy.size,
+                    self.batch_policy.backlogged)
+
+    def batch_stats(self):
+        return dict(batch_size=self.batch_policy.size,
+                coalesce=self.batch_policy.backlogged,
+                resizes=self.batch_policy.resizes,
+                latency_flushes=self.latency_flushes,
+                queue_depth=self.queue_depth)
+
     def stop(self, x, y):
         self.log.debug("stop")
         self.running = False
@@ -153,6 +247,7 @@ class PollPersister(object):
             try:
                 task = self.persistq.get()
             except PersistQueueEmpty:
+                self._flush(time.time())
                 break
 
             # XXX(jdugan): task can be None for two reasons here:
@@ -165,20 +260,32 @@ class PollPersister(object):
                 self.store(task)
                 self.data_count += len(task.data)
                 now = time.time()
+                self._adjust_batching(now)
                 if now > self.last_stats + self.STATS_INTERVAL:
-                    self.log.info("%d records written, %f records/sec" % \
+                    bstats = self.batch_stats()
+                    self.log.info("%d records written, %f records/sec, "
+                            "batch size %d, %d resizes, %d latency flushes" % \
                             (self.data_count,
-                                float(self.data_count) / self.STATS_INTERVAL))
+                                float(self.data_count) / self.STATS_INTERVAL,
+                                bstats['batch_size'], bstats['resizes'],
+                                bstats['latency_flushes']))
+                    if hasattr(self.persistq, 'publish_stats'):
+                        self.persistq.publish_stats(bstats)
                     self.data_count = 0
                     self.last_stats = now
+                    if hasattr(self.persistq, 'advertise_formats'):
+                        # memcached may have been restarted
+                        self.persistq.advertise_formats()
                 del task
                 self.sleeping = False
             else:
                 if not self.sleeping:
-                    self.flush()
+                    self._flush(time.time())
                     self.sleeping = True
                     if self.config.debug:
                         django.db.reset_queries()
+                else:
+                    self._check_latency(time.time())
                 time.sleep(PERSIST_SLEEP_TIME)
 
         if self.config.profile_persister:
@@ -198,8 +305,8 @@ class StreamingPollPersister(PollPersister):
         Specifies the path name of the log file.
 
     """
-    def __init__(self, config, q):
-        PollPersister.__init__(self, config, q)
+    def __init__(self, config, qname, persistq):
+        PollPersister.__init__(self, config, qname, persistq)
 
         self.filename = None
         self.fd = None
@@ -433,6 +540,12 @@ class CassandraPollPersister(PollPersister):
         except MaximumRetryException:
             self.log.warn("flush failed. MaximumRetryException")
 
+    def set_batch_size(self, size, coalesce):
+        try:
+            self.db.set_batch_size(size, coalesce=coalesce)
+        except MaximumRetryException:
+            self.log.warn("set_batch_size failed. MaximumRetryException")
+
     def store(self, result):
         oidset = self.oidsets[result.oidset_name]
         set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
@@ -636,7 +749,60 @@ class CassandraPollPersister(PollPersister):
         
 
 class HistoryTablePersister(PollPersister):
-    """Provides common methods for table histories."""
+    """Provides common methods for table histories.
+
+    Subclasses set ``model`` and ``key`` and implement ``_build_objs()`` and
+    ``_new_row_from_obj()``.
+
+    A digest of the ``_build_objs()`` output is kept in memory for each
+    device and stored in the ``digest`` column of the device's active rows.
+    If a poll produces the same digest as the last applied state nothing
+    has changed and no SQL is done at all."""
+
+    model = None
+    key = None
+
+    # keep the number of parameters in a single statement reasonable
+    BULK_CHUNK_SIZE = 500
+
+    def __init__(self, config, qname, persistq):
+        PollPersister.__init__(self, config, qname, persistq)
+        self.digests = {}
+
+    def store(self, result):
+        t0 = time.time()
+        self.data = result.data
+
+        self.new_data = self._build_objs()
+        nvar = len(self.new_data)
+        self.digest = self._digest(self.new_data)
+
+        if self._unchanged(result.device_name, self.digest):
+            self.log.debug("processed %d vars [unchanged] in %f seconds: %s" % (
+                nvar, time.time() - t0, result))
+            return
+
+        self.device = Device.objects.active().get(name=result.device_name)
+        self.old_data = self.model.objects.active().filter(device=self.device)
+
+        adds, changes, deletes = self.update_db()
+        self.digests[result.device_name] = self.digest
+
+        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
+            nvar, adds, changes, deletes, time.time() - t0, result))
+
+    def _digest(self, objs):
+        return hashlib.sha1(json.dumps(objs, sort_keys=True)).hexdigest()
+
+    def _unchanged(self, device_name, digest):
+        if device_name not in self.digests:
+            # first time we've seen this device: pick up the digest
+            # stored with the rows, if any
+            stored = self.model.objects.active().filter(
+                    device__name=device_name).values_list('digest', flat=True)[:1]
+            self.digests[device_name] = stored[0] if stored else None
+
+        return self.digests[device_name] == digest
 
     def update_db(self):
         """Compare the database to the poll results and update.
@@ -644,13 +810,20 @@ class HistoryTablePersister(PollPersister):
         This assumes that the database object has a begin_time and end_time
         and that self.new_data has the dictionary representing the new data
         and that self.old_data contains the database objects representing the
-        old data.  It uses _new_row_from_dict() to create a new object when
-        needed."""
+        old data.  It uses _new_row_from_obj() to create a new object when
+        needed.
+
+        The differences are worked out in memory and then applied in a
+        single transaction: one bulk update to set end_time on the rows
+        that changed or went away and a bulk_create() for the new rows."""
 
         adds = 0
         changes = 0
         deletes = 0
 
+        expired = []
+        new_rows = []
+
         # iterate through what is currently in the database
         for old in self.old_data:
             # there is an entry in the new data: has anything changed?
@@ -672,47 +845,45 @@ class HistoryTablePersister(PollPersister):
                         break
 
                 if changed:
-                    old.end_time = now()
-                    old.save()
-                    new_row = self._new_row_from_obj(new)
-                    new_row.save()
+                    expired.append(old.pk)
+                    new_rows.append(self._new_row_from_obj(new))
                     changes += 1
 
                 del self.new_data[key]
             # no entry in self.new_data: interface is gone, update db
             else:
-                old.end_time = now()
-                old.save()
+                expired.append(old.pk)
                 deletes += 1
 
         # anything left in self.new_data is something new
         for new in self.new_data:
-            new_row = self._new_row_from_obj(self.new_data[new])
-            new_row.save()
+            new_rows.append(self._new_row_from_obj(self.new_data[new]))
             adds += 1
 
+        model = self.old_data.model
+        end_time = now()
+        with transaction.atomic():
+            for i in range(0, len(expired), self.BULK_CHUNK_SIZE):
+                model.objects.filter(
+                    pk__in=expired[i:i+self.BULK_CHUNK_SIZE]).update(
+                            end_time=end_time)
+
+            model.objects.bulk_create(new_rows,
+                    batch_size=self.BULK_CHUNK_SIZE)
+
+            digest = getattr(self, 'digest', None)
+            if digest:
+                model.objects.active().filter(device=self.device).update(
+                        digest=digest)
+
         return (adds, changes, deletes)
 
 
 class IfRefPollPersister(HistoryTablePersister):
     int_oids = ('ifSpeed', 'ifHighSpeed', 'ifMtu', 'ifType',
             'ifOperStatus', 'ifAdminStatus')
-
-    def store(self, result):
-        t0 = time.time()
-        self.data = result.data
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = IfRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'ifName'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = IfRef
+    key = 'ifName'
 
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
@@ -751,22 +922,8 @@ class IfRefPollPersister(HistoryTablePersister):
 
 class ALUSAPRefPersister(HistoryTablePersister):
     int_oids = ('sapIngressQosPolicyId', 'sapEgressQosPolicyId')
-
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = ALUSAPRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = ALUSAPRef
+    key = 'name'
 
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
@@ -795,24 +952,8 @@ class ALUSAPRefPersister(HistoryTablePersister):
         return objs
 
 class LSPOpStatusPersister(HistoryTablePersister):
-    def __init__(self, config, qname):
-        HistoryTablePersister.__init__(self, config, qname)
-
-    def store(self, result):
-        self.lsp_data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = LSPOpStatus.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = LSPOpStatus
+    key = 'name'
 
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
@@ -824,7 +965,7 @@ class LSPOpStatusPersister(HistoryTablePersister):
     def _build_objs(self):
         lsp_objs = {}
 
-        for k, entries in self.lsp_data.iteritems():
+        for k, entries in self.data.iteritems():
             for name, val in entries:
                 name = name.split('.')[-1].replace("'", "")
 
@@ -879,22 +1020,8 @@ class InfIfRefPollPersister(IfRefPollPersister):
 class SentryOutletRefPollPersister(HistoryTablePersister):
     """Save information about outlets for a Sentry PDU."""
     int_oids = ('outletStatus', 'outletControlState')
-
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = OutletRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'outletID'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = OutletRef
+    key = 'outletID'
 
     def _new_row_from_obj(self, obj):
         obj['device'] = self.device
@@ -955,6 +1082,34 @@ class PersistQueue(object):
         # return pickle.loads(val)
         return json.loads(val)
 
+class ListPersistQueue(PersistQueue):
+    """A PersistQueue over a list of PollResult dicts.
+
+    Used to feed a persister directly, eg. when replaying streaming logs.
+    Raises PersistQueueEmpty once the list is exhausted so that
+    PollPersister.run() returns."""
+    def __init__(self, qname, results):
+        super(ListPersistQueue, self).__init__(qname)
+        self.results = results
+        self.idx = 0
+
+    def get(self, block=False):
+        if self.idx >= len(self.results):
+            raise PersistQueueEmpty()
+
+        result = self.results[self.idx]
+        # let the memory go as we go
+        self.results[self.idx] = None
+        self.idx += 1
+
+        return PollResult(**result)
+
+    def put(self, val):
+        self.results.append(json.loads(self.serialize(val)))
+
+    def __len__(self):
+        return len(self.results) - self.idx
+
 class JsonSerializer(object):
     """This is passed to memcache.Client() to replace default use of 
     pickle to de/serialize."""
@@ -966,8 +1121,210 @@ class JsonSerializer(object):
     def dump(self, value):
         json.dump(value, self.file)
 
-    def load(self, value):
-        json.load(self.file)
+    def load(self):
+        return json.load(self.file)
+
+class PersistWireFormatError(Exception):
+    pass
+
+WIRE_FORMAT_JSON = 'json'
+WIRE_FORMAT_BINARY = 'bin1'
+WIRE_FORMATS = (WIRE_FORMAT_JSON, WIRE_FORMAT_BINARY)
+
+class PollResultCodec(object):
+    """Compact, versioned binary encoding of PollResults.
+
+    Only results whose ``data`` is a list of (path, value) pairs with
+    numeric (or None) values can be encoded, anything else is left to the
+    JSON serialization.  The paths are interned in a per device/oidset/oid
+    dictionary and each pair is sent as a (path id, value) pair.  A
+    dictionary is identified by the SHA1 digest of its contents, the
+    caller is expected to publish it under that digest (see
+    ``MemcachedPersistQueue``) whenever ``encode`` returns a new one.
+
+    Layout of an encoded result (all integers little endian)::
+
+        MAGIC, version (B), timestamp (d), dictionary digest (20s),
+        number of pairs (I), lengths of oidset_name, device_name,
+        oid_name and metadata (4H), the three names (UTF-8), metadata
+        (JSON), path ids (n * I), value type codes (n * c),
+        values (n * 8 bytes)
+    """
+    MAGIC = '\x00es'
+    VERSION = 1
+    # republish dictionaries periodically in case memcached evicted them
+    DICT_REFRESH_INTERVAL = 600
+
+    _header = struct.Struct('<Bd20sIHHHH')
+    _value_codes = {'Q': 'Q', 'q': 'q', 'd': 'd', 'n': '8x'}
+
+    def __init__(self):
+        # (device, oidset, oid) -> [paths, index, digest, last published]
+        self._interned = {}
+        # digest -> [list of paths, last used], used when decoding
+        self._dicts = {}
+        self._dicts_swept = time.time()
+
+    def _intern(self, result):
+        k = (result.device_name, result.oidset_name, result.oid_name)
+        entry = self._interned.get(k)
+        if entry is None or len(entry[0]) > 2 * len(result.data) + 16:
+            # start over if the dictionary has grown far past what is
+            # currently being polled (eg. lots of interface churn)
+            entry = self._interned[k] = [[], {}, None, 0]
+
+        paths, index = entry[0], entry[1]
+        ids = []
+        changed = False
+        for var, val in result.data:
+            t = tuple(var)
+            i = index.get(t)
+            if i is None:
+                i = index[t] = len(paths)
+                paths.append(list(var))
+                changed = True
+            ids.append(i)
+
+        new_dict = None
+        t = time.time()
+        if changed or entry[2] is None:
+            js = json.dumps(paths)
+            entry[2] = hashlib.sha1(js).digest()
+            entry[3] = t
+            new_dict = (entry[2].encode('hex'), js)
+        elif t - entry[3] > self.DICT_REFRESH_INTERVAL:
+            entry[3] = t
+            new_dict = (entry[2].encode('hex'), json.dumps(paths))
+
+        return ids, entry[2], new_dict
+
+    def encode(self, result):
+        """Encode ``result``.
+
+        Returns a tuple of the encoded string and either None or a
+        (hex digest, JSON) tuple for a dictionary which needs to be
+        published.  Returns None if ``result`` can't be encoded."""
+        if not isinstance(result.data, list):
+            return None
+
+        codes = []
+        values = []
+        for pair in result.data:
+            if len(pair) != 2:
+                return None
+            val = pair[1]
+            if isinstance(val, float):
+                codes.append('d')
+                values.append(val)
+            elif isinstance(val, (int, long)):
+                if 0 <= val < 2**64:
+                    codes.append('Q')
+                elif -2**63 <= val < 0:
+                    codes.append('q')
+                else:
+                    return None
+                values.append(val)
+            elif val is None:
+                codes.append('n')
+            else:
+                return None
+
+        ids, digest, new_dict = self._intern(result)
+
+        names = [unicode(x).encode('utf-8') for x in
+                (result.oidset_name, result.device_name, result.oid_name)]
+        metadata = json.dumps(result.metadata)
+        n = len(ids)
+        vfmt = '<' + ''.join([self._value_codes[c] for c in codes])
+
+        payload = ''.join((
+            self.MAGIC,
+            self._header.pack(self.VERSION, result.timestamp, digest, n,
+                len(names[0]), len(names[1]), len(names[2]), len(metadata)),
+            names[0], names[1], names[2], metadata,
+            struct.pack('<%dI' % n, *ids),
+            ''.join(codes),
+            struct.pack(vfmt, *values)))
+
+        return payload, new_dict
+
+    def is_encoded(self, val):
+        return val.startswith(self.MAGIC)
+
+    def _sweep_dicts(self, t):
+        """Forget the dictionaries that haven't been used for a while.
+
+        An encoder that is still using a dictionary republishes it every
+        ``DICT_REFRESH_INTERVAL`` so it can be fetched again if needed,
+        the rest belong to paths which have gone away."""
+        if t - self._dicts_swept < self.DICT_REFRESH_INTERVAL:
+            return
+
+        for digest, entry in self._dicts.items():
+            if t - entry[1] > self.DICT_REFRESH_INTERVAL:
+                del self._dicts[digest]
+        self._dicts_swept = t
+
+    def decode(self, val, fetch_dict):
+        """Decode ``val`` into a dict of PollResult arguments.
+
+        ``fetch_dict`` is called with the hex digest of a dictionary that
+        has not been seen yet and should return its JSON or None."""
+        off = len(self.MAGIC)
+        try:
+            (version, timestamp, digest, n, l_oidset, l_device, l_oid,
+                l_meta) = self._header.unpack_from(val, off)
+        except struct.error as e:
+            raise PersistWireFormatError("truncated header: %s" % e)
+
+        if version != self.VERSION:
+            raise PersistWireFormatError("unsupported wire format version %d"
+                    % version)
+
+        t = time.time()
+        entry = self._dicts.get(digest)
+        if entry is None:
+            js = fetch_dict(digest.encode('hex'))
+            if not js:
+                raise PersistWireFormatError("unknown path dictionary %s"
+                        % digest.encode('hex'))
+            try:
+                entry = self._dicts[digest] = [json.loads(js), t]
+            except ValueError as e:
+                raise PersistWireFormatError("corrupt path dictionary %s: %s"
+                        % (digest.encode('hex'), e))
+        else:
+            entry[1] = t
+        paths = entry[0]
+        self._sweep_dicts(t)
+
+        off += self._header.size
+        names = []
+        try:
+            for l in (l_oidset, l_device, l_oid):
+                names.append(val[off:off+l].decode('utf-8'))
+                off += l
+            metadata = json.loads(val[off:off+l_meta])
+        except ValueError as e:
+            raise PersistWireFormatError("corrupt names or metadata: %s" % e)
+        off += l_meta
+
+        try:
+            ids = struct.unpack_from('<%dI' % n, val, off)
+            off += 4 * n
+            codes = val[off:off+n]
+            off += n
+            vfmt = '<' + ''.join([self._value_codes[c] for c in codes])
+            values = iter(struct.unpack_from(vfmt, val, off))
+            data = []
+            for i, c in zip(ids, codes):
+                data.append([paths[i], None if c == 'n' else values.next()])
+        except (struct.error, KeyError, IndexError) as e:
+            raise PersistWireFormatError("corrupt payload: %s" % e)
+
+        return dict(oidset_name=names[0], device_name=names[1],
+                oid_name=names[2], timestamp=timestamp, data=data,
+                metadata=metadata)
 
 class MemcachedPersistQueue(PersistQueue):
     """A simple queue based on memcached.
@@ -982,6 +1339,10 @@ class MemcachedPersistQueue(PersistQueue):
     """
 
     PREFIX = '_mcpq_'
+    FORMAT_CHECK_INTERVAL = 60
+    # how long get() waits for a reserved but unwritten qid, see put_multi()
+    # and _pending_set()
+    MISSING_GRACE = 2
 
     def __init__(self, qname, memcached_uri):
         super(MemcachedPersistQueue, self).__init__(qname)
@@ -1002,12 +1363,88 @@ class MemcachedPersistQueue(PersistQueue):
         if not lr:
             self.mc.set(self.last_read, 0)
 
+        # the consumer advertises the wire formats it understands here,
+        # producers use the JSON format until they see the binary one
+        self.formats_key = '%s_%s_formats' % (self.PREFIX, self.qname)
+        self.wire_format = WIRE_FORMAT_JSON
+        self.last_format_check = 0
+        self.codec = PollResultCodec()
+
+        self.missing_qid = None
+        self.missing_since = 0
+        # last_added as seen at high_water_time and the one before it, see
+        # _pending_set()
+        self.high_water = 0
+        self.high_water_time = 0
+        self.settled_qid = 0
+        self.skipped_qids = 0
+
     def __str__(self):
         la = self.mc.get(self.last_added)
         lr = self.mc.get(self.last_read)
         return '<MemcachedPersistQueue: %s last_added: %d, last_read: %d>' \
                 % (self.qname, la, lr)
 
+    def _dict_key(self, digest):
+        return '%s_dict_%s' % (self.PREFIX, digest)
+
+    def advertise_formats(self):
+        """Called by the consumer to tell producers which wire formats it
+        is able to decode."""
+        self.mc.set(self.formats_key, ','.join(WIRE_FORMATS))
+
+    def negotiate_format(self):
+        t = time.time()
+        if t - self.last_format_check < self.FORMAT_CHECK_INTERVAL:
+            return self.wire_format
+
+        self.last_format_check = t
+        formats = self.mc.get(self.formats_key)
+        if formats and WIRE_FORMAT_BINARY in formats.split(','):
+            wire_format = WIRE_FORMAT_BINARY
+        else:
+            wire_format = WIRE_FORMAT_JSON
+
+        if wire_format != self.wire_format:
+            self.log.info("switching to wire format %s" % wire_format)
+            self.wire_format = wire_format
+
+        return self.wire_format
+
+    def serialize(self, val):
+        if self.negotiate_format() == WIRE_FORMAT_BINARY:
+            try:
+                encoded = self.codec.encode(val)
+            except Exception as e:
+                self.log.error("binary encoding of %s failed: %s" % (val, e))
+                encoded = None
+
+            if encoded:
+                payload, new_dict = encoded
+                if new_dict:
+                    digest, paths = new_dict
+                    if not self.mc.set(self._dict_key(digest), paths):
+                        self.log.error("memcache 'set' of path dictionary failed")
+                return payload
+
+        return PersistQueue.serialize(self, val)
+
+    def deserialize(self, val):
+        if self.codec.is_encoded(val):
+            return self.codec.decode(val,
+                    lambda digest: self.mc.get(self._dict_key(digest)))
+
+        try:
+            return PersistQueue.deserialize(self, val)
+        except ValueError as e:
+            raise PersistWireFormatError("corrupt JSON: %s" % e)
+
+    def publish_stats(self, stats):
+        """Make the consumer's batching stats available to espersistq."""
+        stats = dict(stats, skipped_qids=self.skipped_qids)
+        self.mc.set('%s_%s_batch' % (self.PREFIX, self.qname),
+                json.dumps(stats))
+
     def put(self, val):
         ser = self.serialize(val)
         if ser:
@@ -1018,6 +1455,62 @@ class MemcachedPersistQueue(PersistQueue):
         else:
             self.log.error("failed to serialize: %s" % str(val))
 
+    def put_multi(self, vals):
+        """Put several values, reserving their qids with a single incr and
+        writing them with a single set_multi."""
+        sers = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                sers.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if not sers:
+            return
+
+        last = self.mc.incr(self.last_added, len(sers))
+        if last is None:
+            self.log.error("memcache 'incr' failed! Polling data lost!")
+            return
+
+        first = last - len(sers) + 1
+        items = {}
+        for i, ser in enumerate(sers):
+            items['%s_%s_%d' % (self.PREFIX, self.qname, first + i)] = ser
+
+        failed = self.mc.set_multi(items)
+        if failed:
+            self.log.error("memcache 'set_multi' failed for %d of %d items! "
+                    "Polling data lost!" % (len(failed), len(items)))
+
+    def _update_high_water(self, last_added):
+        """Every MISSING_GRACE seconds remember last_added.  All of the
+        qids up to the value remembered the time before (settled_qid) were
+        reserved at least MISSING_GRACE seconds ago."""
+        now = time.time()
+        if now - self.high_water_time >= self.MISSING_GRACE:
+            self.settled_qid = self.high_water
+            self.high_water = last_added
+            self.high_water_time = now
+
+    def _pending_set(self, qid):
+        """Is qid possibly reserved by a producer which hasn't written it
+        yet?  Producers write their values right after reserving the qids,
+        so a missing qid which was reserved more than MISSING_GRACE seconds
+        ago has been lost (evicted, most likely) and is skipped straight
+        away.  A newer one is given MISSING_GRACE seconds before it is
+        counted as lost."""
+        if qid <= self.settled_qid:
+            return False
+
+        now = time.time()
+        if qid != self.missing_qid:
+            self.missing_qid = qid
+            self.missing_since = now
+
+        return now - self.missing_since < self.MISSING_GRACE
+
     def get(self, block=False):
         if len(self) <= 0:
             return None
@@ -1025,20 +1518,42 @@ class MemcachedPersistQueue(PersistQueue):
         errors = 0
 
         qid = self.mc.incr(self.last_read)
-        while qid <= self.mc.get(self.last_added):
+        last_added = self.mc.get(self.last_added)
+        self._update_high_water(last_added)
+        while qid <= last_added:
             k = '%s_%s_%d' % (self.PREFIX, self.qname, qid)
             val = self.mc.get(k)
+            if not val and not errors and self._pending_set(qid):
+                # try this qid again next time
+                self.mc.decr(self.last_read)
+                return None
+
             if val:
                 self.mc.delete(k)
                 if errors:
-                    self.log.error("missing data: %d items missing (qids %d-%d)" %
-                            (errors, qid-errors, qid-1))
-                # return self.deserialize(val)
-                return PollResult(**self.deserialize(val))
+                    self._skipped(errors, qid)
+                try:
+                    return PollResult(**self.deserialize(val))
+                except PersistWireFormatError as e:
+                    self.log.error("undecodable data at qid %d: %s" % (qid, e))
+                    errors = 0
+                    qid = self.mc.incr(self.last_read)
+                    continue
 
             errors += 1
 
             qid = self.mc.incr(self.last_read)
+            last_added = self.mc.get(self.last_added)
+
+        # qid hasn't been reserved yet, read it next time
+        self.mc.decr(self.last_read)
+        if errors:
+            self._skipped(errors, qid)
+
+    def _skipped(self, errors, qid):
+        self.log.error("missing data: %d items missing (qids %d-%d)" %
+                (errors, qid-errors, qid-1))
+        self.skipped_qids += errors
 
     def __len__(self):
         n = self.mc.get(self.last_added) - self.mc.get(self.last_read)
@@ -1071,6 +1586,14 @@ class PersistClient(object):
         for sink in self.sinks:
             sink.put(result)
 
+    def put_multi(self, results):
+        for sink in self.sinks:
+            if hasattr(sink, 'put_multi'):
+                sink.put_multi(results)
+            else:
+                for result in results:
+                    sink.put(result)
+
 
 class MultiWorkerQueue(object):
     def __init__(self, qprefix, qtype, uri, num_workers):
@@ -1078,38 +1601,37 @@ class MultiWorkerQueue(object):
         self.qtype = qtype
         self.num_workers = num_workers
         self.queues = {}
-        self.worker_map = {}
         self.log = get_logger('MultiWorkerQueue')
-        self.worker_load = []
 
         for i in range(1, num_workers + 1):
             name = "%s_%d" % (qprefix, i)
             self.queues[name] = qtype(name, uri)
-            self.worker_load.append([i, 0])
 
     def get_worker(self, result):
-        k = ":".join((result.oidset_name, result.device_name))
-        try:
-            w = self.worker_map[k]
-        except KeyError:
-            work_size = len(result.data)
-            w = self.worker_load[0][0]
-            self.worker_map[k] = w
-
-            self.worker_load[0][1] += work_size
-
-            self.log.debug("worker assigned: %s %d load=%d" % (k, w,
-                self.worker_load[0][1]))
+        """Pick the worker queue for ``result``.
 
-            self.worker_load.sort(key=lambda x: x[1])
+        The persisters keep state for each series (eg. the previous value
+        to compute rates from), so all of the results for an oidset on a
+        device have to go to the same worker.  The worker is picked by a
+        hash so that holds no matter which thread or process sends them."""
+        k = u":".join((result.oidset_name, result.device_name))
+        w = (zlib.crc32(k.encode('utf-8')) & 0xffffffff) % self.num_workers
 
-        return '%s_%d' % (self.qprefix, w)
+        return '%s_%d' % (self.qprefix, w + 1)
 
     def put(self, result):
         workerqname = self.get_worker(result)
         workerq = self.queues[workerqname]
         workerq.put(result)
 
+    def put_multi(self, results):
+        batches = {}
+        for result in results:
+            batches.setdefault(self.get_worker(result), []).append(result)
+
+        for workerqname, batch in batches.iteritems():
+            self.queues[workerqname].put_multi(batch)
+
 
 class MemcachedPersistHandler(object):
     def __init__(self, name, config, uri):
@@ -1141,6 +1663,28 @@ class MemcachedPersistHandler(object):
 
             q.put(result)
 
+    def put_multi(self, results):
+        """Put a batch of results, with one put_multi() per queue."""
+        batches = {}
+        for result in results:
+            try:
+                qnames = self.config.persist_map[result.oidset_name.lower()]
+            except KeyError:
+                self.log.error("unknown oidset: %s" % result.oidset_name)
+                continue
+
+            for qname in qnames:
+                batches.setdefault(qname, []).append(result)
+
+        for qname, batch in batches.iteritems():
+            try:
+                q = self.queues[qname]
+            except KeyError:
+                self.log.error("unknown queue: %s" % (qname,))
+                continue
+
+            q.put_multi(batch)
+
 
 def do_profile(func_name, myglobals, mylocals):
     import cProfile
@@ -1171,6 +1715,7 @@ class QueueStats:
         self.qname = qname
         self.last_read = [0, 0]
         self.last_added = [0, 0]
+        self.batch = {}
         self.warn = False
 
     def update_stats(self):
@@ -1188,6 +1733,10 @@ class QueueStats:
                 self.warn = True
                 break
 
+        batch = self.mc.get('%s_%s_batch' % (self.prefix, self.qname))
+        if batch:
+            self.batch = json.loads(batch)
+
     def get_stats(self):
         pending = self.last_added[0] - self.last_read[0]
         new = self.last_added[0] - self.last_added[1]
@@ -1198,7 +1747,10 @@ class QueueStats:
                 new,
                 done,
                 delta,
-                self.last_added[0])
+                self.last_added[0],
+                self.batch.get('batch_size', 0),
+                self.batch.get('latency_flushes', 0),
+                self.batch.get('skipped_qids', 0))
 
 
 def stats(name, config, opts):
@@ -1220,13 +1772,14 @@ def stats(name, config, opts):
     keys.sort()
     while True:
         total = [0,0,0,0]
-        print "%20s %8s %8s %8s %8s %14s" % (
-                "queue", "pending", "new", "done", "delta", "max")
+        print "%20s %8s %8s %8s %8s %14s %6s %8s %8s" % (
+                "queue", "pending", "new", "done", "delta", "max", "batch",
+                "lflushes", "skipped")
         for k in keys:
             stats[k].update_stats()
             vals = stats[k].get_stats()
-            print "%20s % 8d % 8d % 8d % 8d % 14d" % vals
-            total = map(sum, zip(total, vals[1:-1]))
+            print "%20s % 8d % 8d % 8d % 8d % 14d % 6d % 8d % 8d" % vals
+            total = map(sum, zip(total, vals[1:5]))
         total.insert(0, "TOTAL")
         print "%20s % 8d % 8d % 8d % 8d" % tuple(total)
         print ""
@@ -1256,6 +1809,140 @@ def worker(name, config, opts):
     # do_profile("worker.run()", globals(), locals())
 
 
+def replay_files(paths):
+    """Expand a list of files and directories of streaming logs.  "-"
+    means stdin."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([os.path.join(path, f)
+                for f in os.listdir(path)]))
+        else:
+            files.append(path)
+
+    return files
+
+def replay_worker(name, config, qname, qclass, spool):
+    """Load one partition of the replayed data, put it in time order and
+    feed it straight to the persister."""
+    setproctitle(name)
+    log = get_logger(name)
+
+    results = []
+    with open(spool) as f:
+        for line in f:
+            results.append(json.loads(line))
+    os.unlink(spool)
+
+    # sort is stable so results with the same timestamp stay in log order
+    results.sort(key=lambda r: r['timestamp'])
+    log.info("replaying %d results" % len(results))
+
+    klass = eval(qclass)
+    persister = klass(config, qname,
+            persistq=ListPersistQueue(qname, results))
+    persister.run()
+    persister.flush()
+
+def replay(name, config, opts, args):
+    """Replay StreamingPollPersister logs (or any stream of PollResults in
+    the same format) directly into the persister for ``opts.qname``.
+
+    Results are partitioned across ``opts.replay_workers`` processes by
+    device, oidset and oid so every series is handled by one process in
+    time order.  memcached is not used at all."""
+    init_logging(name, config.syslog_facility, level=config.syslog_priority,
+            debug=opts.debug)
+    log = get_logger(name)
+
+    qname = opts.qname or 'cassandra'
+    if qname not in config.persist_queues:
+        print >>sys.stderr, "unknown persist queue: %s" % qname
+        sys.exit(1)
+
+    qclass = config.persist_queues[qname][0]
+    oidsets = set([k for k, v in config.persist_map.iteritems()
+        if qname in v])
+
+    paths = args[1:]
+    if not paths:
+        if not config.streaming_log_dir:
+            print >>sys.stderr, "no files given and no streaming_log_dir set"
+            sys.exit(1)
+        paths = [config.streaming_log_dir]
+
+    nworkers = max(1, int(opts.replay_workers))
+    spooldir = tempfile.mkdtemp(prefix='espersistd_replay_')
+    spools = [os.path.join(spooldir, str(i)) for i in range(nworkers)]
+    spool_fds = [open(f, 'w') for f in spools]
+
+    count = 0
+    skipped = 0
+    t0 = time.time()
+
+    for path in replay_files(paths):
+        if path == '-':
+            fd = sys.stdin
+        else:
+            fd = open(path)
+
+        for line in fd:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                r = json.loads(line)
+            except ValueError, e:
+                log.error("bad record in %s: %s" % (path, e))
+                skipped += 1
+                continue
+
+            if r['oidset_name'].lower() not in oidsets or \
+                    (opts.begin and r['timestamp'] < float(opts.begin)) or \
+                    (opts.end and r['timestamp'] >= float(opts.end)):
+                skipped += 1
+                continue
+
+            series = ':'.join((r['device_name'], r['oidset_name'],
+                r['oid_name'])).encode('utf-8')
+            spool_fds[(zlib.crc32(series) & 0xffffffff) % nworkers].write(
+                    line + '\n')
+            count += 1
+
+        if fd is not sys.stdin:
+            fd.close()
+
+    for fd in spool_fds:
+        fd.close()
+
+    log.info("replaying %d results (%d skipped) to %s with %d workers" % (
+        count, skipped, qname, nworkers))
+
+    # don't share SQL connections with the children
+    for conn in django.db.connections.all():
+        conn.close()
+
+    procs = []
+    for i, spool in enumerate(spools):
+        p = multiprocessing.Process(target=replay_worker,
+                args=("%s_%d" % (name, i + 1), config, qname, qclass, spool))
+        p.start()
+        procs.append(p)
+
+    failed = 0
+    for p in procs:
+        p.join()
+        if p.exitcode != 0:
+            failed += 1
+
+    shutil.rmtree(spooldir, ignore_errors=True)
+
+    log.info("replay done in %f seconds, %d workers failed" % (
+        time.time() - t0, failed))
+    if failed:
+        sys.exit(1)
+
 class PersistManager(object):
     def __init__(self, name, config, opts):
         self.name = name
@@ -1294,12 +1981,65 @@ class PersistManager(object):
         signal.signal(signal.SIGTERM, self.stop)
 
     def start_all_children(self):
+        if self.config.espersistd_prefork:
+            self.preload()
+
         for qname, qinfo in self.config.persist_queues.iteritems():
             (qclass, nworkers) = qinfo
             for i in range(1, nworkers + 1):
                 self.start_child(qname, qclass, i)
 
+    def preload(self):
+        """Do the work shared by all workers once, before forking them.
+
+        The persister classes are resolved and the Cassandra schema is
+        checked here so that forked workers only need to open their own
+        connection pool and queue connection."""
+        for qname, qinfo in self.config.persist_queues.iteritems():
+            klass = eval(qinfo[0])
+            if issubclass(klass, CassandraPollPersister) and \
+                    not CASSANDRA_DB._schema_checked:
+                self.log.info("checking cassandra schema")
+                db = CASSANDRA_DB(self.config, qname=self.name)
+                db.close()
+
+        # don't share SQL connections with the children
+        for conn in django.db.connections.all():
+            conn.close()
+
+    def fork_child(self, qname, qclass, index):
+        pid = os.fork()
+        if pid:
+            self.processes[pid] = (None, qname, qclass, index)
+            return
+
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            # worker() sets up its own logging
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+
+            opts = copy.copy(self.opts)
+            opts.role = 'worker'
+            opts.qname = qname
+            opts.number = str(index)
+
+            worker("espersistd.worker.%s" % qname, self.config, opts)
+        except:
+            status = 1
+            get_logger("espersistd.worker.%s" % qname).error(
+                    "Problem with worker module", exc_info=True)
+        finally:
+            os._exit(status)
+
     def start_child(self, qname, qclass, index):
+        if self.config.espersistd_prefork:
+            return self.fork_child(qname, qclass, index)
+
         args = [sys.executable, self.caller_path,
                 '-r', 'worker',
                 '-q', qname,
@@ -1330,8 +2070,9 @@ class PersistManager(object):
             p, qname, qclass, index = self.processes[pid]
             del self.processes[pid]
             self.log.error("child died: pid %d, %s_%d" % (pid, qname, index))
-            for line in p.stdout.readlines():
-                self.log.error("pid %d: %s" % (pid, line))
+            if p:
+                for line in p.stdout.readlines():
+                    self.log.error("pid %d: %s" % (pid, line))
 
             self.start_child(qname, qclass, index)
 
@@ -1363,6 +2104,14 @@ def espersistd():
     oparse.add_option("-r", "--role", dest="role", default="manager")
     oparse.add_option("-q", "--queue", dest="qname", default="")
     oparse.add_option("-n", "--number", dest="number", default="")
+    oparse.add_option("--replay", dest="role", action="store_const",
+            const="replay",
+            help="replay streaming logs given as arguments into the -q queue")
+    oparse.add_option("--replay-workers", dest="replay_workers", default=4)
+    oparse.add_option("--begin", dest="begin", default=None,
+            help="only replay results at or after this unix time")
+    oparse.add_option("--end", dest="end", default=None,
+            help="only replay results before this unix time")
     (opts, args) = oparse.parse_args(args=argv)
 
     opts.config_file = os.path.abspath(opts.config_file)
@@ -1396,6 +2145,8 @@ def espersistd():
             sys.exit(1)
     elif opts.role == 'stats':
         stats(name, config, opts)
+    elif opts.role == 'replay':
+        replay(name, config, opts, args)
     else:
         print >>sys.stderr, "unknown role: %s" % opts.role
 
@@ -1,4 +1,8 @@
 import os
+import bisect
+import copy
+import errno
+import json
 import signal
 import sys
 import time
@@ -6,6 +10,12 @@ import re
 import socket
 import threading
 import Queue
+import heapq
+import itertools
+import zlib
+import __main__
+
+from subprocess import Popen
 
 import django
 
@@ -17,7 +27,7 @@ from esmond.util import daemonize, setup_exc_handler
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError, PollerError
 from esmond.persist import PollResult, PersistClient
-from esmond.api.models import Device, IfRef, OIDSet
+from esmond.api.models import Device, IfRef, OIDSet, ConfigGeneration
 
 try:
     import tsdb
@@ -35,12 +45,97 @@ class PollUnknownIfIndex(PollError):
 
 
 def filter_data(name, data):
+    if isinstance(data, WalkResults):
+        return data.filter(name)
+
     return filter(lambda x: x[0].startswith(name), data)
 
 
+class WalkResults(object):
+    """The results of a bulkwalk bucketed by the column that was walked.
+
+    Iterates over (name, value) tuples like the list it replaces, but
+    filter_data() can pick out a column without scanning all of the
+    results."""
+
+    def __init__(self):
+        self.columns = []
+        self.buckets = {}
+        self.nvars = 0
+        # number of GETBULKs it took
+        self.pdus = 0
+
+    def add(self, column, results):
+        if column not in self.buckets:
+            self.columns.append(column)
+            self.buckets[column] = []
+
+        self.buckets[column].extend(results)
+        self.nvars += len(results)
+
+    def filter(self, name):
+        try:
+            return self.buckets[name]
+        except KeyError:
+            # not a column we walked, eg. a single instance
+            return filter(lambda x: x[0].startswith(name), self)
+
+    def __len__(self):
+        return self.nvars
+
+    def __iter__(self):
+        return itertools.chain(*[self.buckets[c] for c in self.columns])
+
+
+def poll_phase(name, frequency):
+    """Deterministic offset in [0, frequency) used to spread the pollers
+    over the polling interval instead of polling everything at once."""
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % \
+            int(frequency * 1000) / 1000.0
+
+
+def device_shard(name, nshards):
+    """Stable 1-based espolld shard number for a device."""
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % nshards + 1
+
+
+def next_poll_slot(t, frequency, phase):
+    """Return the first time after t which is phase seconds into a
+    polling interval."""
+    return (int((t - phase) // frequency) + 1) * frequency + phase
+
+
+def first_poll_time(t, frequency, phase, jitter=5):
+    """Return the time of the first poll after a poller is started at t.
+
+    Waiting for the next phase slot could leave a device unpolled for a
+    whole interval after a start, reload or restart, so the first poll is
+    made within min(frequency, jitter) seconds, spread by the phase.  The
+    polls after it are aligned to the phase slots by next_poll_slot()."""
+    return t + min(frequency, jitter) * (phase / float(frequency))
+
+
+def oidset_changed(poller, oidset):
+    """Return True if poller, which was started for an older copy of
+    oidset, needs to be restarted to pick up changes to it."""
+    old = poller.oidset
+    if (old.frequency, old.poller_id, old.poller_args) != \
+            (oidset.frequency, oidset.poller_id, oidset.poller_args):
+        return True
+
+    return [o.name for o in poller.oids] != \
+            [o.name for o in oidset.oids.all()]
+
+
 class PollCorrelator(object):
     """polling correlators correlate an oid to some other field.  this is
-    typically used to generate the key needed to store the variable."""
+    typically used to generate the key needed to store the variable.
+
+    ``oids`` are the tables the correlator needs to be setup().  A change
+    in the values of ``change_oids`` means those tables need to be walked
+    again."""
+
+    change_oids = ['sysUpTime.0']
 
     def __init__(self):
         pass
@@ -111,6 +206,7 @@ class IfNameCorrelator(PollCorrelator):
     """correlates an IfIndex to an it's IfName"""
 
     oids = ['ifName', 'ifAlias']
+    change_oids = ['sysUpTime.0', 'ifTableLastChanged.0']
 
     def setup(self, data, ignore_no_ifalias=True):
         self.xlate = self._table_parse(filter_data('ifName', data))
@@ -141,6 +237,7 @@ class IfNameCorrelator(PollCorrelator):
 
 class SentryCorrelator(object):
     oids = ['outletID', 'tempHumidSensorID']
+    change_oids = ['sysUpTime.0']
 
     def setup(self, data):
         self.outlet = self._parse_name(self._get_outlet_key,
@@ -176,6 +273,7 @@ class InfIfNameCorrelator(PollCorrelator):
     configured so we want to collect them all, but ifAlias is not set."""
 
     oids = ['ifName']
+    change_oids = ['sysUpTime.0', 'ifTableLastChanged.0']
 
     def setup(self, data):
         self.xlate = self._table_parse(filter_data('ifName', data))
@@ -337,11 +435,88 @@ class IfRefTranslator(PollTranslator):
 
         return dataout
 
+class PollStats(object):
+    """Polling metrics per device and oidset.
+
+    Pollers record each poll here from the SNMP thread and PollManager
+    periodically writes a snapshot to poll_stats_file.  The counters are
+    cumulative; duration_max is the longest poll since the last snapshot.
+    An overrun is a poll which took longer than the oidset's frequency."""
+
+    # upper bounds of the poll duration histogram buckets, in seconds
+    DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pollers = {}
+
+    def _new_stats(self):
+        return dict(polls=0, timeouts=0, overruns=0, varbinds=0, pdus=0,
+                duration_total=0.0, duration_max=0.0, duration_last=None,
+                duration_histogram=[0] * (len(self.DURATION_BUCKETS) + 1))
+
+    def record(self, device, oidset, frequency, duration, varbinds=0, pdus=0,
+            timeout=False):
+        with self.lock:
+            try:
+                stats = self.pollers[device][oidset]
+            except KeyError:
+                stats = self._new_stats()
+                self.pollers.setdefault(device, {})[oidset] = stats
+
+            stats['polls'] += 1
+            stats['varbinds'] += varbinds
+            stats['pdus'] += pdus
+            if timeout:
+                stats['timeouts'] += 1
+            if duration > frequency:
+                stats['overruns'] += 1
+
+            stats['duration_total'] += duration
+            stats['duration_last'] = duration
+            stats['duration_max'] = max(stats['duration_max'], duration)
+            stats['duration_histogram'][
+                    bisect.bisect_left(self.DURATION_BUCKETS, duration)] += 1
+
+    def forget(self, device):
+        with self.lock:
+            self.pollers.pop(device, None)
+
+    def snapshot(self):
+        """Return a copy of the stats and start a new duration_max
+        interval."""
+        bounds = ['%g' % b for b in self.DURATION_BUCKETS] + ['inf']
+
+        with self.lock:
+            snap = copy.deepcopy(self.pollers)
+            for oidsets in self.pollers.itervalues():
+                for stats in oidsets.itervalues():
+                    stats['duration_max'] = 0.0
+
+        for oidsets in snap.itervalues():
+            for stats in oidsets.itervalues():
+                stats['duration_histogram'] = dict(zip(bounds,
+                    stats['duration_histogram']))
+
+        return snap
+
+
 class PersistThread(threading.Thread):
+    """Send PollResults from the in-process queue to the persist queues.
+
+    Results are sent in batches of up to espolld_persist_batch: the thread
+    waits for one result and then takes whatever else is already queued.
+    espolld_persist_threads of these run side by side.  Every thread sends
+    a given series to the same worker queue (see MultiWorkerQueue) and
+    each poller's results are a polling interval apart, so they can't get
+    reordered unless the senders fall that far behind."""
+
     INIT = 0
     RUN = 1
     REMOVE = 2
 
+    STATS_INTERVAL = 60
+
     def __init__(self, name, config, persistq):
         threading.Thread.__init__(self)
 
@@ -350,19 +525,45 @@ class PersistThread(threading.Thread):
         self.name = name
 
         self.state = self.INIT
+        self.log = get_logger(self.name)
 
         self.persister = PersistClient(name, config)
 
+        self.sent = 0
+        self.batches = 0
+        self.last_stats = time.time()
+
+    def next_batch(self):
+        batch = [self.persistq.get(block=True)]
+        while len(batch) < self.config.espolld_persist_batch:
+            try:
+                batch.append(self.persistq.get_nowait())
+            except Queue.Empty:
+                break
+
+        return batch
+
     def run(self):
         self.state = self.RUN
         while self.state == self.RUN:
+            batch = self.next_batch()
             try:
-                task = self.persistq.get(block=True)
-            except Queue.Empty:
-                pass
-            else:
-                self.persister.put(task)
-                self.persistq.task_done()
+                self.persister.put_multi(batch)
+            finally:
+                for task in batch:
+                    self.persistq.task_done()
+
+            self.sent += len(batch)
+            self.batches += 1
+
+            now = time.time()
+            if now > self.last_stats + self.STATS_INTERVAL:
+                self.log.info("sent %d results in %d batches, "
+                        "persistq depth %d" % (self.sent, self.batches,
+                            self.persistq.qsize()))
+                self.sent = 0
+                self.batches = 0
+                self.last_stats = now
 
     def stop(self):
         self.state = self.REMOVE
@@ -373,7 +574,14 @@ class PollManager(object):
 
     The main polling is done asynchronously in the main thread.  There is a
     second thread which handles the interactions with the persistence
-    system."""
+    system.
+
+    Pollers are kept in a heap ordered by their next poll time and the main
+    loop sleeps until the next poller is due."""
+
+    # upper bound on how long the main loop sleeps, so signals and reloads
+    # are handled promptly
+    MAX_SLEEP = 1.0
 
     def __init__(self, name, opts, args, config):
         self.name = name
@@ -392,12 +600,22 @@ class PollManager(object):
         self.reload_interval = 30
         self.penalty_interval = 300
 
-        self.devices = Device.objects.active_as_dict()
+        # when running as one of several shards only poll our devices
+        self.shard = int(getattr(opts, 'shard', None) or 0)
+        # read the generation first so that changes made while we load the
+        # devices are picked up by the next reload
+        self.generation = ConfigGeneration.current()
+        self.devices = self._active_devices()
 
         self.persistq = Queue.Queue()
         self.snmp_poller = AsyncSNMPPoller(config=self.config,
                 name="espolld.snmp_poller")
         self.pollers = {}
+        self.schedule = []
+        self.schedule_seq = itertools.count()
+
+        self.stats = PollStats()
+        self.last_stats = time.time()
 
     def start_polling(self):
         self.log.debug("starting, %d devices configured" % len(self.devices))
@@ -407,9 +625,10 @@ class PollManager(object):
         self.running = True
 
         self.threads = {}
-        t = PersistThread("espolld.persist_client", self.config, self.persistq)
-
-        self._start_thread('persist_thread', t)
+        for i in range(max(1, self.config.espolld_persist_threads)):
+            t = PersistThread("espolld.persist_client_%d" % i, self.config,
+                    self.persistq)
+            self._start_thread('persist_thread_%d' % i, t)
 
         bad_devices = []
 
@@ -423,18 +642,80 @@ class PollManager(object):
         self.last_reload = time.time()
 
         while self.running:
-            for poller in self.pollers.itervalues():
+            now = time.time()
+            while self.schedule and self.schedule[0][0] <= now:
+                _, _, key, poller = heapq.heappop(self.schedule)
+                # pollers which were stopped or restarted are just dropped
+                # from the schedule here
+                if self.pollers.get(key) is not poller:
+                    continue
+
                 poller.run_once()
+                self._schedule_poller(key, poller)
+
+            now = time.time()
+            if self.config.poll_stats_file and \
+                    now >= self.last_stats + self.config.poll_stats_interval:
+                self.write_stats()
 
-            if self.last_reload + self.config.reload_interval <= time.time():
+            next_reload = self.last_reload + self.config.reload_interval
+            if next_reload <= now:
                 if self.config.debug:
                     django.db.reset_queries()
                 self.reload()
+                continue
 
-            time.sleep(1)
+            wakeup = min(next_reload, now + self.MAX_SLEEP)
+            if self.schedule:
+                wakeup = min(wakeup, self.schedule[0][0])
+            if wakeup > now:
+                time.sleep(wakeup - now)
 
         self.shutdown()
 
+    def stats_file(self):
+        if self.shard:
+            return "%s.%d" % (self.config.poll_stats_file, self.shard)
+
+        return self.config.poll_stats_file
+
+    def write_stats(self):
+        """Write the polling stats to poll_stats_file as JSON.
+
+        The file is replaced atomically so readers never see a partial
+        write."""
+        self.last_stats = time.time()
+
+        stats = dict(time=self.last_stats, hostname=self.hostname,
+                shard=self.shard, persistq_depth=self.persistq.qsize(),
+                pollers=self.stats.snapshot())
+
+        path = self.stats_file()
+        tmp = "%s.tmp" % path
+        try:
+            f = open(tmp, 'w')
+            try:
+                json.dump(stats, f)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            self.log.error("unable to write stats to %s: %s" % (path, e))
+
+    def _schedule_poller(self, key, poller):
+        heapq.heappush(self.schedule,
+                (poller.next_poll, self.schedule_seq.next(), key, poller))
+
+    def _active_devices(self):
+        devices = Device.objects.active_as_dict()
+
+        if self.shard and self.config.espolld_shards > 1:
+            for name in devices.keys():
+                if device_shard(name, self.config.espolld_shards) != self.shard:
+                    del devices[name]
+
+        return devices
+
     def _start_thread(self, name, t):
         t.setDaemon(True)
         t.setName(name)
@@ -458,7 +739,7 @@ class PollManager(object):
 
         self.log.info("starting all pollers for %s" % device.name)
 
-        for oidset in device.oidsets.all():
+        for oidset in device.oidsets.select_related('poller'):
             self._start_poller(device, oidset)
 
         return True
@@ -468,6 +749,7 @@ class PollManager(object):
         for poller_name in self._pollers_for_device(device):
             self._stop_poller(poller_name)
         self.snmp_poller.remove_session(device.name)
+        self.stats.forget(device.name)
 
     def _start_poller(self, device, oidset):
         key = "%s_%s" % (device.name, oidset.name)
@@ -487,7 +769,9 @@ class PollManager(object):
             self.log.error(str(e))
             return
 
+        poller.stats = self.stats
         self.pollers[key] = poller
+        self._schedule_poller(key, poller)
 
     def _stop_poller(self, poller_name):
         self.log.info("stopping poller %s" % poller_name)
@@ -511,15 +795,29 @@ class PollManager(object):
 
     def reload(self):
         """Reload the configuration data and stop, start or restart pollers
-        as necessary."""
+        as necessary.
 
-        self.log.debug("reloading devices and oidsets")
+        The set of active devices is checked on every reload since devices
+        come and go as their begin_time and end_time pass without the
+        ConfigGeneration changing.  Only the devices whose generation is
+        newer than the last one we loaded are looked at more closely, and
+        only the pollers whose oidset changed are restarted so the others
+        keep their state."""
 
-        new_devices = Device.objects.active_as_dict()
+        self.last_reload = time.time()
+
+        generation = ConfigGeneration.current()
+        new_devices = self._active_devices()
 
         new_device_set = set(new_devices.iterkeys())
         old_device_set = set(self.devices.iterkeys())
 
+        if generation == self.generation and new_device_set == old_device_set:
+            return
+
+        self.log.debug("reloading devices and oidsets: generation %d -> %d"
+                % (self.generation, generation))
+
         bad_devices = []
         for name in new_device_set.difference(old_device_set):
             if not self._start_device(new_devices[name]):
@@ -535,30 +833,200 @@ class PollManager(object):
             old_device = self.devices[name]
             new_device = new_devices[name]
 
+            if new_device.generation <= self.generation:
+                # unchanged, keep the device the pollers are using
+                new_devices[name] = old_device
+                continue
+
             if new_device.community != old_device.community:
                 self._restart_device(new_device)
-                break
+                continue
 
-            old_oidset = []
-            for poller in self.pollers.keys():
-                if poller.startswith(name):
-                    old_oidset.append(poller.split("_")[1])
+            old_pollers = {}
+            for key in self._pollers_for_device(old_device):
+                old_pollers[key[len(name) + 1:]] = self.pollers[key]
+            old_oidset_names = set(old_pollers.iterkeys())
 
             new_oidset = {}
-            for oidset in new_device.oidsets.all():
+            for oidset in new_device.oidsets.select_related('poller'):
                 new_oidset[oidset.name] = oidset
 
-            old_oidset_names = set(old_oidset)
             new_oidset_names = set(new_oidset.iterkeys())
 
-            for oidset_name in new_oidset_names.difference(old_oidset_names):
-                self._start_poller(new_device, new_oidset[oidset_name])
-
             for oidset_name in old_oidset_names.difference(new_oidset_names):
                 self._stop_poller("%s_%s" % (old_device.name, oidset_name))
 
+            # the oidsets themselves may have changed so restart the pollers
+            # for the ones we are keeping if they need the new OID lists
+            for oidset_name in new_oidset_names:
+                oidset = new_oidset[oidset_name]
+                poller = old_pollers.get(oidset_name)
+                if poller is None or oidset_changed(poller, oidset):
+                    self._start_poller(new_device, oidset)
+
         self.devices = new_devices
-        self.last_reload = time.time()
+        self.generation = generation
+
+
+class PollSupervisor(object):
+    """Run espolld as several shard processes.
+
+    Each shard is a separate espolld process running a PollManager for the
+    devices whose name hashes to it (see device_shard()).  Shards which die
+    are restarted, waiting exponentially longer (up to RESTART_DELAY_MAX
+    seconds) each time a shard dies again soon after being restarted.  On
+    SIGHUP the config is reread and, if the number of shards changed, all
+    shards are restarted so the devices are spread over the new set of
+    shards."""
+
+    RESTART_DELAY_MIN = 1
+    RESTART_DELAY_MAX = 300
+    WAIT_INTERVAL = 1
+
+    def __init__(self, name, opts, config):
+        self.name = name
+        self.opts = opts
+        self.config = config
+        self.nshards = config.espolld_shards
+        self.running = False
+        self.reload_pending = False
+        self.processes = {}
+        # shard -> time it was last started
+        self.started = {}
+        # shard -> seconds waited before it was last restarted
+        self.restart_delay = {}
+        # shard -> time it is due to be restarted
+        self.restarts = {}
+
+        self.log = get_logger(self.name)
+        # save the location of the calling script for later use
+        # (os.path.abspath uses current directory and daemonize does a cd /)
+        self.caller_path = os.path.abspath(__main__.__file__)
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, self.hup)
+
+    def shard_args(self, shard):
+        """The command line for a shard, passing on our own options."""
+        args = [sys.executable, self.caller_path,
+                '-f', self.opts.config_file,
+                '--shard', str(shard)]
+        if self.opts.debug:
+            args.append('--debug')
+        if self.opts.pid_dir:
+            args.extend(['-p', self.opts.pid_dir])
+
+        return args
+
+    def start_shard(self, shard):
+        p = Popen(self.shard_args(shard))
+        self.processes[p.pid] = (p, shard)
+        self.started[shard] = time.time()
+        self.log.info("started shard %d/%d: pid %d" % (shard, self.nshards,
+            p.pid))
+
+    def start_all_shards(self):
+        for shard in range(1, self.nshards + 1):
+            self.start_shard(shard)
+
+    def stop_all_shards(self):
+        for pid, (p, shard) in self.processes.items():
+            self.log.info("stopping shard %d: pid %d" % (shard, pid))
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno not in (errno.ESRCH, errno.ECHILD):
+                    raise
+
+        self.processes = {}
+        self.restarts = {}
+
+    def shard_died(self, shard, now):
+        """Schedule a restart of shard and return the delay before it.
+
+        The delay doubles each time the shard dies again within
+        RESTART_DELAY_MAX seconds of being started."""
+        delay = self.restart_delay.get(shard, 0)
+        if now - self.started.get(shard, 0) > self.RESTART_DELAY_MAX:
+            delay = 0
+        delay = min(max(delay * 2, self.RESTART_DELAY_MIN),
+                self.RESTART_DELAY_MAX)
+
+        self.restart_delay[shard] = delay
+        self.restarts[shard] = now + delay
+
+        return delay
+
+    def restart_shards(self, now):
+        for shard, when in self.restarts.items():
+            if now >= when:
+                del self.restarts[shard]
+                self.start_shard(shard)
+
+    def run(self):
+        self.log.info("starting %d shards" % self.nshards)
+        self.running = True
+
+        self.start_all_shards()
+
+        while self.running:
+            if self.reload_pending:
+                self.reload()
+
+            self.restart_shards(time.time())
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.ECHILD):
+                    pid = 0
+                else:
+                    raise
+
+            if pid == 0:
+                time.sleep(self.WAIT_INTERVAL)
+                continue
+
+            if pid not in self.processes:
+                continue
+
+            p, shard = self.processes.pop(pid)
+            if self.running:
+                delay = self.shard_died(shard, time.time())
+                self.log.error("shard %d died: pid %d, status %d, "
+                        "restarting in %d seconds" % (shard, pid, status,
+                            delay))
+
+        self.stop_all_shards()
+        self.log.info("exiting")
+
+    def reload(self):
+        self.reload_pending = False
+
+        try:
+            config = get_config(self.opts.config_file, self.opts)
+        except ConfigError, e:
+            self.log.error("unable to reload config: %s" % e)
+            return
+
+        self.config = config
+        if config.espolld_shards == self.nshards:
+            return
+
+        self.log.info("number of shards changed from %d to %d" % (
+            self.nshards, config.espolld_shards))
+        self.stop_all_shards()
+        self.nshards = config.espolld_shards
+        self.start_all_shards()
+
+    def hup(self, signum, frame):
+        self.reload_pending = True
+
+    def stop(self, signum, frame):
+        self.log.info("stopping (signal: %d)" % (signum, ))
+        self.running = False
 
 
 class Poller(object):
@@ -582,11 +1050,18 @@ class Poller(object):
 
         self.name = "espolld." + self.device.name + "." + self.oidset.name
 
-        self.next_poll = int(time.time() - 1)
-        self.oids = self.oidset.oids
+        # each poller polls at a fixed, per poller offset into the polling
+        # interval so the load is spread out over time
+        self.phase = poll_phase("%s_%s" % (self.device.name, self.oidset.name),
+                self.oidset.frequency)
+        self.next_poll = first_poll_time(time.time(), self.oidset.frequency,
+                self.phase)
+        # the OIDs are cached for the life of the poller, PollManager starts
+        # a new poller when the oidset changes
+        self.oids = list(self.oidset.oids.all())
         # in some pollers we poll oids beyond the ones which are used
         # for that poller, so we make a copy in poll_oids
-        self.poll_oids = [o.name for o in self.oids.all()]
+        self.poll_oids = [o.name for o in self.oids]
         self.running = True
         self.log = get_logger(self.name)
 
@@ -598,6 +1073,10 @@ class Poller(object):
 
         self.polling_round = 0
 
+        # set by PollManager to record metrics for each poll
+        self.stats = None
+        self.round_pdus = 0
+
     def __str__(self):
         return '<%s: %s %s>' % (self.__name__, self.device.name,
                 self.oidset.name)
@@ -606,7 +1085,9 @@ class Poller(object):
         if self.time_to_poll():
             self.log.debug("grabbing data")
             self.begin_time = time.time()
-            self.next_poll = self.begin_time + self.oidset.frequency
+            self.next_poll = next_poll_slot(self.begin_time,
+                    self.oidset.frequency, self.phase)
+            self.round_pdus = 0
 
             self.begin()
             self.collect()
@@ -629,8 +1110,8 @@ class Poller(object):
         called with the data.  If collect encounters erros the error() method
         is called."""
 
-        self.poller.bulkwalk(self.device.name, self.poll_oids, self.finish,
-                self.error)
+        self.poller.bulkwalk(self.device.name, self.poll_oids, self.collected,
+                self.failed)
 
     def finish(self, data):
         """finish is called once all the data has been retrieved.
@@ -640,6 +1121,23 @@ class Poller(object):
 
         raise NotImplementedError("must implement finish method")
 
+    def record(self, varbinds=0, pdus=0, timeout=False):
+        if self.stats is not None:
+            self.stats.record(self.device.name, self.oidset.name,
+                    self.oidset.frequency, time.time() - self.begin_time,
+                    varbinds=varbinds, pdus=self.round_pdus + pdus,
+                    timeout=timeout)
+
+    def collected(self, data):
+        """Record the poll and pass the data on to finish()."""
+        self.record(varbinds=len(data), pdus=getattr(data, 'pdus', 0))
+        self.finish(data)
+
+    def failed(self, error):
+        """Record the failed poll and pass the error on to error()."""
+        self.record(timeout=True)
+        self.error(error)
+
     def error(self, error):
         """error is called if there is an error or a timeout while polling.
 
@@ -673,42 +1171,109 @@ class Poller(object):
 
 class CorrelatedPoller(Poller):
     """Handles polling of an OIDSet for a device and uses a correlator to
-    determine the name of the variable to use to store values."""
+    determine the name of the variable to use to store values.
+
+    The correlator's tables are cached between polls.  They are only walked
+    again every ``poll_correlator_refresh`` seconds, when a GET of the
+    correlator's ``change_oids`` (eg. sysUpTime and ifTableLastChanged)
+    shows that the device restarted or its tables changed, or when an
+    unknown index shows up.  Other polls only walk the oidset's own OIDs."""
     def __init__(self, config, device, oidset, poller, persistq):
         Poller.__init__(self, config, device, oidset, poller, persistq)
 
         self.correlator = eval(self.poller_args['correlator'])()
-        self.poll_oids.extend(self.correlator.oids)
+        self.oidset_oids = list(self.poll_oids)
+        self.correlator_oids = list(self.correlator.oids)
+        self.change_oids = getattr(self.correlator, 'change_oids',
+                PollCorrelator.change_oids)
+        self.poll_oids.extend(self.correlator_oids)
+
+        self.refresh = True
+        self.next_refresh = 0
+        self.last_change_values = None
 
         self.results = {}
 
     def begin(self):
         pass
 
+    def collect(self):
+        if not self.correlator_oids:
+            # nothing to cache
+            self.refresh = True
+            Poller.collect(self)
+            return
+
+        self.poller.get(self.device.name, self.change_oids,
+                self._check_changes, self.failed)
+
+    def _check_changes(self, r):
+        self.round_pdus += 1
+        values = [v for (var, v) in r]
+        last = self.last_change_values
+        self.last_change_values = values
+
+        # the first value is sysUpTime, which only goes backwards when the
+        # device restarts
+        if last is not None and (len(values) != len(last) or
+                values[0] < last[0] or values[1:] != last[1:]):
+            self.log.debug("device changed, refreshing correlator tables")
+            self.refresh = True
+
+        if time.time() >= self.next_refresh:
+            self.refresh = True
+
+        if self.refresh:
+            self.poll_oids = self.oidset_oids + self.correlator_oids
+        else:
+            self.poll_oids = self.oidset_oids
+
+        Poller.collect(self)
+
+    def setup_correlator(self, data):
+        if self.refresh:
+            self.correlator.setup(data)
+            self.refresh = False
+            self.next_refresh = time.time() + \
+                    self.config.poll_correlator_refresh
+
+    def lookup(self, oid, var):
+        try:
+            return self.correlator.lookup(oid, var)
+        except PollUnknownIfIndex:
+            # new interface? pick it up on the next poll
+            self.refresh = True
+            raise
+
+    def correlate(self, oid, data):
+        correlated_data = []
+        # qualified names are returned unqualified
+        if "::" in oid.name:
+            oid.name = oid.name.split("::")[-1]
+        for var, val in filter_data(oid.name, data):
+            try:
+                varname = self.lookup(oid, var)
+            except PollUnknownIfIndex:
+                self.log.error("unknown ifIndex: %s %s" % (var, str(val)))
+                continue
+
+            if varname:
+                correlated_data.append((varname, val))
+            else:
+                if val != 0:
+                    pass
+                    #self.log.warning("ignoring: %s %s" % (var, str(val)))
+
+        return correlated_data
+
     def finish(self, data):
-        self.correlator.setup(data)
+        self.setup_correlator(data)
 
         ts = time.time()
         metadata = dict(tsdb_flags=ROW_VALID)
 
-        for oid in self.oidset.oids.all():
-            dataout = []
-            # qualified names are returned unqualified
-            if "::" in oid.name:
-                oid.name = oid.name.split("::")[-1]
-            for var, val in filter_data(oid.name, data):
-                try:
-                    varname = self.correlator.lookup(oid, var)
-                except PollUnknownIfIndex:
-                    self.log.error("unknown ifIndex: %s %s" % (var, str(val)))
-                    continue
-
-                if varname:
-                    dataout.append((varname, val))
-                else:
-                    if val != 0:
-                        pass
-                        #self.log.warning("ignoring: %s %s" % (var, str(val)))
+        for oid in self.oids:
+            dataout = self.correlate(oid, data)
 
             pr = PollResult(self.oidset.name, self.device.name, oid.name,
                     ts, dataout, metadata)
@@ -718,43 +1283,23 @@ class CorrelatedPoller(Poller):
         self.log.debug("grabbed %d vars in %f seconds" %
                         (len(data), time.time() - self.begin_time))
 
-class TranslatedPoller(Poller):
+class TranslatedPoller(CorrelatedPoller):
     """Handles polling of an OIDSet for a device and uses a correlator to
     determine the name of the variable to use to store values. Also uses
     a translator to perform any needed translation of the values."""
     def __init__(self, config, device, oidset, poller, persistq):
-        Poller.__init__(self, config, device, oidset, poller, persistq)
+        CorrelatedPoller.__init__(self, config, device, oidset, poller,
+                persistq)
 
         self.translator = eval(self.poller_args['translator'])()
-        self.correlator = eval(self.poller_args['correlator'])()
-        self.poll_oids.extend(self.correlator.oids)
-
-        self.results = {}
-
-    def begin(self):
-        pass
 
     def finish(self, data):
-        self.correlator.setup(data)
+        self.setup_correlator(data)
         ts = time.time()
         metadata = dict(tsdb_flags=ROW_VALID)
-        for oid in self.oidset.oids.all():
-            correlated_data = []
-            # qualified names are returned unqualified
-            if "::" in oid.name:
-                oid.name = oid.name.split("::")[-1]
-            for var, val in filter_data(oid.name, data):
-                try:
-                    varname = self.correlator.lookup(oid, var)
-                except PollUnknownIfIndex:
-                    self.log.error("unknown ifIndex: %s %s" % (var, str(val)))
-                    continue
-                if varname:
-                    correlated_data.append((varname, val))
-                else:
-                    if val != 0:
-                        pass
-                        #self.log.warning("ignoring: %s %s" % (var, str(val)))
+        dataout = []
+        for oid in self.oids:
+            correlated_data = self.correlate(oid, data)
             dataout = self.translator.translate(correlated_data)
             pr = PollResult(self.oidset.name, self.device.name, oid.name,
                     ts, dataout, metadata)
@@ -778,7 +1323,7 @@ class UncorrelatedPoller(Poller):
 
     def finish(self, data):
         dataout = {}
-        for oid in self.oidset.oids.all():
+        for oid in self.oids:
             dataout[oid.name] = filter_data(oid.name, data)
             if self.translator:
                 dataout[oid.name] = self.translator.translate(dataout[oid.name])
@@ -801,22 +1346,66 @@ class PollRequest(object):
         self.additional_oids = additional_oids
 
         self.results = []
+        # time the outstanding request was sent and its max-repetitions
+        self.sent_at = None
+        self.maxrepetitions = None
+
+        # bulkwalks: the column walks in the order they were requested and
+        # the number still running
+        self.walks = []
+        self.active_walks = 0
+        self.failed = False
+        self.pdus = 0
 
     def append(self, oid, value):
         self.results.append((oid, value))
 
 
+class WalkRequest(PollRequest):
+    """The walk of one column of a bulkwalk PollRequest.
+
+    Several of these may be outstanding at once for a single PollRequest,
+    their results are merged into it when the last one is done."""
+    def __init__(self, pollreq, walk_oid):
+        PollRequest.__init__(self, 'bulkwalk', pollreq.callback,
+                pollreq.errback, walk_oid=walk_oid)
+        self.pollreq = pollreq
+
+
 class AsyncSNMPPoller(object):
     """Manage all polling requests and responses.
 
-    AsyncPoller manages all the polling using DLNetSNMP."""
+    AsyncPoller manages all the polling using DLNetSNMP.
+
+    The max-repetitions used for GETBULKs is learned per device: it grows
+    while responses come back full and fast, is capped at what the agent
+    actually returns in one PDU and shrinks on slow responses and
+    timeouts, within poll_maxrepetitions_min and poll_maxrepetitions_max."""
 
     def __init__(self, config=None, name="AsyncSNMPPoller", maxrepetitions=25):
         self.maxrepetitions = maxrepetitions
+        self.min_maxrepetitions = 1
+        self.max_maxrepetitions = maxrepetitions
+        # responses slower than this reduce max-repetitions
+        self.slow_response = 1.0
         self.name = name
         self.config = config
 
+        if self.config:
+            self.maxrepetitions = self.config.poll_maxrepetitions
+            self.min_maxrepetitions = self.config.poll_maxrepetitions_min
+            self.max_maxrepetitions = self.config.poll_maxrepetitions_max
+            self.slow_response = self.config.poll_timeout / 2.0
+
         self.reqmap = {}
+        # OID lookups cached across polls: str_to_oid() results, the names
+        # of walked columns and whether their indexes (of each length) are
+        # numeric
+        self.oid_cache = {}
+        self.oid_names = {}
+        self.numeric_index = {}
+        # learned max-repetitions, kept across polls and session restarts
+        self.session_maxrepetitions = {}
 
         self.sessions = SNMPManager(local_dir="/usr/local/share/snmp",
                 threaded_processor=True)
@@ -866,31 +1455,150 @@ class AsyncSNMPPoller(object):
 
         oids = [str(o) for o in oids]  # make a copy of the oids list
 
-        oid = oids.pop(0)
+        pollreq = PollRequest('bulkwalk', callback, errback,
+                additional_oids=oids)
+
+        # claim all of the initial walks before sending anything: responses
+        # are handled in the DLNetSNMP thread and may start further walks
+        walks = []
+        while oids and len(walks) < self.get_concurrent_walks(host):
+            walk = self._next_walk(pollreq)
+            if walk:
+                walks.append(walk)
+
+        if not walks:
+            return
+
+        pollreq.active_walks = len(walks)
+        for walk, oid in walks:
+            self._getbulk(host, walk, oid)
+
+    def get_concurrent_walks(self, host):
+        if not self.config:
+            return 1
+
+        return max(1, self.config.poll_concurrent_walks_map.get(host.lower(),
+                self.config.poll_concurrent_walks))
+
+    def _next_walk(self, pollreq):
+        """Set up the walk of the next column of pollreq.  Returns a
+        (WalkRequest, oid) tuple or None if the OID can't be resolved."""
+        oid = pollreq.additional_oids.pop(0)
         #print "oid >%s<" % (oid)
-        noid = str_to_oid(oid)  # avoid the noid!
+        try:
+            noid = self.oid_cache[oid]
+        except KeyError:
+            noid = str_to_oid(oid)  # avoid the noid!
+            if noid is not None:
+                noid = tuple(noid)
+                self.oid_cache[oid] = noid
         if noid is None:
             # XXX tell someone: raise exception?
             self.log.error("unable to resolve OID: %s" % oid)
-            return
-        noid = tuple(noid)
+            return None
 
-        pollreq = PollRequest('bulkwalk', callback, errback,
-                walk_oid=noid, additional_oids=oids)
+        walk = WalkRequest(pollreq, noid)
+        pollreq.walks.append(walk)
+
+        return (walk, oid)
+
+    def _walk_done(self, host, walk):
+        pollreq = walk.pollreq
+
+        while pollreq.additional_oids:
+            #print "MORE", pollreq.additional_oids
+            next_walk = self._next_walk(pollreq)
+            if next_walk:
+                self._getbulk(host, *next_walk)
+                return
+
+        pollreq.active_walks -= 1
+        if pollreq.active_walks == 0:
+            results = WalkResults()
+            for w in pollreq.walks:
+                results.add(self._column_name(w.walk_oid), w.results)
+            results.pdus = pollreq.pdus
+            pollreq.callback(results)
+
+    def _column_name(self, walk_oid):
+        try:
+            return self.oid_names[walk_oid]
+        except KeyError:
+            column = oid_to_str(walk_oid).split('::')[-1]
+            self.oid_names[walk_oid] = column
+            return column
+
+    def _varname(self, walk_oid, oid):
+        """Return the unqualified name of oid, which was returned by walking
+        walk_oid.
+
+        Whether a column's index is rendered as plain numbers is cached
+        for each length of index, so for most tables the name is built from
+        the column name and the numeric index instead of converting the
+        whole OID for every varbind.  Tables with string or enumerated
+        indexes still go through oid_to_str()."""
+
+        column = self._column_name(walk_oid)
+        index = oid[len(walk_oid):]
+        key = (walk_oid, len(index))
+
+        numeric = self.numeric_index.get(key)
+        if numeric:
+            return '%s.%s' % (column, '.'.join(map(str, index)))
+
+        name = oid_to_str(oid).split('::')[-1]
+        if numeric is None:
+            self.numeric_index[key] = \
+                    name == '%s.%s' % (column, '.'.join(map(str, index)))
+
+        return name
+
+    def _getbulk(self, host, pollreq, oid):
+        pollreq.maxrepetitions = self.get_maxrepetitions(host)
+        pollreq.sent_at = time.time()
+        pollreq.pollreq.pdus += 1
         reqid = self.sessions[host].async_getbulk(
-                0, self.maxrepetitions, [oid])
+                0, pollreq.maxrepetitions, [oid])
         self.reqmap[reqid] = pollreq
 
+    def get_maxrepetitions(self, host):
+        return self.session_maxrepetitions.get(host, self.maxrepetitions)
+
+    def tune_maxrepetitions(self, host, requested, nvars, latency, done,
+            timeout=False):
+        """Adjust the max-repetitions for host after a GETBULK for
+        requested repetitions returned nvars varbinds in latency seconds.
+        done is true if the response reached the end of the walk."""
+        cur = self.get_maxrepetitions(host)
+        new = cur
+
+        if timeout:
+            new = cur / 2
+        elif latency > self.slow_response:
+            new = int(cur * 0.75)
+        elif not done and requested == cur:
+            if nvars >= requested:
+                new = int(cur * 1.5) + 1
+            else:
+                # the agent truncated the PDU, there's no point in asking
+                # for more than it is willing to send
+                new = nvars
+
+        new = max(self.min_maxrepetitions, min(self.max_maxrepetitions, new))
+        if new != cur:
+            self.log.debug("%s: max-repetitions %d -> %d" % (host, cur, new))
+            self.session_maxrepetitions[host] = new
+
     def bulkget(self, host, nonrepeaters, maxrepetitions, oids, callback,
             errback):
         pollreq = PollRequest('bulkget', callback, errback)
-        reqid = sessions[host].async_getbulk(
+        reqid = self.sessions[host].async_getbulk(
                 nonrepeaters, maxrepetitions, oids)
         self.reqmap[reqid] = pollreq
 
     def get(self, host, oids, callback, errback):
         pollreq = PollRequest('get', callback, errback)
-        reqid = sessions[host].async_get(oids)
+        reqid = self.sessions[host].async_get(oids)
         self.reqmap[reqid] = pollreq
 
     # ***
@@ -913,6 +1621,9 @@ class AsyncSNMPPoller(object):
         if pollreq.type != 'bulkwalk':
             pollreq.callback(r)
             #print "_callback wtf!"
+        elif pollreq.pollreq.failed:
+            # another column of this walk has timed out
+            pass
         else:
             last = ''
             done = False
@@ -921,27 +1632,19 @@ class AsyncSNMPPoller(object):
                     done = True
                     break
 
-                soid = oid_to_str(last).split('::')[-1]
-                pollreq.results.append((soid, v))
+                pollreq.results.append((self._varname(pollreq.walk_oid, last),
+                    v))
+
+            self.tune_maxrepetitions(session, pollreq.maxrepetitions, len(r),
+                    time.time() - pollreq.sent_at, done)
 
             if done:
                 #print '_callback bulkwalk done', last
-                if pollreq.additional_oids:
-                    #print "MORE", pollreq.additional_oids
-                    oid = pollreq.additional_oids.pop(0)
-                    #print "2>%s<" % oid
-                    pollreq.walk_oid = tuple(str_to_oid(oid))
-                    new_reqid = self.sessions[session].async_getbulk(0,
-                        self.maxrepetitions, [oid])
-                    self.reqmap[new_reqid] = pollreq
-                else:
-                    pollreq.callback(pollreq.results)
+                self._walk_done(session, pollreq)
             else:
                 #print '_callback bulkwalk not done', last, oid_to_str(last)
                 # get more data
-                new_reqid = self.sessions[session].async_getbulk(0,
-                    self.maxrepetitions, [last])
-                self.reqmap[new_reqid] = pollreq
+                self._getbulk(session, pollreq, last)
 
         del self.reqmap[reqid]
 
@@ -950,6 +1653,15 @@ class AsyncSNMPPoller(object):
 
         del self.reqmap[reqid]
 
+        if pollreq.type == 'bulkwalk':
+            self.tune_maxrepetitions(session, pollreq.maxrepetitions, 0, 0,
+                    False, timeout=True)
+
+            # only report the first failed column of a walk
+            if pollreq.pollreq.failed:
+                return
+            pollreq.pollreq.failed = True
+
         # XXX look into getting actual error messages
         pollreq.errback("timeout")
 
@@ -1008,6 +1720,8 @@ def espoll():
     except PollerError, e:
         print str(e)
 
+    # don't wait for the poller's slot in the polling interval
+    poller.next_poll = time.time()
     poller.run_once()
 
     time.sleep(12)
@@ -1024,11 +1738,17 @@ def espoll():
 
 
 def espolld():
-    """Entry point for espolld."""
+    """Entry point for espolld.
+
+    If espolld_shards is greater than one this process becomes the
+    PollSupervisor and starts one espolld process per shard."""
     argv = sys.argv
     oparse = get_opt_parser(default_config_file=get_config_path())
+    oparse.add_option("-s", "--shard", dest="shard", default="")
     (opts, args) = oparse.parse_args(args=argv)
 
+    opts.config_file = os.path.abspath(opts.config_file)
+
     django.setup()
 
     try:
@@ -1038,6 +1758,8 @@ def espolld():
         sys.exit(1)
 
     name = "espolld"
+    if opts.shard:
+        name += ".shard%s" % opts.shard
 
     init_logging(name, config.syslog_facility, level=config.syslog_priority,
             debug=opts.debug)
@@ -1049,11 +1771,21 @@ def espolld():
         exc_handler = setup_exc_handler(name, config)
         exc_handler.install()
 
-        daemonize(name, config.pid_dir,
-                log_stdout_stderr=config.syslog_facility)
+        # shards are started by an already daemonized supervisor
+        if not opts.shard:
+            daemonize(name, config.pid_dir,
+                    log_stdout_stderr=config.syslog_facility)
 
     os.umask(0022)
 
+    if config.espolld_shards > 1 and not opts.shard:
+        try:
+            PollSupervisor(name, opts, config).run()
+        except Exception, e:
+            log.error("Problem with poll supervisor: %s" % e)
+            sys.exit(1)
+        return
+
     try:
         poller = PollManager(name, opts, args, config)
 
@@ -163,6 +163,16 @@ REST_FRAMEWORK = {
     }
 }
 
+# The throttles keep their state in the default cache, put it in memcached
+# so it is shared by all of the WSGI processes.
+if ESMOND_SETTINGS.api_throttle_memcached:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': ESMOND_SETTINGS.api_throttle_memcached,
+        }
+    }
+
 ALLOWED_HOSTS = ['localhost', '127.0.0.1']
 if ESMOND_SETTINGS.allowed_hosts:
     ALLOWED_HOSTS.extend(ESMOND_SETTINGS.allowed_hosts)
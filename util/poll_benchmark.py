@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+Benchmark espolld against a fleet of simulated SNMP agents.
+
+This starts util/snmp_agent_sim.py with the requested number of agents,
+creates a Device for each of them (named by its address, eg.
+127.0.0.1:20161) with the given oidsets and runs espolld against them for
+--duration seconds.  espolld writes its polling stats (see poll_stats_file)
+to a temporary directory and the benchmark reports from those:
+
+  - polls completed against the number expected for the duration
+  - timeouts and overruns (polls that took longer than their frequency)
+  - GETBULK PDUs and varbinds per poll
+  - approximate poll duration percentiles and the slowest pollers
+  - espolld CPU time
+
+espolld polls every active device in the database, so run this against a
+scratch database.  Unless --persist is given espoll_persist_uri is removed
+from the config and the polled data is discarded.  The devices created by
+the benchmark are deleted afterwards unless --keep is given.
+"""
+
+import ConfigParser
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import django
+from django.utils.timezone import now
+
+from esmond.config import get_config_path
+from esmond.poll import PollStats
+
+
+def read_stats(path):
+    """Merge the stats files written by espolld and its shards."""
+    pollers = {}
+    depth = 0
+    for fname in [path] + glob.glob(path + '.*'):
+        if fname.endswith('.tmp') or not os.path.exists(fname):
+            continue
+        try:
+            stats = json.load(open(fname))
+        except ValueError:
+            continue
+        pollers.update(stats['pollers'])
+        depth += stats.get('persistq_depth', 0)
+
+    return pollers, depth
+
+
+def percentile(histogram, total, q):
+    bounds = ['%g' % b for b in PollStats.DURATION_BUCKETS] + ['inf']
+    n = 0
+    for bound in bounds:
+        n += histogram.get(bound, 0)
+        if n >= q * total:
+            return bound
+
+    return 'inf'
+
+
+def report(pollers, frequencies, duration, cpu):
+    totals = dict(polls=0, timeouts=0, overruns=0, pdus=0, varbinds=0,
+            duration_total=0.0)
+    histogram = {}
+    expected = 0
+    slowest = []
+
+    for device, oidsets in pollers.iteritems():
+        for oidset, stats in oidsets.iteritems():
+            for k in totals:
+                totals[k] += stats[k]
+            for bound, n in stats['duration_histogram'].iteritems():
+                histogram[bound] = histogram.get(bound, 0) + n
+            expected += int(duration / frequencies.get(oidset, duration))
+            if stats['polls']:
+                slowest.append((stats['duration_total'] / stats['polls'],
+                    stats['timeouts'], device, oidset))
+
+    polls = totals['polls']
+    print
+    print "pollers:     %d" % len(slowest)
+    print "polls:       %d of ~%d expected" % (polls, expected)
+    print "timeouts:    %d" % totals['timeouts']
+    print "overruns:    %d" % totals['overruns']
+    if polls:
+        print "pdus/poll:   %.1f" % (float(totals['pdus']) / polls)
+        print "vars/poll:   %.1f" % (float(totals['varbinds']) / polls)
+        print "duration:    mean %.3fs, p50 <= %ss, p95 <= %ss, p99 <= %ss" % (
+                totals['duration_total'] / polls,
+                percentile(histogram, polls, 0.5),
+                percentile(histogram, polls, 0.95),
+                percentile(histogram, polls, 0.99))
+    if cpu:
+        print "espolld cpu: %.1fs user, %.1fs system, %.1f%% of one core" % (
+                cpu[0], cpu[1], 100.0 * (cpu[0] + cpu[1]) / duration)
+
+    slowest.sort(reverse=True)
+    if slowest:
+        print
+        print "slowest pollers (mean duration, timeouts):"
+        for mean, timeouts, device, oidset in slowest[:10]:
+            print "  %-24s %-20s %.3fs %d" % (device, oidset, mean, timeouts)
+
+
+def write_config(base_config, path, options, stats_file):
+    cfg = ConfigParser.RawConfigParser()
+    cfg.read(base_config)
+    cfg.set('main', 'poll_stats_file', stats_file)
+    cfg.set('main', 'poll_stats_interval', str(options.stats_interval))
+    cfg.set('main', 'espolld_shards', str(options.shards))
+    cfg.set('main', 'pid_dir', os.path.dirname(path))
+    if not options.persist:
+        cfg.remove_option('main', 'espoll_persist_uri')
+
+    f = open(path, 'w')
+    cfg.write(f)
+    f.close()
+
+
+def create_devices(options):
+    from esmond.api.models import Device, OIDSet, DeviceOIDSetMap
+
+    oidsets = [OIDSet.objects.get(name=name)
+            for name in options.oidsets.split(',')]
+
+    created = []
+    for port in range(options.base_port, options.base_port + options.devices):
+        device, new = Device.objects.get_or_create(
+                name="127.0.0.1:%d" % port,
+                defaults=dict(community=options.community, begin_time=now()))
+        if new:
+            created.append(device.name)
+            for oidset in oidsets:
+                DeviceOIDSetMap(device=device, oid_set=oidset).save()
+
+    others = Device.objects.active().exclude(
+            name__startswith="127.0.0.1:").count()
+    if others:
+        print "warning: %d other active devices will be polled too" % others
+
+    return created, dict((o.name, o.frequency) for o in oidsets)
+
+
+def delete_devices(names):
+    from esmond.api.models import Device
+    Device.objects.filter(name__in=names).delete()
+
+
+def main():
+    usage = '%prog [ -n NUM | -o OIDSETS | -d SECONDS | -i NUM | -l MS ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--config-file', metavar='CONFIG',
+            type='string', dest='config_file', default=get_config_path(),
+            help='esmond config to base the benchmark on (default=%default).')
+    parser.add_option('-n', '--devices', metavar='NUM_DEVICES',
+            type='int', dest='devices', default=100,
+            help='Number of simulated devices (default=%default).')
+    parser.add_option('-b', '--base-port', metavar='PORT',
+            type='int', dest='base_port', default=20161,
+            help='UDP port of the first simulated device (default=%default).')
+    parser.add_option('-o', '--oidsets', metavar='OIDSETS',
+            type='string', dest='oidsets', default='FastPollHC',
+            help='Comma separated oidsets to poll (default=%default).')
+    parser.add_option('-d', '--duration', metavar='SECONDS',
+            type='int', dest='duration', default=300,
+            help='How long to run espolld (default=%default).')
+    parser.add_option('-s', '--stats-interval', metavar='SECONDS',
+            type='int', dest='stats_interval', default=30,
+            help='How often espolld writes stats (default=%default).')
+    parser.add_option('-S', '--shards', metavar='NUM_SHARDS',
+            type='int', dest='shards', default=1,
+            help='Number of espolld shards (default=%default).')
+    parser.add_option('-c', '--community', metavar='COMMUNITY',
+            type='string', dest='community', default='public',
+            help='SNMP community (default=%default).')
+    parser.add_option('-i', '--interfaces', metavar='NUM_INTERFACES',
+            type='int', dest='interfaces', default=48,
+            help='Interfaces per simulated device (default=%default).')
+    parser.add_option('-l', '--latency', metavar='MS',
+            type='float', dest='latency', default=0.0,
+            help='Mean simulated response latency (default=%default).')
+    parser.add_option('-J', '--jitter', metavar='MS',
+            type='float', dest='jitter', default=0.0,
+            help='Simulated latency standard deviation (default=%default).')
+    parser.add_option('-L', '--loss', metavar='FRACTION',
+            type='float', dest='loss', default=0.0,
+            help='Fraction of requests the simulator drops '
+            '(default=%default).')
+    parser.add_option('-j', '--sim-processes', metavar='NUM_PROCESSES',
+            type='int', dest='sim_processes', default=1,
+            help='Number of simulator processes (default=%default).')
+    parser.add_option('--no-sim',
+            dest='sim', action='store_false', default=True,
+            help="Don't start the simulator, use one which is already "
+            "running.")
+    parser.add_option('--espolld', metavar='PATH',
+            type='string', dest='espolld',
+            default=os.path.join(os.path.dirname(sys.executable), 'espolld'),
+            help='espolld to run (default=%default).')
+    parser.add_option('--persist',
+            dest='persist', action='store_true', default=False,
+            help='Send the polled data to espoll_persist_uri.')
+    parser.add_option('-k', '--keep',
+            dest='keep', action='store_true', default=False,
+            help="Don't delete the simulated devices afterwards.")
+    options, args = parser.parse_args()
+
+    django.setup()
+
+    tmpdir = tempfile.mkdtemp(prefix='esmond_poll_benchmark_')
+    config_file = os.path.join(tmpdir, 'esmond.conf')
+    stats_file = os.path.join(tmpdir, 'espolld_stats.json')
+    write_config(options.config_file, config_file, options, stats_file)
+
+    created, frequencies = create_devices(options)
+    print "%d devices, %d created, polling %s" % (options.devices,
+            len(created), options.oidsets)
+
+    sim = None
+    espolld = None
+    cpu = None
+    keep_tmpdir = False
+    try:
+        if options.sim:
+            sim = subprocess.Popen([sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'snmp_agent_sim.py'),
+                '-n', str(options.devices),
+                '-b', str(options.base_port),
+                '-i', str(options.interfaces),
+                '-c', options.community,
+                '-l', str(options.latency),
+                '-J', str(options.jitter),
+                '-L', str(options.loss),
+                '-j', str(options.sim_processes)])
+            time.sleep(1)
+
+        log = open(os.path.join(tmpdir, 'espolld.log'), 'w')
+        espolld = subprocess.Popen([options.espolld, '-d', '-f', config_file],
+                stdout=log, stderr=subprocess.STDOUT)
+        print "espolld pid %d, logging to %s" % (espolld.pid, log.name)
+
+        begin = time.time()
+        while time.time() - begin < options.duration:
+            time.sleep(min(options.stats_interval,
+                options.duration - (time.time() - begin)))
+            if espolld.poll() is not None:
+                print "espolld exited early, see %s" % log.name
+                keep_tmpdir = True
+                break
+
+            pollers, depth = read_stats(stats_file)
+            polls = sum([s['polls'] for o in pollers.itervalues()
+                for s in o.itervalues()])
+            timeouts = sum([s['timeouts'] for o in pollers.itervalues()
+                for s in o.itervalues()])
+            print "%4ds: %d polls, %d timeouts, persistq depth %d" % (
+                    time.time() - begin, polls, timeouts, depth)
+
+        duration = time.time() - begin
+        if espolld.poll() is None:
+            espolld.send_signal(signal.SIGTERM)
+            pid, status, rusage = os.wait4(espolld.pid, 0)
+            cpu = (rusage.ru_utime, rusage.ru_stime)
+        espolld = None
+
+        pollers, depth = read_stats(stats_file)
+        report(pollers, frequencies, duration, cpu)
+    finally:
+        if espolld and espolld.poll() is None:
+            espolld.kill()
+        if sim and sim.poll() is None:
+            sim.send_signal(signal.SIGTERM)
+            sim.wait()
+        if not options.keep:
+            delete_devices(created)
+        if not keep_tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
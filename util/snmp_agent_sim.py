@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+"""
+Simulate a fleet of SNMP agents on localhost for espolld load testing.
+
+Each agent listens on its own UDP port of 127.0.0.1 and answers SNMPv2c GET,
+GETNEXT and GETBULK requests for the system group, ifTable and ifXTable of
+a device with the given number of interfaces.  Counters increase at a
+steady, per interface rate so the data looks like traffic.  Responses can
+be delayed and dropped to simulate slow and lossy devices, and GETBULK
+responses are cut off at --max-pdu bytes like a real agent's would be.
+
+Agents are named by their address, so a device named 127.0.0.1:20161 in
+esmond polls the first agent.  See util/poll_benchmark.py.
+
+The protocol support is only what espolld needs: no SNMPv1 traps, SETs or
+SNMPv3.  Use -j to spread a large fleet over several processes.
+"""
+
+import bisect
+import errno
+import heapq
+import itertools
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+
+from optparse import OptionParser
+
+# BER tags
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_ID = 0x06
+SEQUENCE = 0x30
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+END_OF_MIB_VIEW = 0x82
+
+GET = 0xa0
+GETNEXT = 0xa1
+RESPONSE = 0xa2
+GETBULK = 0xa5
+
+SYSTEM = (1, 3, 6, 1, 2, 1, 1)
+IF_NUMBER = (1, 3, 6, 1, 2, 1, 2, 1, 0)
+IF_ENTRY = (1, 3, 6, 1, 2, 1, 2, 2, 1)
+IF_X_ENTRY = (1, 3, 6, 1, 2, 1, 31, 1, 1, 1)
+IF_TABLE_LAST_CHANGE = (1, 3, 6, 1, 2, 1, 31, 1, 5, 0)
+
+
+class BERError(Exception):
+    pass
+
+
+def encode_length(n):
+    if n < 0x80:
+        return chr(n)
+
+    s = ''
+    while n:
+        s = chr(n & 0xff) + s
+        n >>= 8
+
+    return chr(0x80 | len(s)) + s
+
+
+def encode_tlv(tag, value):
+    return chr(tag) + encode_length(len(value)) + value
+
+
+def encode_int(n, tag=INTEGER):
+    s = ''
+    while True:
+        s = chr(n & 0xff) + s
+        n >>= 8
+        if (n == 0 and not ord(s[0]) & 0x80) or \
+                (n == -1 and ord(s[0]) & 0x80):
+            break
+
+    return encode_tlv(tag, s)
+
+
+def encode_oid(oid):
+    s = chr(40 * oid[0] + oid[1])
+    for n in oid[2:]:
+        b = chr(n & 0x7f)
+        n >>= 7
+        while n:
+            b = chr(0x80 | (n & 0x7f)) + b
+            n >>= 7
+        s += b
+
+    return encode_tlv(OBJECT_ID, s)
+
+
+def decode_tlv(data, i):
+    """Return (tag, value, offset of the next TLV)."""
+    try:
+        tag = ord(data[i])
+        n = ord(data[i + 1])
+        i += 2
+        if n & 0x80:
+            nbytes = n & 0x7f
+            n = 0
+            for c in data[i:i + nbytes]:
+                n = (n << 8) | ord(c)
+            i += nbytes
+    except IndexError:
+        raise BERError("truncated message")
+
+    if i + n > len(data):
+        raise BERError("truncated message")
+
+    return tag, data[i:i + n], i + n
+
+
+def decode_int(s):
+    n = 0
+    for c in s:
+        n = (n << 8) | ord(c)
+    if s and ord(s[0]) & 0x80:
+        n -= 1 << (8 * len(s))
+
+    return n
+
+
+def decode_oid(s):
+    if not s:
+        raise BERError("empty OID")
+
+    oid = [ord(s[0]) // 40, ord(s[0]) % 40]
+    n = 0
+    for c in s[1:]:
+        n = (n << 7) | (ord(c) & 0x7f)
+        if not ord(c) & 0x80:
+            oid.append(n)
+            n = 0
+
+    return tuple(oid)
+
+
+class SimulatedMib(object):
+    """The OIDs served by every agent, in lexicographic order.
+
+    Values are functions of the agent and the current time so that one
+    table can be shared by the whole fleet."""
+
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+        self.values = {}
+
+        self._scalar(SYSTEM + (1, 0), lambda a, t:
+                encode_tlv(OCTET_STRING, "esmond simulated agent"))
+        self._scalar(SYSTEM + (3, 0), lambda a, t:
+                encode_int(a.uptime(t), TIMETICKS))
+        self._scalar(SYSTEM + (5, 0), lambda a, t:
+                encode_tlv(OCTET_STRING, a.name))
+        self._scalar(IF_NUMBER, lambda a, t: encode_int(interfaces))
+        self._scalar(IF_TABLE_LAST_CHANGE, lambda a, t:
+                encode_int(0, TIMETICKS))
+
+        for i in range(1, interfaces + 1):
+            self._if_entry(i)
+
+        self.oids = sorted(self.values.iterkeys())
+
+    def _scalar(self, oid, f):
+        self.values[oid] = f
+
+    def _if_entry(self, i):
+        def const(tag, value):
+            return lambda a, t: encode_int(value, tag)
+
+        def string(value):
+            return lambda a, t: encode_tlv(OCTET_STRING, value)
+
+        def counter(tag, scale, mask):
+            return lambda a, t: encode_int(
+                    int(a.octets(i, t) * scale) & mask, tag)
+
+        c32 = 0xffffffff
+        c64 = 0xffffffffffffffff
+
+        name = "xe-0/0/%d" % (i - 1)
+        columns = {
+            IF_ENTRY + (1,): const(INTEGER, i),
+            IF_ENTRY + (2,): string(name),
+            IF_ENTRY + (3,): const(INTEGER, 6),
+            IF_ENTRY + (4,): const(INTEGER, 9192),
+            IF_ENTRY + (5,): const(GAUGE32, 4294967295),
+            IF_ENTRY + (6,): string('\x00\x1b\x21' + chr(i >> 16 & 0xff) +
+                chr(i >> 8 & 0xff) + chr(i & 0xff)),
+            IF_ENTRY + (7,): const(INTEGER, 1),
+            IF_ENTRY + (8,): const(INTEGER, 1),
+            IF_ENTRY + (10,): counter(COUNTER32, 1, c32),
+            IF_ENTRY + (13,): counter(COUNTER32, 1e-7, c32),
+            IF_ENTRY + (14,): counter(COUNTER32, 1e-8, c32),
+            IF_ENTRY + (16,): counter(COUNTER32, 0.8, c32),
+            IF_ENTRY + (19,): counter(COUNTER32, 1e-7, c32),
+            IF_ENTRY + (20,): counter(COUNTER32, 1e-8, c32),
+            IF_X_ENTRY + (1,): string(name),
+            IF_X_ENTRY + (6,): counter(COUNTER64, 1, c64),
+            IF_X_ENTRY + (7,): counter(COUNTER64, 1 / 800.0, c64),
+            IF_X_ENTRY + (10,): counter(COUNTER64, 0.8, c64),
+            IF_X_ENTRY + (11,): counter(COUNTER64, 0.8 / 800.0, c64),
+            IF_X_ENTRY + (15,): const(GAUGE32, 10000),
+            IF_X_ENTRY + (18,): string("simulated interface %d" % i),
+        }
+
+        for column, f in columns.iteritems():
+            self.values[column + (i,)] = f
+
+    def get(self, agent, oid, t):
+        try:
+            return encode_oid(oid) + self.values[oid](agent, t)
+        except KeyError:
+            return encode_oid(oid) + encode_tlv(NO_SUCH_OBJECT, '')
+
+    def next(self, agent, oid, t):
+        """Return (next oid, encoded varbind), next oid is None at the end
+        of the MIB."""
+        i = bisect.bisect_right(self.oids, oid)
+        if i == len(self.oids):
+            return None, encode_oid(oid) + encode_tlv(END_OF_MIB_VIEW, '')
+
+        noid = self.oids[i]
+        return noid, encode_oid(noid) + self.values[noid](agent, t)
+
+
+class SimulatedAgent(object):
+    def __init__(self, port, mib, community, max_pdu):
+        self.port = port
+        self.name = "127.0.0.1:%d" % port
+        self.mib = mib
+        self.community = community
+        self.max_pdu = max_pdu
+
+        rand = random.Random(port)
+        self.boot_time = time.time() - rand.uniform(3600, 86400 * 30)
+        # bytes/sec per interface
+        self.rates = [rand.uniform(1e3, 1e9) for i in range(mib.interfaces + 1)]
+
+        self.requests = 0
+        self.dropped = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.setblocking(0)
+
+    def uptime(self, t):
+        return int((t - self.boot_time) * 100)
+
+    def octets(self, ifindex, t):
+        return (t - self.boot_time) * self.rates[ifindex]
+
+    def handle(self, data):
+        """Return the response to the request in data or None."""
+        _, msg, _ = decode_tlv(data, 0)
+        _, version, i = decode_tlv(msg, 0)
+        _, community, i = decode_tlv(msg, i)
+        if community != self.community:
+            return None
+
+        pdu_type, pdu, _ = decode_tlv(msg, i)
+        _, reqid, i = decode_tlv(pdu, 0)
+        _, a, i = decode_tlv(pdu, i)
+        _, b, i = decode_tlv(pdu, i)
+        _, vbl, _ = decode_tlv(pdu, i)
+
+        oids = []
+        i = 0
+        while i < len(vbl):
+            _, vb, i = decode_tlv(vbl, i)
+            _, oid, _ = decode_tlv(vb, 0)
+            oids.append(decode_oid(oid))
+
+        t = time.time()
+        if pdu_type == GET:
+            varbinds = [self.mib.get(self, oid, t) for oid in oids]
+        elif pdu_type == GETNEXT:
+            varbinds = [self.mib.next(self, oid, t)[1] for oid in oids]
+        elif pdu_type == GETBULK:
+            varbinds = self.getbulk(decode_int(a), decode_int(b), oids, t)
+        else:
+            return None
+
+        # keep the response under max_pdu, leaving room for the headers
+        budget = self.max_pdu - 64 - len(community)
+        body = ''
+        for vb in varbinds:
+            vb = encode_tlv(SEQUENCE, vb)
+            if body and len(body) + len(vb) > budget:
+                break
+            body += vb
+
+        pdu = encode_tlv(INTEGER, reqid) + encode_int(0) + encode_int(0) + \
+                encode_tlv(SEQUENCE, body)
+
+        return encode_tlv(SEQUENCE, encode_tlv(INTEGER, version) +
+                encode_tlv(OCTET_STRING, community) +
+                encode_tlv(RESPONSE, pdu))
+
+    def getbulk(self, nonrepeaters, maxrepetitions, oids, t):
+        varbinds = [self.mib.next(self, oid, t)[1]
+                for oid in oids[:nonrepeaters]]
+
+        repeaters = oids[nonrepeaters:]
+        for i in range(maxrepetitions):
+            if not repeaters:
+                break
+
+            nexts = [self.mib.next(self, oid, t) for oid in repeaters]
+            varbinds.extend([vb for (oid, vb) in nexts])
+            if all(oid is None for (oid, vb) in nexts):
+                break
+            repeaters = [oid or old for ((oid, vb), old)
+                    in zip(nexts, repeaters)]
+
+        return varbinds
+
+
+class AgentFleet(object):
+    """Serve a set of agents from one process with poll(2)."""
+
+    def __init__(self, agents, latency, jitter, loss):
+        self.agents = dict((a.sock.fileno(), a) for a in agents)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        self.pending = []
+        self.seq = itertools.count()
+        self.running = False
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def delay(self):
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def run(self):
+        poller = select.poll()
+        for fd in self.agents:
+            poller.register(fd, select.POLLIN)
+
+        self.running = True
+        while self.running:
+            timeout = 1000
+            if self.pending:
+                timeout = max(0, (self.pending[0][0] - time.time()) * 1000)
+
+            try:
+                events = poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                agent = self.agents[fd]
+                try:
+                    data, addr = agent.sock.recvfrom(65535)
+                except socket.error:
+                    continue
+
+                agent.requests += 1
+                if random.random() < self.loss:
+                    agent.dropped += 1
+                    continue
+
+                try:
+                    response = agent.handle(data)
+                except BERError:
+                    continue
+
+                if response:
+                    heapq.heappush(self.pending, (time.time() + self.delay(),
+                        self.seq.next(), agent, response, addr))
+
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, agent, response, addr = heapq.heappop(self.pending)
+                try:
+                    agent.sock.sendto(response, addr)
+                except socket.error:
+                    pass
+
+        requests = sum([a.requests for a in self.agents.itervalues()])
+        dropped = sum([a.dropped for a in self.agents.itervalues()])
+        print "pid %d: %d agents, %d requests, %d dropped" % (os.getpid(),
+                len(self.agents), requests, dropped)
+
+
+def main():
+    usage = '%prog [ -n NUM | -b PORT | -i NUM | -l MS | -L FRACTION ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--agents', metavar='NUM_AGENTS',
+            type='int', dest='agents', default=10,
+            help='Number of agents to simulate (default=%default).')
+    parser.add_option('-b', '--base-port', metavar='PORT',
+            type='int', dest='base_port', default=20161,
+            help='UDP port of the first agent, the others follow it '
+            '(default=%default).')
+    parser.add_option('-i', '--interfaces', metavar='NUM_INTERFACES',
+            type='int', dest='interfaces', default=48,
+            help='Number of interfaces on each agent (default=%default).')
+    parser.add_option('-c', '--community', metavar='COMMUNITY',
+            type='string', dest='community', default='public',
+            help='SNMP community (default=%default).')
+    parser.add_option('-l', '--latency', metavar='MS',
+            type='float', dest='latency', default=0.0,
+            help='Mean response latency in milliseconds (default=%default).')
+    parser.add_option('-J', '--jitter', metavar='MS',
+            type='float', dest='jitter', default=0.0,
+            help='Standard deviation of the latency in milliseconds '
+            '(default=%default).')
+    parser.add_option('-L', '--loss', metavar='FRACTION',
+            type='float', dest='loss', default=0.0,
+            help='Fraction of requests to drop (default=%default).')
+    parser.add_option('-m', '--max-pdu', metavar='BYTES',
+            type='int', dest='max_pdu', default=1472,
+            help='Maximum response size in bytes (default=%default).')
+    parser.add_option('-j', '--processes', metavar='NUM_PROCESSES',
+            type='int', dest='processes', default=1,
+            help='Number of processes to spread the agents over '
+            '(default=%default).')
+    options, args = parser.parse_args()
+
+    mib = SimulatedMib(options.interfaces)
+    ports = range(options.base_port, options.base_port + options.agents)
+
+    children = []
+    for n in range(options.processes):
+        my_ports = ports[n::options.processes]
+        if not my_ports:
+            break
+
+        if options.processes > 1:
+            pid = os.fork()
+            if pid:
+                children.append(pid)
+                continue
+
+        agents = [SimulatedAgent(port, mib, options.community,
+            options.max_pdu) for port in my_ports]
+        fleet = AgentFleet(agents, options.latency / 1000.0,
+                options.jitter / 1000.0, options.loss)
+        signal.signal(signal.SIGINT, fleet.stop)
+        signal.signal(signal.SIGTERM, fleet.stop)
+
+        if options.processes == 1:
+            print "serving %d agents on 127.0.0.1:%d-%d" % (len(agents),
+                    ports[0], ports[-1])
+        fleet.run()
+        if options.processes > 1:
+            os._exit(0)
+        return 0
+
+    print "serving %d agents on 127.0.0.1:%d-%d in %d processes" % (
+            len(ports), ports[0], ports[-1], len(children))
+
+    def stop_children(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_children)
+    signal.signal(signal.SIGTERM, stop_children)
+
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())